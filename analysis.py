@@ -1,10 +1,12 @@
 """Code used in citation network analysis."""
 from __future__ import print_function
-import random
 
-import networkx
+import numpy
 import pandas
 
+import instrument
+from csrgraph import as_csr, expand_ranges
+
 # # Setup and helpers
 
 def normalize(series):
@@ -23,7 +25,7 @@ class AnnotatedNetwork(object):
 
     Constructor arguments:
 
-    -   **`network`** is a `networkx.DiGraph`.
+    -   **`network`** is a `networkx.DiGraph` or a `csrgraph.CSRGraph`.
 
     -   **`metadata`** is a `pandas.DataFrame`.
 
@@ -47,44 +49,118 @@ class AnnotatedNetwork(object):
             used to create the neighborhood.
 
         """
-        neighborhood = set([root])
-        for _ in range(depth):
-            # Expand by adding all nodes adjacent to any node currently in the
-            # neighborhood.
-            for node in neighborhood.copy():
-                neighborhood |= set(self.network.predecessors(node))
-        return neighborhood
+        import nhood
+        return nhood.neighborhood(self.network, root, depth, closed=True)
 
+    @instrument.traced('AnnotatedNetwork.classify')
     def classify(self, node, field, max_cited=20):
+        """Predict a node's `field` value from the nodes it cites.
+
+        The prediction is the most common value of `field` among the
+        `max_cited` cited nodes with the highest indegree (ties broken by
+        lowest label), or `None` if none of them has a value. Ties between
+        values go to the smallest one, as with `pandas.Series.mode`.
+
+        """
         metadata = self.metadata[field]
-        cited = self.network.successors(node)
+        cited = list(self.network.successors(node))
         if len(cited) > max_cited:
-            indegrees = pandas.Series(self.network.in_degree(cited))
-            indegrees.sort(ascending=False)
-            cited = indegrees.head(max_cited)
-        values = metadata.loc[cited]
+            indegrees = pandas.Series(dict(self.network.in_degree(cited)))
+            indegrees = indegrees.sort_index().sort_values(ascending=False,
+                                                           kind='mergesort')
+            cited = indegrees.head(max_cited).index
+        values = metadata[metadata.index.isin(cited)]
         mode = values.mode()
         return mode[0] if len(mode) else None
 
+    @instrument.traced('AnnotatedNetwork.classify_many', items=len)
+    def classify_many(self, nodes, field, max_cited=20):
+        """Classify many nodes at once, return a `pandas.Series`.
+
+        Gives the same predictions as calling `classify` on each node, but
+        selects the top cited nodes and takes the vote for all of `nodes`
+        together with array operations over the CSR edge list and the
+        categorical codes of the metadata column.
+
+        """
+        csr = self.csr()
+        codes, categories, meta_indptr = self._encoded(field)
+        nodes = list(nodes)
+        queries = csr.ids(nodes)
+
+        # All (query, cited) pairs, then keep the top `max_cited` per query
+        # by indegree, lowest label first among equal indegrees.
+        owner, positions = expand_ranges(csr.indptr, queries)
+        cited = csr.indices[positions]
+        indegrees = csr.in_degree_array()
+        order = numpy.lexsort((cited, -indegrees[cited], owner))
+        owner, cited = owner[order], cited[order]
+        starts = numpy.searchsorted(owner, owner, side='left')
+        keep = numpy.arange(len(owner)) - starts < max_cited
+        owner, cited = owner[keep], cited[keep]
+
+        # Look up the metadata values of the selected cited nodes and count
+        # votes per (query, value).
+        voter, rows = expand_ranges(meta_indptr, cited)
+        votes = pandas.DataFrame({'query': owner[voter], 'code': codes[rows]})
+        counts = votes.groupby(['query', 'code']).size().reset_index(
+            name='count')
+        counts = counts.sort_values(['query', 'count', 'code'],
+                                    ascending=[True, False, True],
+                                    kind='mergesort')
+        winners = counts.drop_duplicates('query')
+        result = pandas.Series([None] * len(nodes), index=nodes,
+                               dtype=object, name=field)
+        result.iloc[winners['query'].values] = numpy.asarray(
+            categories)[winners['code'].values]
+        return result
+
+    def csr(self):
+        """Return the network as a (cached) `csrgraph.CSRGraph`."""
+        if getattr(self, '_csr_network', None) is None:
+            self._csr_network = as_csr(self.network)
+        return self._csr_network
+
+    def _encoded(self, field):
+        """Return `(codes, categories, indptr)` for a metadata column.
+
+        Non-null values of `field` are encoded as sorted category codes and
+        grouped by the dense id of their node, so the codes of node `i` are
+        `codes[indptr[i]:indptr[i+1]]`. Rows for nodes outside the network
+        are dropped. Results are cached per field.
+
+        """
+        cache = self.__dict__.setdefault('_encoded_fields', {})
+        if field not in cache:
+            csr = self.csr()
+            series = self.metadata[field].dropna()
+            if isinstance(series.dtype, pandas.CategoricalDtype):
+                codes = series.cat.codes.values
+                categories = series.cat.categories
+            else:
+                codes, categories = pandas.factorize(series, sort=True)
+            labels = series.index.values.astype(numpy.int64)
+            ids = numpy.searchsorted(csr.labels, labels)
+            ids[ids == len(csr.labels)] = 0
+            present = (csr.labels[ids] == labels if len(csr.labels)
+                       else numpy.zeros(len(labels), dtype=bool))
+            ids, codes = ids[present], codes[present]
+            order = numpy.argsort(ids, kind='mergesort')
+            indptr = numpy.zeros(len(csr.labels) + 1, dtype=numpy.int64)
+            numpy.cumsum(numpy.bincount(ids, minlength=len(csr.labels)),
+                         out=indptr[1:])
+            cache[field] = (codes[order], categories, indptr)
+        return cache[field]
+
     # # Main report generator
 
-    def report(self):
-        """Generate a LaTeX report, return as `str`."""
-
-        metrics = pandas.DataFrame({
-            'indegree': self.network.in_degree(),
-            'pagerank': networkx.pagerank_scipy(self.network, max_iter=200),
-        })
-        mean = metrics.mean()
-        std = metrics.std()
-
-        for field, series in self.metadata.items():
-            successes = 0
-            for node in random.sample(series.index.tolist(), 100):
-                value = self.classify(node, field)
-                try:
-                    if value == series.loc[node] or value in series.loc[node]:
-                        successes += 1
-                except Exception:
-                    pass
-            print(field, successes)
+    def report(self, samples=100, max_cited=(20,), seed=0, processes=None):
+        """Evaluate classification accuracy for every metadata field.
+
+        Return a `pandas.DataFrame` with one row per field and `max_cited`
+        setting; see `evaluation.evaluate` for the columns.
+
+        """
+        import evaluation
+        return evaluation.evaluate(self, max_cited=max_cited, samples=samples,
+                                   seed=seed, processes=processes)
@@ -0,0 +1,125 @@
+"""Approximate neighborhood function (HyperANF).
+
+Every node gets a HyperLogLog counter estimating the size of its closed
+neighborhood. A counter starts out holding just the node itself; after round
+`k` it is the union (register-wise maximum) of its own counter and those of
+its predecessors from round `k - 1`, so it estimates the size of the closed
+`k`-neighborhood. All counters are rows of one `uint8` register array, and a
+round is a segmented maximum over the reverse CSR adjacency.
+
+The relative standard error of each estimate is about `1.04 / sqrt(m)` for
+`m` registers per counter.
+
+"""
+import math
+
+import numpy
+import pandas
+
+import nhood
+from csrgraph import as_csr
+
+DEFAULT_ERROR = 0.05 # target relative standard error of the estimates
+EDGE_BLOCK_BYTES = 64 * 2**20 # bound on gathered registers per block
+
+def register_bits(error=DEFAULT_ERROR):
+    """Return the number of index bits `b` (`m = 2**b` registers) needed for
+    a relative standard error of at most `error`."""
+    m = (1.04 / error) ** 2
+    return min(max(int(math.ceil(math.log2(m))), 4), 16)
+
+def hash64(labels):
+    """Return 64-bit hashes of int64 labels (splitmix64 finalizer)."""
+    x = labels.astype(numpy.uint64) + numpy.uint64(0x9E3779B97F4A7C15)
+    x = (x ^ (x >> numpy.uint64(30))) * numpy.uint64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> numpy.uint64(27))) * numpy.uint64(0x94D049BB133111EB)
+    return x ^ (x >> numpy.uint64(31))
+
+def initial_registers(labels, bits):
+    """Return HyperLogLog registers holding one element per label."""
+    hashes = hash64(numpy.asarray(labels, dtype=numpy.int64))
+    index = (hashes >> numpy.uint64(64 - bits)).astype(numpy.int64)
+    # Rank of the first set bit among the next 32 bits (33 if none are set).
+    word = ((hashes << numpy.uint64(bits)) >> numpy.uint64(32)).astype(
+        numpy.float64)
+    rank = numpy.full(len(labels), 33, dtype=numpy.uint8)
+    nonzero = word > 0
+    rank[nonzero] = 32 - numpy.floor(numpy.log2(word[nonzero])).astype(
+        numpy.uint8)
+    registers = numpy.zeros((len(labels), 1 << bits), dtype=numpy.uint8)
+    registers[numpy.arange(len(labels)), index] = rank
+    return registers
+
+def estimate(registers):
+    """Return the HyperLogLog cardinality estimate of each register row."""
+    m = registers.shape[1]
+    alpha = {16: 0.673, 32: 0.697, 64: 0.709}.get(m, 0.7213 / (1 + 1.079 / m))
+    raw = alpha * m * m / numpy.exp2(-registers.astype(numpy.float64)).sum(
+        axis=1)
+    zeros = (registers == 0).sum(axis=1)
+    # Linear counting is more accurate for small cardinalities.
+    small = (raw <= 2.5 * m) & (zeros > 0)
+    raw[small] = m * numpy.log(m / zeros[small])
+    return raw
+
+def _union_predecessors(registers, rindptr, rindices):
+    """Return one HyperANF round: each row maxed with its predecessors."""
+    result = registers.copy()
+    n, m = registers.shape
+    per_block = max(EDGE_BLOCK_BYTES // m, 1)
+    start = 0
+    while start < n:
+        # Take as many consecutive nodes as fit in one block of edges.
+        stop = int(numpy.searchsorted(rindptr, rindptr[start] + per_block,
+                                      side='right')) - 1
+        stop = min(max(stop, start + 1), n)
+        lo, hi = rindptr[start], rindptr[stop]
+        counts = numpy.diff(rindptr[start:stop+1])
+        nonempty = numpy.flatnonzero(counts)
+        if len(nonempty):
+            gathered = registers[rindices[lo:hi]]
+            offsets = (rindptr[start:stop][nonempty] - lo).astype(numpy.int64)
+            maxima = numpy.maximum.reduceat(gathered, offsets, axis=0)
+            rows = start + nonempty
+            result[rows] = numpy.maximum(result[rows], maxima)
+        start = stop
+    return result
+
+def neighborhood_function(graph, depth=3, error=DEFAULT_ERROR, closed=False):
+    """Estimate the 1..`depth` neighborhood sizes of every node.
+
+    Return a `pandas.DataFrame` indexed by node with columns `'1-nhood'` to
+    `'{depth}-nhood'`, in the same layout as `nhood.neighborhood_sizes`.
+    `error` is the target relative standard error of the estimates.
+
+    """
+    csr = as_csr(graph)
+    registers = initial_registers(csr.labels, register_bits(error))
+    offset = 0 if closed else 1
+    sizes = {}
+    for d in range(1, depth + 1):
+        registers = _union_predecessors(registers, csr.rindptr, csr.rindices)
+        sizes['{}-nhood'.format(d)] = numpy.maximum(
+            estimate(registers) - offset, 0)
+    return pandas.DataFrame(sizes, index=pandas.Index(csr.labels))
+
+def check_against_exact(graph, depth=3, top=20, error=DEFAULT_ERROR):
+    """Compare estimates with exact sizes for the top indegree nodes.
+
+    These are the seeds reported in `nhood_sizes.txt`. Return a
+    `pandas.DataFrame` with exact and estimated sizes and the relative error
+    for each depth.
+
+    """
+    csr = as_csr(graph)
+    indegrees = pandas.Series(csr.in_degree_array(), index=csr.labels)
+    seeds = indegrees.sort_values(ascending=False).head(top).index
+    exact = nhood.neighborhood_sizes(csr, seeds, depth)
+    approx = neighborhood_function(csr, depth, error).loc[seeds]
+    table = pandas.DataFrame(index=seeds)
+    for column in exact.columns:
+        table[column] = exact[column]
+        table[column + ' est'] = approx[column].round().astype(int)
+        table[column + ' err'] = ((approx[column] - exact[column])
+                                  / exact[column].clip(lower=1))
+    return table
@@ -0,0 +1,237 @@
+"""Benchmark suite on synthetic data.
+
+For each scale, a synthetic dataset is generated once (see `synthetic`) and
+cached in `PATENT_BENCHMARK_DIR`, then every stage of the analysis pipeline
+is timed on it: loading the graph and metadata, annotating, indegree,
+PageRank, neighborhoods, overlap and classification. Results are written as
+JSON, one record per scale and stage, and `compare` lines up two result
+files to spot regressions.
+
+Usage: `python benchmark.py --scales 10000 100000 --output results.json`,
+then `python benchmark.py --compare old.json new.json`.
+
+"""
+import os
+import os.path
+import sys
+import json
+import time
+import platform
+import argparse
+
+import numpy
+
+import dataio
+import synthetic
+
+SCALES = (10000, 100000, 1000000, 10000000)
+STAGES = ('load_graph', 'load_metadata', 'annotate', 'indegree', 'pagerank',
+          'nhood', 'overlap', 'classify')
+RESULTS_VERSION = 1
+# Stages whose state each stage reads; they run first even when not
+# selected.
+REQUIRES = {
+    'load_graph': (),
+    'load_metadata': (),
+    'annotate': ('load_graph', 'load_metadata'),
+    'indegree': ('load_graph',),
+    'pagerank': ('load_graph',),
+    'nhood': ('indegree',),
+    'overlap': ('indegree',),
+    'classify': ('load_graph', 'load_metadata'),
+}
+TOP_ROOTS = 20 # highest-indegree roots for the neighborhood stages
+CLASSIFY_SAMPLES = 10000
+
+def dataset(nodes, seed=0, directory=None):
+    """Return `(graph_file, meta_files)` of a cached synthetic dataset."""
+    if directory is None:
+        directory = os.environ.get('PATENT_BENCHMARK_DIR',
+            os.path.expanduser('~/.cache/patentdata/benchmark'))
+    path = os.path.join(directory, '{}-{}'.format(nodes, seed))
+    done = os.path.join(path, 'complete')
+    if not os.path.exists(done):
+        with dataio.timed('Generating {} synthetic patents'.format(nodes)):
+            synthetic.generate(path, nodes, seed)
+        open(done, 'w').close()
+    return synthetic.source_files(path)
+
+# # Stages
+#
+# Each stage takes the state dict filled by earlier stages, may add to it,
+# and returns the number of items it processed.
+
+def stage_load_graph(state):
+    state['graph'] = dataio.read_graph(state['graph_file'], backend='csr')
+    return state['graph'].number_of_edges()
+
+def stage_load_metadata(state):
+    state['metadata'] = dataio.read_metadata(
+        state['meta_files'], columns=list(dataio.ANALYSIS_COLUMNS))
+    return len(state['metadata'])
+
+def stage_annotate(state):
+    dataio.annotate_graph(state['graph'], state['metadata'])
+    return len(state['metadata'].columns)
+
+def stage_indegree(state):
+    indegrees = state['graph'].in_degree_array()
+    top = numpy.argsort(-indegrees, kind='mergesort')[:TOP_ROOTS]
+    state['roots'] = state['graph'].labels[top]
+    return len(indegrees)
+
+def stage_pagerank(state):
+    import pagerank
+    scores = pagerank.PageRank.from_graph(state['graph']).scores()
+    return len(scores)
+
+def stage_nhood(state):
+    import nhood
+    sizes = nhood.neighborhood_sizes(state['graph'], state['roots'], depth=3)
+    return int(sizes.values.sum())
+
+def stage_overlap(state):
+    import nhood
+    import overlap
+    sets = nhood.neighborhood_sets(state['graph'], state['roots'][:10])
+    overlap.overlap_table(sets)
+    return sum(len(members) for members in sets.values())
+
+def stage_classify(state):
+    from analysis import AnnotatedNetwork
+    graph = state['graph']
+    citing = numpy.flatnonzero(graph.out_degree_array() > 0)
+    rng = numpy.random.RandomState(0)
+    nodes = graph.labels[rng.choice(citing, min(CLASSIFY_SAMPLES,
+                                                len(citing)), replace=False)]
+    network = AnnotatedNetwork(graph, state['metadata'])
+    network.classify_many(nodes, 'appMyName')
+    return len(nodes)
+
+def with_prerequisites(stages):
+    """Return `stages` plus the stages they depend on, in `STAGES` order."""
+    needed = set()
+    def add(stage):
+        if stage not in needed:
+            needed.add(stage)
+            for requirement in REQUIRES[stage]:
+                add(requirement)
+    for stage in stages:
+        add(stage)
+    return [stage for stage in STAGES if stage in needed]
+
+def run_scale(nodes, seed=0, stages=STAGES, directory=None):
+    """Time the stages on one scale, return a list of result dicts.
+
+    Prerequisites of the selected stages also run and are recorded with
+    `selected` false. A stage that raises is recorded with its error, and
+    the stages depending on it are recorded as skipped; the others still
+    run.
+
+    """
+    graph_file, meta_files = dataset(nodes, seed, directory)
+    state = {'graph_file': graph_file, 'meta_files': meta_files}
+    results = []
+    failed = set()
+    for stage in with_prerequisites(stages):
+        start, cpu = time.perf_counter(), time.process_time()
+        items = None
+        blocked = [requirement for requirement in REQUIRES[stage]
+                   if requirement in failed]
+        if blocked:
+            error = 'skipped: {} failed'.format(', '.join(blocked))
+        else:
+            error = None
+            try:
+                items = globals()['stage_' + stage](state)
+            except Exception as exc:
+                error = repr(exc)
+        if error is not None:
+            failed.add(stage)
+        seconds = time.perf_counter() - start
+        results.append({
+            'scale': nodes,
+            'stage': stage,
+            'selected': stage in stages,
+            'seconds': seconds,
+            'cpu_seconds': time.process_time() - cpu,
+            'items': items,
+            'items_per_second': items / seconds if items and seconds
+                                else None,
+            'peak_rss': dataio.peak_rss(),
+            'error': error,
+        })
+        print('{:>10} {:<14} {:9.3f} s{}'.format(
+            nodes, stage, seconds, '' if error is None else '  ' + error),
+            file=sys.stderr)
+    return results
+
+def environment():
+    import pandas
+    import scipy
+    return {
+        'python': platform.python_version(),
+        'numpy': numpy.__version__,
+        'pandas': pandas.__version__,
+        'scipy': scipy.__version__,
+        'machine': platform.machine(),
+        'processor': platform.processor(),
+        'system': platform.system(),
+    }
+
+def run(scales=SCALES, output=None, seed=0, stages=STAGES, directory=None):
+    """Run the benchmark on every scale and return the results document.
+
+    With `output`, the document is rewritten after every scale, so results
+    of the smaller scales survive a failure at a larger one.
+
+    """
+    document = {
+        'version': RESULTS_VERSION,
+        'started': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'seed': seed,
+        'environment': environment(),
+        'results': [],
+    }
+    for nodes in scales:
+        document['results'].extend(run_scale(nodes, seed, stages,
+                                              directory))
+        if output:
+            tmp = output + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(document, f, indent=2)
+            os.replace(tmp, output)
+    return document
+
+def compare(baseline, current):
+    """Return a `pandas.DataFrame` of seconds per scale and stage in two
+    results documents (or file names), with their ratio."""
+    import pandas
+    def frame(document):
+        if isinstance(document, str):
+            with open(document) as f:
+                document = json.load(f)
+        return pandas.DataFrame(document['results']) \
+                     .set_index(['scale', 'stage'])['seconds']
+    table = pandas.concat([frame(baseline).rename('baseline'),
+                           frame(current).rename('current')], axis=1)
+    table['ratio'] = table['current'] / table['baseline']
+    return table
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--scales', type=int, nargs='+', default=SCALES)
+    parser.add_argument('--stages', nargs='+', default=STAGES,
+                        choices=STAGES)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='benchmark-{}.json'.format(
+        time.strftime('%Y%m%d-%H%M%S')))
+    parser.add_argument('--compare', nargs=2, metavar=('BASELINE', 'CURRENT'))
+    args = parser.parse_args()
+    if args.compare:
+        print(compare(*args.compare).to_string())
+        return
+    run(args.scales, args.output, args.seed, args.stages)
+
+if __name__ == '__main__':
+    main()
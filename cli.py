@@ -0,0 +1,197 @@
+"""Command-line entry point for the patent network analyses.
+
+Usage: `python cli.py [--timing] <command> [options]`, with the commands
+`load`, `indegree`, `pagerank`, `nhood`, `classify` and `report`; see
+`python cli.py <command> --help`.
+
+Data is served from the snapshot cache (see `dataio.load_snapshot`), so
+after the first run a command only maps the cached arrays. Modules beyond
+the standard library are imported by the command that needs them, and
+`--timing` prints how long imports, loading and the query itself took.
+
+"""
+import os
+import sys
+import time
+import argparse
+
+_start = time.perf_counter()
+
+class Timer(object):
+    """Collect `(phase, seconds)` pairs, starting when `cli` is imported."""
+
+    def __init__(self, start=_start):
+        self.last = start
+        self.phases = []
+
+    def mark(self, phase):
+        now = time.perf_counter()
+        self.phases.append((phase, now - self.last))
+        self.last = now
+
+    def report(self, stream=sys.stderr):
+        total = sum(seconds for _, seconds in self.phases)
+        for phase, seconds in self.phases + [('total', total)]:
+            print('{:>10}: {:.3f} seconds'.format(phase, seconds), file=stream)
+
+def load(timer):
+    """Return the current snapshot, marking import and load times."""
+    import dataio
+    timer.mark('import')
+    snap = dataio.load_current_snapshot()
+    snap.graph # map the arrays
+    timer.mark('load')
+    return snap
+
+def fail(message):
+    """Exit with status 1 after printing a one-line error to stderr."""
+    sys.exit('cli.py: error: {}'.format(message))
+
+def parse_nodes(values, graph):
+    """Return `values` as node labels, failing on any not in `graph`."""
+    nodes = []
+    for value in values:
+        try:
+            node = int(value)
+        except ValueError:
+            fail('invalid node: {}'.format(value))
+        if node not in graph:
+            fail('unknown node: {}'.format(value))
+        nodes.append(node)
+    return nodes
+
+# # Commands
+
+def cmd_load(args, timer):
+    snap = load(timer)
+    graph = snap.graph
+    print('snapshot: {}'.format(snap.path))
+    print('revision: {}'.format(snap.revision))
+    print('nodes: {}'.format(graph.number_of_nodes()))
+    print('edges: {}'.format(graph.number_of_edges()))
+    print('metadata columns: {}'.format(', '.join(snap.metadata.columns)))
+
+def cmd_indegree(args, timer):
+    snap = load(timer)
+    import pandas
+    graph = snap.graph
+    indegrees = pandas.Series(graph.in_degree_array(), index=graph.labels,
+                              name='indegree')
+    if args.nodes:
+        table = indegrees.reindex(parse_nodes(args.nodes, graph))
+    else:
+        table = indegrees.sort_index().sort_values(
+            ascending=False, kind='mergesort').head(args.top)
+    timer.mark('query')
+    print(table.to_string())
+
+def cmd_pagerank(args, timer):
+    snap = load(timer)
+    nodes = parse_nodes(args.nodes, snap.graph)
+    import pandas
+    if os.environ.get('PATENT_MEMORY_BUDGET'):
+        import streaming
+        scores = streaming.pagerank(snap.graph, alpha=args.alpha)
+    else:
+        import pagerank
+        scores = pagerank.PageRank.from_graph(snap.graph, alpha=args.alpha) \
+                                  .scores()
+    ranks = scores.rank(ascending=False, method='min').astype(int)
+    table = pandas.DataFrame({'pagerank': scores, 'rank': ranks})
+    if nodes:
+        table = table.reindex(nodes)
+    else:
+        table = table.sort_values('rank', kind='mergesort').head(args.top)
+    timer.mark('query')
+    print(table.to_string())
+
+def cmd_nhood(args, timer):
+    snap = load(timer)
+    import nhood
+    for root in parse_nodes(args.nodes, snap.graph):
+        members = sorted(nhood.neighborhood(snap.graph, root, args.depth,
+                                            args.closed))
+        shown = members if args.limit is None else members[:args.limit]
+        print('{}\t{}\t{}'.format(root, len(members),
+                                  ' '.join(str(node) for node in shown)))
+    timer.mark('query')
+
+def cmd_classify(args, timer):
+    snap = load(timer)
+    from analysis import AnnotatedNetwork
+    if args.field not in snap.metadata.columns:
+        fail('unknown field: {}'.format(args.field))
+    network = AnnotatedNetwork(snap.graph, snap.metadata)
+    result = network.classify_many(parse_nodes(args.nodes, snap.graph),
+                                   args.field, args.max_cited)
+    timer.mark('query')
+    print(result.to_string())
+
+def cmd_report(args, timer):
+    snap = load(timer)
+    import evaluation
+    from analysis import AnnotatedNetwork
+    network = AnnotatedNetwork(snap.graph, snap.metadata)
+    result = evaluation.evaluate(network, fields=args.fields or None,
+                                 max_cited=args.max_cited,
+                                 samples=args.samples, seed=args.seed,
+                                 processes=args.processes,
+                                 snapshot_path=snap.path)
+    timer.mark('query')
+    print(result.to_string())
+
+def parser():
+    main = argparse.ArgumentParser(prog='cli.py', description=__doc__
+                                   .split('\n')[0])
+    main.add_argument('--timing', action='store_true',
+                      help='print import, load and query times to stderr')
+    commands = main.add_subparsers(dest='command')
+    commands.required = True
+
+    command = commands.add_parser('load', help='build or open the snapshot')
+    command.set_defaults(run=cmd_load)
+
+    command = commands.add_parser('indegree', help='indegree of nodes')
+    command.add_argument('nodes', nargs='*', help='nodes (default: top)')
+    command.add_argument('--top', type=int, default=10)
+    command.set_defaults(run=cmd_indegree)
+
+    command = commands.add_parser('pagerank', help='PageRank and rank')
+    command.add_argument('nodes', nargs='*', help='nodes (default: top)')
+    command.add_argument('--top', type=int, default=10)
+    command.add_argument('--alpha', type=float, default=0.85)
+    command.set_defaults(run=cmd_pagerank)
+
+    command = commands.add_parser('nhood', help='neighborhoods of nodes')
+    command.add_argument('nodes', nargs='+')
+    command.add_argument('--depth', type=int, default=1)
+    command.add_argument('--closed', action='store_true',
+                         help='include the root itself')
+    command.add_argument('--limit', type=int, default=None,
+                         help='members printed per node')
+    command.set_defaults(run=cmd_nhood)
+
+    command = commands.add_parser('classify', help='classify nodes')
+    command.add_argument('nodes', nargs='+')
+    command.add_argument('--field', default='appMyName')
+    command.add_argument('--max-cited', type=int, default=20)
+    command.set_defaults(run=cmd_classify)
+
+    command = commands.add_parser('report', help='classification accuracy')
+    command.add_argument('--fields', nargs='*')
+    command.add_argument('--max-cited', type=int, nargs='+', default=[20])
+    command.add_argument('--samples', type=int, default=100)
+    command.add_argument('--seed', type=int, default=0)
+    command.add_argument('--processes', type=int, default=None)
+    command.set_defaults(run=cmd_report)
+    return main
+
+def main(argv=None):
+    timer = Timer()
+    args = parser().parse_args(argv)
+    args.run(args, timer)
+    if args.timing:
+        timer.report()
+
+if __name__ == '__main__':
+    main()
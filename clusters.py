@@ -0,0 +1,157 @@
+"""IPC-partitioned cluster pipeline.
+
+The graph is partitioned by IPC code prefix, and each partition's induced
+subgraph is analyzed with quadratic techniques that are too expensive for
+the whole graph: co-citation and bibliographic coupling between all pairs
+of members, and shortest-path closeness. Partitions are scheduled on a
+process pool largest-first, so the biggest class starts early instead of
+straggling at the end, and results are yielded as each partition finishes.
+
+"""
+import concurrent.futures
+
+import numpy
+import pandas
+import scipy.sparse
+import scipy.sparse.csgraph
+
+from csrgraph import as_csr
+
+# IPC parts concatenated at each level, e.g. 'H', 'H01', 'H01L', 'H01L33',
+# 'H01L33/00'.
+IPC_LEVELS = {
+    'section': ('ipcaA',),
+    'class': ('ipcaA', 'ipcaB'),
+    'subclass': ('ipcaA', 'ipcaB', 'ipcaC'),
+    'group': ('ipcaA', 'ipcaB', 'ipcaC', 'ipcaD'),
+    'subgroup': ('ipcaA', 'ipcaB', 'ipcaC', 'ipcaD', 'ipcaE'),
+}
+TOP_PAIRS = 20 # strongest pairs reported per cluster and measure
+
+def ipc_codes(metadata, level='subclass'):
+    """Return a `pandas.Series` of IPC codes at `level`, indexed by node.
+
+    Each node keeps its first complete IPC row, so the codes partition the
+    nodes.
+
+    """
+    parts = IPC_LEVELS[level]
+    frame = pandas.DataFrame({part: metadata[part] for part in parts})
+    frame = frame.dropna()
+    frame = frame[~frame.index.duplicated(keep='first')]
+    codes = frame[parts[0]].astype(str)
+    for part in parts[1:-1]:
+        codes = codes + frame[part].astype(str)
+    if len(parts) > 1:
+        separator = '/' if level == 'subgroup' else ''
+        codes = codes + separator + frame[parts[-1]].astype(str)
+    return codes
+
+def partition(graph, codes, min_size=2):
+    """Split a graph into the induced subgraphs of each code.
+
+    Return a list of `(code, labels, src, dst)` tuples, largest first:
+    the member labels and the edges between members as indices into
+    `labels`. All partitions are extracted in one pass over the edges.
+    Codes with fewer than `min_size` members are skipped.
+
+    """
+    csr = as_csr(graph)
+    codes = codes[codes.index.isin(csr.labels)]
+    names, assignment = numpy.unique(codes.values.astype(str),
+                                     return_inverse=True)
+    part = numpy.full(len(csr.labels), -1, dtype=numpy.int64)
+    part[csr.ids(codes.index.values)] = assignment
+    src, dst = csr.edge_ids()
+    inside = (part[src] >= 0) & (part[src] == part[dst])
+    src, dst = src[inside], dst[inside]
+    edge_order = numpy.argsort(part[src], kind='mergesort')
+    src, dst = src[edge_order], dst[edge_order]
+    edge_bounds = numpy.searchsorted(part[src], numpy.arange(len(names) + 1))
+    node_order = numpy.argsort(part, kind='mergesort')
+    node_bounds = numpy.searchsorted(part[node_order],
+                                     numpy.arange(len(names) + 1))
+    partitions = []
+    for p, name in enumerate(names):
+        members = node_order[node_bounds[p]:node_bounds[p+1]]
+        if len(members) < min_size:
+            continue
+        lo, hi = edge_bounds[p], edge_bounds[p+1]
+        partitions.append((name, csr.labels[members],
+                           numpy.searchsorted(members, src[lo:hi]),
+                           numpy.searchsorted(members, dst[lo:hi])))
+    partitions.sort(key=lambda item: len(item[1]), reverse=True)
+    return partitions
+
+def analyze_cluster(code, labels, src, dst, top=TOP_PAIRS):
+    """Run the quadratic analyses on one cluster.
+
+    Return a dict with `code`, `nodes` (a per-member `pandas.DataFrame` of
+    closeness and total co-citation and coupling strength) and `cocitation`
+    and `coupling` (the `top` strongest pairs of each).
+
+    """
+    n = len(labels)
+    adjacency = scipy.sparse.csr_matrix(
+        (numpy.ones(len(src), dtype=numpy.int32), (src, dst)), shape=(n, n))
+    # Co-citation: how many members cite both i and j. Bibliographic
+    # coupling: how many members both i and j cite.
+    cocitation = _strip_diagonal(adjacency.T @ adjacency)
+    coupling = _strip_diagonal(adjacency @ adjacency.T)
+    distances = scipy.sparse.csgraph.shortest_path(adjacency, directed=False,
+                                                   unweighted=True)
+    reachable = numpy.isfinite(distances)
+    reached = reachable.sum(axis=1) - 1
+    total = numpy.where(reachable, distances, 0).sum(axis=1)
+    # Wasserman-Faust closeness, scaled for partially connected clusters.
+    closeness = numpy.where(total > 0,
+                            reached / numpy.maximum(total, 1)
+                            * reached / max(n - 1, 1), 0.0)
+    nodes = pandas.DataFrame({
+        'closeness': closeness,
+        'cocitation': numpy.asarray(cocitation.sum(axis=1)).ravel(),
+        'coupling': numpy.asarray(coupling.sum(axis=1)).ravel(),
+    }, index=pandas.Index(labels, name='applnID'))
+    return {
+        'code': code,
+        'size': n,
+        'edges': len(src),
+        'nodes': nodes,
+        'cocitation': _top_pairs(cocitation, labels, top),
+        'coupling': _top_pairs(coupling, labels, top),
+    }
+
+def _strip_diagonal(matrix):
+    matrix = scipy.sparse.triu(matrix, k=1).tocsr()
+    matrix = matrix + matrix.T
+    matrix.eliminate_zeros()
+    return matrix
+
+def _top_pairs(matrix, labels, top):
+    """Return the `top` strongest pairs `i < j` of a symmetric matrix."""
+    upper = scipy.sparse.triu(matrix, k=1).tocoo()
+    order = numpy.argsort(-upper.data, kind='mergesort')[:top]
+    return pandas.DataFrame({
+        'a': labels[upper.row[order]],
+        'b': labels[upper.col[order]],
+        'weight': upper.data[order],
+    }, columns=['a', 'b', 'weight'])
+
+def run(graph, metadata, level='subclass', processes=None, min_size=2,
+        analyze=analyze_cluster):
+    """Analyze every IPC cluster, yielding results as they finish.
+
+    Clusters are submitted largest-first to a process pool of `processes`
+    workers (`1` runs them in this process, in order). Each yielded value
+    is the dict returned by `analyze` for one cluster.
+
+    """
+    partitions = partition(graph, ipc_codes(metadata, level), min_size)
+    if processes == 1:
+        for item in partitions:
+            yield analyze(*item)
+        return
+    with concurrent.futures.ProcessPoolExecutor(processes) as pool:
+        futures = [pool.submit(analyze, *item) for item in partitions]
+        for future in concurrent.futures.as_completed(futures):
+            yield future.result()
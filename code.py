@@ -1,30 +1,36 @@
-"""Patent citation network case study."""
+"""Patent citation network case study.
 
-import scipy.stats
+Plotting, statistics, networkx and the analysis modules built on scipy are
+imported inside the functions that use them, so importing this module stays
+fast.
+
+"""
+
+import numpy
 import pandas
-import networkx
-import matplotlib.pyplot as plt
 import collections
 
+import dataio
+import instrument
+
 def neighborhood(graph, nbunch, depth=1, closed=False):
     """Return the neighborhood of a node or nodes."""
     if nbunch in graph:
-        return next(neighborhood_iter(graph, nbunch, depth))[1]
+        return next(neighborhood_iter(graph, nbunch, depth, closed))[1]
     else:
-        return dict(neighborhood_iter(graph, nbunch, depth))
+        return dict(neighborhood_iter(graph, nbunch, depth, closed))
 
 def neighborhood_iter(graph, nbunch=None, depth=1, closed=False):
     """Return the neighborhood of a node or nodes as an iterator."""
+    import nhood
     if nbunch is None:
         nbunch = graph.nodes()
     for root in graph.nbunch_iter(nbunch):
-        nhood = set([root])
-        for _ in range(depth):
-            for node in nhood.copy():
-                nhood |= set(graph.predecessors(node))
-        if not closed:
-            nhood.remove(root)
-        yield root, nhood
+        # One span per root, closed before yielding so that the consumer's
+        # work between items is not attributed to it.
+        with instrument.span('code.neighborhood_iter', items=1, depth=depth):
+            result = nhood.neighborhood(graph, root, depth, closed)
+        yield root, result
 
 def histogram(dct):
     """Return a Series of the lengths of dct's values, indexed by key."""
@@ -32,11 +38,9 @@ def histogram(dct):
 
 def read_graph(filename):
     """Read edgelist from tsv file, return a networkx.DiGraph."""
-    frame = read_tsv(filename)
-    clean_frame = frame.dropna() # ignore missing data
-    edgelist = clean_frame.values.tolist()
-    return networkx.DiGraph(edgelist)
+    return dataio.read_graph(filename)
 
+@instrument.traced('code.read_metadata', items=len)
 def read_metadata(filenames, index_col='applnID'):
     """Read metadata from several files and return one pandas.DataFrame."""
     frames = [read_tsv(filename, index_col=index_col)
@@ -46,15 +50,11 @@ def read_metadata(filenames, index_col='applnID'):
         joinframe = joinframe.join(frame, how='outer', rsuffix='_dup')
     return joinframe
 
-def annotate_graph(graph, metadata):
+def annotate_graph(graph, metadata, mode='attributes'):
     """Annotate graph with metadata fields."""
-    for column, series in metadata.iteritems():
-        clean_series = series.dropna() # ignore missing data
-        for index, value in clean_series.iteritems():
-            if index not in graph:
-                continue # ignore nodes not in graph
-            graph.node[index][column] = value
+    dataio.annotate_graph(graph, metadata, mode)
 
+@instrument.traced('code.read_tsv', items=len)
 def read_tsv(filename, index_col=None):
     """Return a pandas.DataFrame of a tsv file."""
     return pandas.read_csv(filename,
@@ -66,16 +66,14 @@ def read_tsv(filename, index_col=None):
 
 def unique_sets(dct):
     """Given a dict of iterables, return unique elements in each."""
-    result = {}
-    for key, category in dct.items():
-        remaining = dct.copy()
-        del remaining[key]
-        all_others = set()
-        for others in remaining.values():
-            all_others |= set(others)
-        result[key] = set(category) - all_others
-    return result
+    counts = collections.Counter(
+        element for category in dct.values() for element in set(category))
+    return {
+        key: set(element for element in category if counts[element] == 1)
+        for key, category in dct.items()
+    }
 
+@instrument.traced('code.analyze_indegree')
 def analyze_indegree(graph, show_table=False, show_plot=False):
     """Run analysis on indegree."""
     indegrees = pandas.Series(graph.in_degree(), name='indegree')
@@ -89,19 +87,23 @@ def analyze_indegree(graph, show_table=False, show_plot=False):
         print('There are {} nodes with indegree >99.'
                 .format(len(indegrees[indegrees > 99].values)))
     if show_plot:
+        import matplotlib.pyplot as plt
         hist = indegrees[indegrees < 50].hist()
         hist.set_title('Histogram of indegrees (<50)')
         hist.set_ylabel('Number of patents')
         hist.set_xlabel('Indegree')
         plt.show()
 
+@instrument.traced('code.analyze_pagerank')
 def analyze_pagerank(graph, show_table=False, show_plot=False):
     """Run analysis on pagerank."""
     if not (show_table or show_plot):
         return # expensive computation, skip if unneccessary
+    import scipy.stats
+    import pagerank as pagerank_engine
     indegrees = pandas.Series(graph.in_degree(), name='indegree')
-    pagerank = pandas.Series(networkx.pagerank_scipy(graph, max_iter=200),
-            name='pagescore')
+    pagerank = (pagerank_engine.PageRank.from_graph(graph, max_iter=200)
+                               .scores().rename('pagescore'))
     table = (pandas.DataFrame({'indegree': graph.in_degree()})
                    .sort(columns='indegree', ascending=False))
     table['indegree_rank'] = pandas.Series(range(1, len(table)+1),
@@ -116,83 +118,76 @@ def analyze_pagerank(graph, show_table=False, show_plot=False):
         print('pagescore and indegree have r == {}'.format(r_val))
         print(table.head(10))
 
-def big_companies(graph, metadata, show_table=False):
+@instrument.traced('code.big_companies')
+def big_companies(graph, metadata, show_table=False, as_of=None,
+                  rollup=False):
     """Compute the big companies."""
-    ingraph = pandas.Series({
-        applnID: str(int(applnID)) in graph
-        for applnID in metadata.index
-    }, name='ingraph')
-    metadata = metadata.join(ingraph)
-    companies = (metadata[metadata['ingraph'] == True]['appMyName']
-                    .dropna())
-    patents = pandas.DataFrame({
-        'patents': collections.Counter(companies.values)
-    })
+    import companies
+    import pagerank as pagerank_engine
+    pagerank = (pagerank_engine.PageRank.from_graph(graph, max_iter=200)
+                               .scores())
+    table = companies.company_table(graph, metadata, pagerank, as_of, rollup)
     if show_table:
+        nodes = graph.number_of_nodes()
         print('{}/{} ({}) nodes with company metadata'
-                .format(len(companies),
-                    graph.number_of_nodes(),
-                    len(companies) / graph.number_of_nodes()))
-        print(patents.sort(columns='patents', ascending=False)
-                .head(10))
-
-def visualize_cluster(graph, index=1, show_plot=False):
-    """Display visualizations for clusters."""
-    indegrees = pandas.Series(graph.in_degree(), name='indegree')
-    high_indegrees = indegrees.order().tail(10).index # top 10
-    nhoods = neighborhood(graph, high_indegrees)
-    root = high_indegrees[-index]
-    cluster = networkx.subgraph(graph, nhoods[root])
+                .format(table['patents'].sum(), nodes,
+                    table['patents'].sum() / nodes))
+        for column in ('patents', 'outdegree_sum', 'pagerank_sum'):
+            print(companies.top(table, column)[
+                [column + '_rank', 'patents', 'outdegree_sum',
+                 'pagerank_sum']])
+    return table
+
+def visualize_cluster(graph, index=1, show_plot=False, clusters=None,
+                      cache=None):
+    """Display visualizations for clusters.
+
+    Pass a `layout.ClusterSet` as `clusters` to reuse its indegree and
+    neighborhood pass across indexes, and a `layout.LayoutCache` as `cache`
+    to reuse layouts.
+
+    """
+    import layout
+    if clusters is None:
+        clusters = layout.ClusterSet(graph)
+    labels, src, dst = clusters.cluster(index)
     if show_plot:
-        nodelist = cluster.nodes()
-        cluster_indg = [cluster.in_degree(node) for node in nodelist]
-        pos = networkx.spring_layout(cluster, k=.2, iterations=500)
-        fig = networkx.draw_networkx_edges(cluster, pos,
-                width=.7,
-                alpha=.7)
-        fig = networkx.draw_networkx_nodes(cluster, pos,
-                node_size=50,
-                node_color=cluster_indg,
-                vmin=min(cluster_indg),
-                vmax=max(cluster_indg),
-                nodelist=nodelist)
+        import matplotlib.pyplot as plt
+        cache = cache if cache is not None else layout.LayoutCache()
+        pos = cache.get(labels, src, dst)
+        cluster_indg = numpy.bincount(dst, minlength=len(labels))
+        fig, ax = plt.subplots()
+        layout.draw(ax, pos, src, dst, cluster_indg)
         plt.show()
+    return clusters
 
+@instrument.traced('code.analyze_nhood_overlap')
 def analyze_nhood_overlap(graph, show_table=False, show_plot=False):
     """Run analysis about neighborhood overlaps."""
+    import nhood
+    import overlap
     indegrees = pandas.Series(graph.in_degree(), name='indegree')
     high_indegrees = indegrees.order().tail(10).index # top 10
-    nhoods = neighborhood(graph, high_indegrees)
-    bignodes = pandas.Series({
-        node: len(set(high_indegrees) & set(nhood))
-        for node, nhood in nhoods.items()
-    }, name='bignodes')
-    unique_nhoods = unique_sets(nhoods)
-    unique_factors = pandas.Series({
-        node: len(unique_nhoods[node]) / len(nhoods[node])
-        for node in nhoods
-    }, name='percentunique')
+    nhoods = nhood.neighborhood_sets(graph, high_indegrees)
+    stats = overlap.overlap_table(nhoods)
     if show_table:
         table = pandas.DataFrame(indegrees)
-        print(table.join(unique_factors, how='right')
-                   .join(bignodes)
+        print(table.join(stats[['percentunique', 'bignodes']], how='right')
                    .sort(columns='indegree', ascending=False))
 
+@instrument.traced('code.analyze_nhood_size')
 def analyze_nhood_size(graph, show_table=False, show_plot=False):
     """Run analysis about neighborhood sizes."""
+    import nhood
     indegrees = pandas.Series(graph.in_degree(), name='indegree')
     high_indegrees = indegrees.order().tail(20).index # top 20
-    nhoods = {
-        depth: neighborhood(graph, high_indegrees, depth)
-        for depth in range(1, 4)
-    }
-    nhood_hists = pandas.DataFrame({
-        '{}-nhood'.format(depth): histogram(nhood)
-        for depth, nhood in nhoods.items()
-    }).join(indegrees).sort(columns='indegree', ascending=False)
+    nhood_hists = (nhood.neighborhood_sizes(graph, high_indegrees, depth=3)
+                        .join(indegrees)
+                        .sort(columns='indegree', ascending=False))
     if show_table:
         print(nhood_hists)
     if show_plot:
+        import matplotlib.pyplot as plt
         del nhood_hists['indegree']
         nhood_hists.index = range(20)
         nhood_fig = nhood_hists.plot()
@@ -202,14 +197,14 @@ def analyze_nhood_size(graph, show_table=False, show_plot=False):
         plt.show()
 
 def test():
-    """Run some basic tests."""
-    graphfile = ('/Users/ben/Downloads/PatentNetworks/'
-                 'citation pairs by applnID simple try '
-                 'sorted by citing.txt')
-    metafiles = ('/Users/ben/Downloads/PatentNetworks/'
-                 'LEDs patents keyinfo.txt',
-                 '/Users/ben/Downloads/PatentNetworks/'
-                 'LEDs patents applicants longform.txt')
+    """Run some basic tests.
+
+    Data is read from `PATENT_DATA_DIR`; see `synthetic.generate` for data
+    to run on without the LED dataset.
+
+    """
+    graphfile, metafiles = dataio.source_files()
+    metafiles = metafiles[:2] # keyinfo and applicants
     print('Loading data...', end='', flush=True)
     graph = read_graph(graphfile)
     metadata = read_metadata(metafiles)
@@ -220,8 +215,8 @@ def test():
 
     # Analyses
     big_companies(graph, metadata, show_table=True)
-    visualize_cluster(graph, index=1, show_plot=False)
-    visualize_cluster(graph, index=5, show_plot=False)
+    clusters = visualize_cluster(graph, index=1, show_plot=False)
+    visualize_cluster(graph, index=5, show_plot=False, clusters=clusters)
     analyze_pagerank(graph, show_table=False, show_plot=False)
     analyze_indegree(graph, show_table=False, show_plot=False)
     analyze_nhood_overlap(graph, show_table=False)
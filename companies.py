@@ -0,0 +1,125 @@
+"""Company-level aggregation of per-patent metrics.
+
+Every node is mapped to an integer company code once; per-company counts,
+sums, means and rankings are then `numpy.bincount` reductions over
+node-aligned metric arrays, with no per-row graph lookups. Companies can be
+rolled up into their acquirers as of a date, following chains of
+acquisitions.
+
+"""
+import numpy
+import pandas
+
+from csrgraph import as_csr
+
+COMPANY_FIELD = 'appMyName'
+ACQUIRER_FIELD = 'acquirerMyName'
+ACQUISITION_DATE_FIELD = 'acqCompleteDate'
+
+def acquisitions(metadata, as_of=None):
+    """Return a `pandas.Series` mapping acquired company to acquirer.
+
+    Only acquisitions completed by `as_of` count (all of them with
+    `as_of=None`, including undated ones). A company acquired several times
+    keeps its latest acquirer by then.
+
+    """
+    if ACQUIRER_FIELD not in metadata:
+        return pandas.Series([], dtype=object)
+    frame = pandas.DataFrame({
+        'company': metadata[COMPANY_FIELD].astype(object),
+        'acquirer': metadata[ACQUIRER_FIELD].astype(object),
+        'date': (pandas.to_datetime(metadata[ACQUISITION_DATE_FIELD])
+                 if ACQUISITION_DATE_FIELD in metadata
+                 else pandas.NaT),
+    }).dropna(subset=['company', 'acquirer'])
+    frame = frame[frame['company'] != frame['acquirer']]
+    if as_of is not None:
+        frame = frame[frame['date'] <= pandas.Timestamp(as_of)]
+    frame = frame.sort_values('date', kind='mergesort', na_position='first')
+    return frame.drop_duplicates('company', keep='last') \
+                .set_index('company')['acquirer']
+
+def resolve(companies, acquired):
+    """Replace each company by its ultimate acquirer.
+
+    -   **`companies`** is a `pandas.Series` of company names.
+
+    -   **`acquired`** maps acquired company to acquirer, as returned by
+        `acquisitions`. Chains are followed to their end; cycles in the
+        acquisition data are cut after as many steps as there are
+        acquisitions.
+
+    """
+    names = pandas.Index(pandas.unique(companies.dropna()))
+    names = names.union(pandas.Index(acquired.index)).union(
+        pandas.Index(acquired.values))
+    owner = pandas.Series(names, index=names)
+    owner.update(acquired)
+    for _ in range(len(acquired)):
+        step = owner.map(owner)
+        if step.equals(owner):
+            break
+        owner = step
+    return companies.map(owner)
+
+def company_codes(graph, metadata, as_of=None, rollup=False):
+    """Return `(codes, names)` assigning each node of `graph` a company.
+
+    `codes` is an int64 array aligned with the graph's node ids, with -1 for
+    nodes without company metadata, and `names` holds the company name of
+    each code. With `rollup`, companies are replaced by their acquirers as
+    of `as_of`. Nodes with several applicants keep the first.
+
+    """
+    csr = as_csr(graph)
+    companies = metadata[COMPANY_FIELD].dropna()
+    companies = companies[~companies.index.duplicated(keep='first')] \
+                         .astype(object)
+    if rollup:
+        companies = resolve(companies, acquisitions(metadata, as_of))
+    codes, names = pandas.factorize(companies.reindex(csr.labels))
+    return codes.astype(numpy.int64), pandas.Index(names, name='company')
+
+def node_metrics(graph, pagerank=None):
+    """Return node-aligned metric arrays: `indegree`, `outdegree` and,
+    given a `pandas.Series` of scores, `pagerank`."""
+    csr = as_csr(graph)
+    metrics = {
+        'indegree': csr.in_degree_array(),
+        'outdegree': csr.out_degree_array(),
+    }
+    if pagerank is not None:
+        metrics['pagerank'] = pagerank.reindex(csr.labels).fillna(0).values
+    return metrics
+
+def aggregate(codes, names, metrics):
+    """Return a `pandas.DataFrame` of per-company totals.
+
+    Columns are `patents`, then `<metric>_sum` and `<metric>_mean` for each
+    node-aligned array in `metrics`. Nodes with code -1 are left out.
+
+    """
+    has_company = codes >= 0
+    codes = codes[has_company]
+    patents = numpy.bincount(codes, minlength=len(names))
+    table = pandas.DataFrame({'patents': patents}, index=names)
+    for name, values in sorted(metrics.items()):
+        total = numpy.bincount(codes,
+                               weights=numpy.asarray(values)[has_company],
+                               minlength=len(names))
+        table[name + '_sum'] = total
+        table[name + '_mean'] = total / numpy.maximum(patents, 1)
+    return table
+
+def company_table(graph, metadata, pagerank=None, as_of=None, rollup=False):
+    """Aggregate `node_metrics` by company; see `aggregate`."""
+    codes, names = company_codes(graph, metadata, as_of, rollup)
+    return aggregate(codes, names, node_metrics(graph, pagerank))
+
+def top(table, column='patents', k=10):
+    """Return the `k` companies ranked highest by `column`, with a rank."""
+    ranked = table.sort_index().sort_values(column, ascending=False,
+                                            kind='mergesort').head(k)
+    ranked.insert(0, column + '_rank', numpy.arange(1, len(ranked) + 1))
+    return ranked
@@ -0,0 +1,341 @@
+"""Compact array-backed directed graph for large citation networks."""
+from __future__ import print_function
+import time
+import tracemalloc
+
+import numpy
+import pandas
+
+class CSRGraph(object):
+    """Directed graph stored as forward and reverse CSR arrays.
+
+    Node labels (applnIDs) are kept in a sorted array; a node's position in
+    that array is its dense id. Edges are stored twice, once grouped by
+    source (successors) and once grouped by destination (predecessors), so
+    both directions can be read as contiguous slices.
+
+    The query methods mirror the subset of the `networkx.DiGraph` API used by
+    the analyses: `predecessors`, `successors`, `in_degree`, `out_degree`,
+    `subgraph` and `nbunch_iter`. Like networkx 1.x, neighbor and degree
+    queries return lists and dicts keyed by label.
+
+    Constructor arguments:
+
+    -   **`labels`** is a sorted int64 array of node labels.
+
+    -   **`indptr`** and **`indices`** are the forward CSR arrays: the dense
+        ids of the successors of node `i` are `indices[indptr[i]:indptr[i+1]]`.
+
+    -   **`rindptr`** and **`rindices`** are the reverse CSR arrays, holding
+        predecessors in the same layout.
+
+    """
+
+    def __init__(self, labels, indptr, indices, rindptr, rindices):
+        self.labels = labels
+        self.indptr = indptr
+        self.indices = indices
+        self.rindptr = rindptr
+        self.rindices = rindices
+        self.node_attrs = {}
+
+    @classmethod
+    def from_edges(cls, src, dst, labels=None):
+        """Build a graph from arrays of source and destination labels.
+
+        Duplicate edges are collapsed. If `labels` is given, the graph
+        also contains those nodes, even when they have no edges.
+
+        """
+        src = numpy.asarray(src, dtype=numpy.int64)
+        dst = numpy.asarray(dst, dtype=numpy.int64)
+        nodes = numpy.union1d(src, dst)
+        if labels is not None:
+            nodes = numpy.union1d(nodes, numpy.asarray(labels,
+                                                        dtype=numpy.int64))
+        n = len(nodes)
+        rows = numpy.searchsorted(nodes, src)
+        cols = numpy.searchsorted(nodes, dst)
+        # Collapse duplicate edges and sort by (row, col) in one step.
+        keys = numpy.unique(rows * n + cols)
+        rows = (keys // max(n, 1)).astype(numpy.int32)
+        cols = (keys % max(n, 1)).astype(numpy.int32)
+        indptr, indices = _compress(rows, cols, n)
+        order = numpy.lexsort((rows, cols))
+        rindptr, rindices = _compress(cols[order], rows[order], n)
+        return cls(nodes, indptr, indices, rindptr, rindices)
+
+    @classmethod
+    def from_networkx(cls, graph):
+        """Build a graph from a `networkx.DiGraph`."""
+        src, dst = edge_arrays(graph)
+        return cls.from_edges(src, dst,
+                              labels=numpy.fromiter(graph.nodes(),
+                                                    dtype=numpy.int64))
+
+    def to_networkx(self):
+        """Return a copy of this graph as a `networkx.DiGraph`."""
+        import networkx
+        graph = networkx.DiGraph()
+        graph.add_nodes_from(self.labels.tolist())
+        src, dst = self.edge_arrays()
+        graph.add_edges_from(zip(src.tolist(), dst.tolist()))
+        return graph
+
+    # # Node lookup
+
+    def ids(self, nodes):
+        """Return the dense ids of an iterable of labels.
+
+        Raises `KeyError` if any label is not a node of the graph.
+
+        """
+        nodes = numpy.asarray(nodes, dtype=numpy.int64).reshape(-1)
+        ids = numpy.searchsorted(self.labels, nodes)
+        ids[ids == len(self.labels)] = 0
+        missing = self.labels[ids] != nodes if len(self.labels) else (
+            numpy.ones(len(nodes), dtype=bool))
+        if missing.any():
+            raise KeyError(nodes[missing][0])
+        return ids
+
+    def id(self, node):
+        """Return the dense id of a single label, or -1 if it is absent."""
+        try:
+            i = int(self.labels.searchsorted(node))
+        except (TypeError, ValueError, OverflowError):
+            return -1
+        if i < len(self.labels) and self.labels[i] == node:
+            return i
+        return -1
+
+    def __contains__(self, node):
+        if numpy.ndim(node) != 0:
+            return False
+        return self.id(node) >= 0
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __iter__(self):
+        return iter(self.labels.tolist())
+
+    def nodes(self):
+        return self.labels.tolist()
+
+    def number_of_nodes(self):
+        return len(self.labels)
+
+    def number_of_edges(self):
+        return len(self.indices)
+
+    def nbunch_iter(self, nbunch=None):
+        """Iterate over the nodes of `nbunch` that are in the graph.
+
+        As in networkx, `nbunch` may be `None` (all nodes), a single node or
+        an iterable of nodes.
+
+        """
+        if nbunch is None:
+            return iter(self)
+        if nbunch in self:
+            return iter([nbunch])
+        return (node for node in nbunch if node in self)
+
+    # # Adjacency
+
+    def _checked_id(self, node):
+        i = self.id(node) if numpy.ndim(node) == 0 else -1
+        if i < 0:
+            raise KeyError(node)
+        return i
+
+    def successors(self, node):
+        i = self._checked_id(node)
+        return self.labels[self.indices[self.indptr[i]:self.indptr[i+1]]] \
+                   .tolist()
+
+    def predecessors(self, node):
+        i = self._checked_id(node)
+        return self.labels[self.rindices[self.rindptr[i]:self.rindptr[i+1]]] \
+                   .tolist()
+
+    def in_degree_array(self):
+        """Return in-degrees as an array aligned with `labels`."""
+        return numpy.diff(self.rindptr)
+
+    def out_degree_array(self):
+        """Return out-degrees as an array aligned with `labels`."""
+        return numpy.diff(self.indptr)
+
+    def in_degree(self, nbunch=None):
+        return self._degree(self.rindptr, nbunch)
+
+    def out_degree(self, nbunch=None):
+        return self._degree(self.indptr, nbunch)
+
+    def _degree(self, indptr, nbunch):
+        i = self.id(nbunch) if numpy.ndim(nbunch) == 0 else -1
+        if i >= 0:
+            return int(indptr[i+1] - indptr[i])
+        if nbunch is None:
+            ids = numpy.arange(len(self.labels))
+        else:
+            ids = self.ids(list(self.nbunch_iter(nbunch)))
+        degrees = numpy.diff(indptr)
+        return dict(zip(self.labels[ids].tolist(), degrees[ids].tolist()))
+
+    def edge_ids(self):
+        """Return `(src, dst)` arrays of dense ids, grouped by source."""
+        src = numpy.repeat(numpy.arange(len(self.labels), dtype=numpy.int32),
+                           numpy.diff(self.indptr))
+        return src, self.indices
+
+    def edge_arrays(self):
+        """Return `(src, dst)` arrays of labels, grouped by source."""
+        src, dst = self.edge_ids()
+        return self.labels[src], self.labels[dst]
+
+    def edges(self):
+        src, dst = self.edge_arrays()
+        return list(zip(src.tolist(), dst.tolist()))
+
+    def add_edges(self, src, dst):
+        """Return a new graph with edges added, plus the edges that are new.
+
+        `src` and `dst` are label arrays; nodes are added as needed. Edges
+        are merged into the existing sorted CSR arrays by insertion, so the
+        cost is a linear copy of the arrays plus sorting the new edges only.
+        The second return value is a `(src, dst)` pair of label arrays
+        holding the edges that were not already present. `node_attrs` are
+        not carried over.
+
+        """
+        src = numpy.asarray(src, dtype=numpy.int64)
+        dst = numpy.asarray(dst, dtype=numpy.int64)
+        labels = numpy.union1d(self.labels, numpy.union1d(src, dst))
+        n = len(labels)
+        remap = numpy.searchsorted(labels, self.labels)
+        rows, cols = self.edge_ids()
+        keys = remap[rows].astype(numpy.int64) * n + remap[cols]
+        added = numpy.unique(numpy.searchsorted(labels, src) * n
+                             + numpy.searchsorted(labels, dst))
+        positions = numpy.searchsorted(keys, added)
+        exists = numpy.zeros(len(added), dtype=bool)
+        inside = positions < len(keys)
+        exists[inside] = keys[positions[inside]] == added[inside]
+        added, positions = added[~exists], positions[~exists]
+        keys = numpy.insert(keys, positions, added)
+        indptr, indices = _compress(keys // n, keys % n, n)
+
+        rrows = numpy.repeat(numpy.arange(len(self.labels)),
+                             numpy.diff(self.rindptr))
+        rkeys = remap[rrows].astype(numpy.int64) * n + remap[self.rindices]
+        radded = numpy.sort((added % n) * n + added // n)
+        rkeys = numpy.insert(rkeys, numpy.searchsorted(rkeys, radded), radded)
+        rindptr, rindices = _compress(rkeys // n, rkeys % n, n)
+        graph = CSRGraph(labels, indptr, indices, rindptr, rindices)
+        return graph, (labels[added // n], labels[added % n])
+
+    def subgraph(self, nbunch):
+        """Return the subgraph induced on the nodes in `nbunch`."""
+        keep = numpy.zeros(len(self.labels), dtype=bool)
+        keep[self.ids(list(self.nbunch_iter(nbunch)))] = True
+        src, dst = self.edge_ids()
+        mask = keep[src] & keep[dst]
+        sub = CSRGraph.from_edges(self.labels[src[mask]],
+                                  self.labels[dst[mask]],
+                                  labels=self.labels[keep])
+        for name, values in self.node_attrs.items():
+            sub.node_attrs[name] = values[keep]
+        return sub
+
+    @property
+    def nbytes(self):
+        """Total size in bytes of the node and edge arrays."""
+        return sum(array.nbytes for array in (self.labels, self.indptr,
+                                              self.indices, self.rindptr,
+                                              self.rindices))
+
+def _compress(rows, cols, n):
+    """Return CSR `(indptr, indices)` for edges already sorted by row."""
+    indptr = numpy.zeros(n + 1, dtype=numpy.int64)
+    numpy.cumsum(numpy.bincount(rows, minlength=n), out=indptr[1:])
+    return indptr, cols.astype(numpy.int32, copy=False)
+
+def expand_ranges(indptr, rows):
+    """Return `(owner, positions)` for the CSR ranges of `rows`.
+
+    `positions` concatenates `indptr[r]:indptr[r+1]` for each `r` in `rows`,
+    and `owner[j]` is the index into `rows` that position `j` came from.
+
+    """
+    rows = numpy.asarray(rows, dtype=numpy.int64)
+    starts = indptr[rows]
+    lengths = indptr[rows + 1] - starts
+    owner = numpy.repeat(numpy.arange(len(rows)), lengths)
+    offsets = numpy.cumsum(lengths) - lengths
+    positions = numpy.arange(lengths.sum()) - offsets[owner] + starts[owner]
+    return owner, positions
+
+def edge_arrays(graph):
+    """Return `(src, dst)` int64 label arrays for either graph backend."""
+    if isinstance(graph, CSRGraph):
+        return graph.edge_arrays()
+    edges = numpy.fromiter(
+        (node for edge in graph.edges() for node in edge),
+        dtype=numpy.int64, count=2 * graph.number_of_edges())
+    return edges[0::2], edges[1::2]
+
+def as_csr(graph):
+    """Return `graph` as a `CSRGraph`, converting from networkx if needed."""
+    if isinstance(graph, CSRGraph):
+        return graph
+    return CSRGraph.from_networkx(graph)
+
+def compare_backends(filename, queries=10000, seed=0):
+    """Compare memory use and query latency of the two graph backends.
+
+    Both backends are built from the same edgelist file. Memory is the
+    amount allocated while building the graph from already parsed edge
+    arrays; latency is the mean over `queries` random `predecessors` and
+    `in_degree` calls.
+
+    """
+    import networkx
+    import dataio
+    src, dst = dataio.read_edges(filename)
+    builders = (
+        ('networkx', lambda: networkx.DiGraph(zip(src.tolist(),
+                                                  dst.tolist()))),
+        ('csr', lambda: CSRGraph.from_edges(src, dst)),
+    )
+    rng = numpy.random.RandomState(seed)
+    nodes = None
+    results = {}
+    for name, build in builders:
+        tracemalloc.start()
+        start = time.perf_counter()
+        graph = build()
+        build_time = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        if nodes is None:
+            nodes = rng.choice(numpy.union1d(src, dst), queries).tolist()
+        start = time.perf_counter()
+        for node in nodes:
+            list(graph.predecessors(node))
+        pred_time = (time.perf_counter() - start) / len(nodes)
+        start = time.perf_counter()
+        for node in nodes:
+            graph.in_degree(node)
+        indeg_time = (time.perf_counter() - start) / len(nodes)
+        results[name] = {
+            'build_seconds': build_time,
+            'build_peak_mb': peak / 2**20,
+            'predecessors_us': pred_time * 1e6,
+            'in_degree_us': indeg_time * 1e6,
+        }
+    table = pandas.DataFrame(results)
+    print(table)
+    return table
@@ -2,19 +2,33 @@
 
 import os
 import os.path
+import sys
 import time
-import pickle
+import resource
 import contextlib
 import collections
 
-import scipy.stats
+import numpy
 import pandas
-import networkx
-import matplotlib.pyplot as plt
-import redis
+
+import snapshot
+import instrument
+from csrgraph import CSRGraph
 
 _graph = None
 _metadata = None
+_redis_pools = {}
+
+EDGE_CHUNKSIZE = 1 << 20 # rows parsed per chunk by `iter_edge_chunks`
+
+# Metadata columns read by the analyses.
+ANALYSIS_COLUMNS = ('appMyName', 'acquirerMyName', 'acqCompleteDate',
+                    'ipcaA', 'ipcaB', 'ipcaC', 'ipcaD', 'ipcaE',
+                    'applnFilingDate', 'applnIpcaNovelty')
+
+# Code-like columns that stay categorical even when their values look
+# numeric (e.g. IPC parts such as '01').
+STRING_COLUMNS = ('ipca', 'applnNr', 'appSNam', 'appMyName', 'acquirerMyName')
 
 def graph():
     global _graph
@@ -28,61 +42,145 @@ def metadata():
         load_graph_and_metadata()
     return _metadata
 
-def load_graph_and_metadata():
+def source_files():
+    """Return the citation edgelist and metadata file paths."""
+    data_dir = os.environ.get('PATENT_DATA_DIR',
+        os.path.expanduser('~/Downloads/PatentNetworks'))
+    graph_file = os.path.join(data_dir,
+        'citation pairs by applnID simple try sorted by citing.txt')
+    meta_files = [
+        os.path.join(data_dir, filename)
+        for filename in (
+            'LEDs patents keyinfo.txt',
+            'LEDs patents applicants longform.txt',
+            'LEDs patents ipcas longform.txt',
+        )]
+    return graph_file, meta_files
+
+def metadata_columns():
+    """Return the metadata columns to load, or `None` for all of them.
+
+    Set by `PATENT_METADATA_COLUMNS` as a comma-separated list, or `all`;
+    defaults to `ANALYSIS_COLUMNS`.
+
+    """
+    setting = os.environ.get('PATENT_METADATA_COLUMNS')
+    if setting is None:
+        return list(ANALYSIS_COLUMNS)
+    if setting == 'all':
+        return None
+    return [column.strip() for column in setting.split(',') if column.strip()]
+
+def load_snapshot():
+    """Return a `snapshot.Snapshot` of the current source files.
+
+    Snapshots are looked up in `PATENT_SNAPSHOT_DIR`, then in Redis, and
+    otherwise built from the source files (and, if allowed, uploaded to
+    Redis in chunks). If `PATENT_MEMORY_BUDGET` is set, the graph is built
+    within that budget by `streaming.build_snapshot`.
+
+    """
     redis_read = os.environ.get('PATENT_REDIS_READ', True)
     redis_write = os.environ.get('PATENT_REDIS_WRITE', True)
-    redis_host = os.environ.get('REDIS_HOST', 'localhost')
-    redis_port = os.environ.get('REDIS_PORT', 6379)
     redis_prefix = os.environ.get('PATENT_REDIS_PREFIX', 'patentdata:')
+    snapshot_dir = os.environ.get('PATENT_SNAPSHOT_DIR',
+        os.path.expanduser('~/.cache/patentdata/snapshots'))
+
+    columns = metadata_columns()
+    graph_file, meta_files = source_files()
+    key = snapshot.source_key([graph_file] + meta_files,
+                              options=[columns, {'longform': 'keep'}])
+    if snapshot.exists(snapshot_dir, key):
+        return snapshot.open_snapshot(snapshot_dir, key)
 
     # Attempt to connect to Redis server.
+    rc = redis_client() if redis_read or redis_write else None
+
+    # Check Redis server for a pre-built snapshot.
+    if rc is not None and redis_read:
+        with timed('Fetching snapshot from Redis'):
+            path = snapshot.pull_from_redis(rc, snapshot_dir, key,
+                                            redis_prefix)
+        if path is not None:
+            return snapshot.Snapshot(path)
+
+    # If there was no snapshot anywhere, build one from file instead. With a
+    # memory budget, the graph is built out of core.
+    with timed('Loading graph from file'):
+        metadata = read_metadata(meta_files, columns=columns,
+                                 longform='keep')
+        if os.environ.get('PATENT_MEMORY_BUDGET'):
+            import streaming
+            path = streaming.build_snapshot(graph_file, snapshot_dir, key,
+                                            metadata)
+        else:
+            graph = read_graph(graph_file, backend='csr')
+            path = snapshot.write(snapshot_dir, key, graph, metadata)
+
+    # If allowed, upload the snapshot to Redis for other machines.
+    if rc is not None and redis_write:
+        snapshot.push_to_redis(rc, path, redis_prefix)
+    return snapshot.Snapshot(path)
+
+def redis_client():
+    """Return a `redis.StrictRedis` client, or `None` if Redis is unusable.
+
+    Clients share one connection pool per `REDIS_HOST` and `REDIS_PORT`, so
+    repeated calls (and concurrent users of one client) reuse connections
+    instead of opening a new one each time.
+
+    """
+    import redis
+    host = os.environ.get('REDIS_HOST', 'localhost')
+    port = int(os.environ.get('REDIS_PORT', 6379))
+    pool = _redis_pools.get((host, port))
+    if pool is None:
+        pool = redis.ConnectionPool(host=host, port=port, socket_timeout=2)
+        _redis_pools[(host, port)] = pool
+    rc = redis.StrictRedis(connection_pool=pool)
     try:
-        rc = redis.StrictRedis(host=redis_host, port=redis_port,
-                               socket_timeout=2)
-    except redis.ConnectionError:
-        print('Could not connect to Redis instance at {}:{}. '
-              'Caching disabled.'.format(redis_host, redis_port))
-        rc = None
-        redis_read = redis_write = None
-
-    # Check Redis server for pre-loaded graph and metadata.
-    graph_key = redis_prefix + 'main_graph'
-    metadata_key = redis_prefix + 'main_metadata'
-    if redis_read:
-        pickled_graph = rc.get(graph_key)
-        pickled_metadata = rc.get(metadata_key)
-    else:
-        pickled_graph = None
+        rc.ping()
+    except redis.RedisError as exc:
+        # Also covers timeouts, authentication and protocol errors.
+        print('Could not use Redis instance at {}:{} ({}). '
+              'Caching disabled.'.format(host, port, exc), file=sys.stderr)
+        return None
+    return rc
 
-    # If we found pre-loaded data in Redis, unpickle it.
-    if pickled_graph and pickled_metadata:
-        graph = pickle.loads(pickled_graph)
-        metadata = pickle.loads(pickled_metadata)
+def load_current_snapshot():
+    """Return the snapshot of the sources with any pending deltas applied.
 
-    # If there was no data in Redis, load it from file instead.
-    else:
-        data_dir = os.environ.get('PATENT_DATA_DIR',
-            os.path.expanduser('~/Downloads/PatentNetworks'))
-        graph_file = os.path.join(data_dir,
-            'citation pairs by applnID simple try sorted by citing.txt')
-        meta_files = [
-            os.path.join(data_dir, filename)
-            for filename in (
-                'LEDs patents keyinfo.txt',
-                'LEDs patents applicants longform.txt',
-                'LEDs patents ipcas longform.txt',
-            )]
-        with timed('Loading graph from file'):
-            graph = read_graph(graph_file)
-            metadata = read_metadata(meta_files)
-            annotate_graph(graph, metadata)
-
-        # If allowed, pickle the graph and metadata and write it back to Redis.
-        if redis_write:
-            pickled_graph = pickle.dumps(graph)
-            pickled_metadata = pickle.dumps(metadata)
-            rc.set(graph_key, pickled_graph)
-            rc.set(metadata_key, pickled_metadata)
+    Delta files are read from `PATENT_DELTA_DIR` if it is set; see
+    `ingest.pending_files` for their naming. Deltas are applied on top of
+    the newest snapshot already derived from the sources (see
+    `ingest.latest_snapshot`), so each run only parses new delta files.
+
+    """
+    snap = load_snapshot()
+    delta_dir = os.environ.get('PATENT_DELTA_DIR')
+    if delta_dir:
+        import ingest
+        snapshot_dir = os.path.dirname(snap.path)
+        snap = ingest.latest_snapshot(snap, snapshot_dir, delta_dir)
+        edge_files, metadata_files = ingest.pending_files(snap, delta_dir)
+        if edge_files or metadata_files:
+            with timed('Applying {} delta files'.format(
+                    len(edge_files) + len(metadata_files))):
+                snap = ingest.apply_delta(snap, snapshot_dir, edge_files,
+                                          metadata_files).snapshot
+    return snap
+
+def load_graph_and_metadata():
+    backend = os.environ.get('PATENT_GRAPH_BACKEND', 'networkx')
+    annotate_mode = os.environ.get('PATENT_ANNOTATE_MODE', 'attributes')
+    snap = load_current_snapshot()
+    graph = snap.graph
+    metadata = snap.metadata
+    if backend == 'networkx':
+        graph = graph.to_networkx()
+    elif backend != 'csr':
+        raise ValueError('Unknown graph backend: {}'.format(backend))
+    annotate_graph(graph, metadata, mode=annotate_mode)
 
     global _graph
     global _metadata
@@ -91,45 +189,253 @@ def load_graph_and_metadata():
 
 @contextlib.contextmanager
 def timed(description):
-    """Print timing information on code within the context."""
-    print('{}...'.format(description), end='', flush=True)
-    start = time.clock()
+    """Print timing information on code within the context to stderr."""
+    print('{}...'.format(description), end='', flush=True, file=sys.stderr)
+    start = time.perf_counter()
     yield
-    end = time.clock()
-    print('done after {} seconds.'.format(end - start))
+    end = time.perf_counter()
+    print('done after {:.3f} seconds.'.format(end - start), file=sys.stderr)
 
 def histogram(dct):
     """Return a Series of the lengths of dct's values, indexed by key."""
     return pandas.Series({key: len(val) for key, val in dct.items()})
 
-def read_graph(filename):
-    """Read edgelist from tsv file, return a networkx.DiGraph."""
-    frame = read_tsv(filename)
-    clean_frame = frame.dropna() # ignore missing data
-    edgelist = [
-        (int(src), int(dst)) # convert edges to integers
-        for src, dst in clean_frame.values.tolist()
-    ]
-    return networkx.DiGraph(edgelist)
-
-def read_metadata(filenames, index_col='applnID'):
-    """Read metadata from several files and return one pandas.DataFrame."""
-    frames = [read_tsv(filename, index_col=index_col)
-              for filename in filenames]
-    joinframe = frames[0]
-    for frame in frames[1:]:
-        joinframe = joinframe.join(frame, how='outer', rsuffix='_dup')
+def read_graph(filename, backend='networkx'):
+    """Read edgelist from tsv file, return a graph.
+
+    `backend` is either `'networkx'` for a `networkx.DiGraph` or `'csr'` for
+    a compact `csrgraph.CSRGraph`.
+
+    """
+    src, dst = read_edges(filename)
+    if backend == 'csr':
+        return CSRGraph.from_edges(src, dst)
+    if backend != 'networkx':
+        raise ValueError('Unknown graph backend: {}'.format(backend))
+    import networkx
+    graph = networkx.DiGraph()
+    graph.add_edges_from(zip(src.tolist(), dst.tolist()))
+    return graph
+
+def read_edges(filename, chunksize=EDGE_CHUNKSIZE):
+    """Read edgelist from tsv file, return `(src, dst)` int64 arrays."""
+    chunks = list(iter_edge_chunks(filename, chunksize))
+    if not chunks:
+        empty = numpy.empty(0, dtype=numpy.int64)
+        return empty, empty.copy()
+    return (numpy.concatenate([src for src, _ in chunks]),
+            numpy.concatenate([dst for _, dst in chunks]))
+
+def iter_edge_chunks(filename, chunksize=EDGE_CHUNKSIZE):
+    """Yield `(src, dst)` int64 arrays from a tsv edgelist, chunk by chunk.
+
+    Only the first two columns are parsed. Chunks of plain integers are
+    parsed straight to int64; a chunk with anything else (which would come
+    out as float64 and lose labels above 2**53) is read again as strings.
+    Rows with a missing or non-integer endpoint are dropped.
+
+    """
+    done = 0
+    for frame in _edge_reader(filename, chunksize):
+        rows = len(frame)
+        if rows and not all(dtype.kind == 'i' for dtype in frame.dtypes):
+            frame = next(_edge_reader(filename, rows, str, skip=done))
+            frame = pandas.DataFrame({
+                column: frame[column].str.extract(
+                    r'^\s*([+-]?\d+)(?:\.0*)?\s*$', expand=False)
+                for column in frame.columns}).dropna()
+        done += rows
+        yield tuple(frame[column].to_numpy().astype(numpy.int64)
+                    for column in frame.columns)
+
+def _edge_reader(filename, chunksize, dtype=None, skip=0):
+    """Return a chunked reader of the first two columns after `skip` rows."""
+    return pandas.read_csv(filename,
+                           delimiter='\t',
+                           encoding='ISO-8859-1',
+                           usecols=[0, 1],
+                           dtype=dtype,
+                           skiprows=range(1, skip + 1),
+                           chunksize=chunksize)
+
+def benchmark_read_graph(filename, chunksize=EDGE_CHUNKSIZE):
+    """Load an edgelist and print rows/sec and peak RSS for each stage."""
+    import networkx
+    start = time.perf_counter()
+    src, dst = read_edges(filename, chunksize)
+    parsed = time.perf_counter()
+    graph = networkx.DiGraph()
+    graph.add_edges_from(zip(src.tolist(), dst.tolist()))
+    built = time.perf_counter()
+    for stage, elapsed in (('parse', parsed - start),
+                           ('build', built - parsed),
+                           ('total', built - start)):
+        print('{}: {} rows in {:.3f} seconds ({:.0f} rows/sec)'
+              .format(stage, len(src), elapsed,
+                      len(src) / elapsed if elapsed else float('inf')))
+    print('peak RSS: {:.1f} MB'.format(peak_rss() / 2**20))
+    return graph
+
+def peak_rss():
+    """Return the peak resident set size of this process in bytes."""
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS reports bytes.
+    return usage if os.uname().sysname == 'Darwin' else usage * 1024
+
+@instrument.traced('dataio.read_metadata', items=len)
+def read_metadata(filenames, index_col='applnID', columns=None,
+                  longform='keep'):
+    """Read metadata from several files and return one pandas.DataFrame.
+
+    Arguments:
+
+    -   **`filenames`** are tsv files sharing the `index_col` column.
+
+    -   **`columns`** optionally lists the columns to load; each is read from
+        the first file that has it and other columns are never parsed. By
+        default every column of every file is loaded.
+
+    -   **`longform`** controls files with several rows per applnID (such as
+        the applicants and IPC files). With `'keep'` all rows are kept: the
+        files are joined on the applnID and the position of each row among
+        that applnID's rows, so an applnID with two applicants and three IPC
+        codes gets three rows rather than six, and columns from one-row
+        files are only filled on its first row. With `'first'` only the
+        first row of each applnID is kept, so the files join one-to-one.
+
+    Columns are typed by `read_typed_tsv`, and the index is int64.
+
+    """
+    if longform not in ('first', 'keep'):
+        raise ValueError('Unknown longform mode: {}'.format(longform))
+    frames = []
+    loaded = set()
+    for filename in filenames:
+        usecols = None
+        if columns is not None:
+            header = read_tsv_header(filename)
+            usecols = [column for column in header
+                       if column in columns and column not in loaded]
+            if not usecols:
+                continue # nothing wanted from this file
+            loaded.update(usecols)
+        with instrument.span('dataio.read_typed_tsv',
+                             file=os.path.basename(filename)) as span:
+            frame = read_typed_tsv(filename, index_col, usecols)
+            span.items = len(frame)
+        if longform == 'first' and not frame.index.is_unique:
+            frame = frame[~frame.index.duplicated(keep='first')]
+        frames.append(frame)
+    if not frames:
+        return pandas.DataFrame(index=pandas.Index([], dtype=numpy.int64,
+                                                   name=index_col))
+    longform = not all(frame.index.is_unique for frame in frames)
+    if longform:
+        frames = [frame.set_axis(occurrence_index(frame.index))
+                  for frame in frames]
+    with instrument.span('dataio.join', items=len(frames)):
+        joinframe = frames[0]
+        for frame in frames[1:]:
+            joinframe = joinframe.join(frame, how='outer', rsuffix='_dup')
+    if longform:
+        joinframe = joinframe.sort_index().droplevel(1)
     return joinframe
 
-def annotate_graph(graph, metadata):
-    """Annotate graph with metadata fields."""
-    for column, series in metadata.iteritems():
-        clean_series = series.dropna() # ignore missing data
-        for index, value in clean_series.iteritems():
-            if index not in graph:
-                continue # ignore nodes not in graph
-            graph.node[index][column] = value
+def occurrence_index(index):
+    """Return a MultiIndex pairing each label of `index` with the number of
+    times it occurred before, for aligning rows of one-to-many tables."""
+    occurrence = pandas.Series(index).groupby(index).cumcount().values
+    return pandas.MultiIndex.from_arrays([index, occurrence],
+                                         names=[index.name, 'occurrence'])
+
+def read_typed_tsv(filename, index_col='applnID', usecols=None):
+    """Return a pandas.DataFrame of a tsv file with typed columns.
+
+    Values are parsed straight into categoricals. Columns whose name ends in
+    `Date` are then converted to datetime64, and columns whose values are
+    all numeric to numbers; both conversions only touch the (few) distinct
+    values. The remaining columns, and those in `STRING_COLUMNS` such as
+    company names and IPC parts, stay categorical. Rows without a numeric
+    `index_col` are dropped.
+
+    """
+    if usecols is not None:
+        usecols = [index_col] + [column for column in usecols
+                                 if column != index_col]
+    frame = pandas.read_csv(filename,
+                            delimiter='\t',
+                            encoding='ISO-8859-1',
+                            usecols=usecols,
+                            dtype='category')
+    index = pandas.to_numeric(frame.pop(index_col).astype(object),
+                              errors='coerce')
+    valid = index.notnull().values
+    frame = frame[valid]
+    frame.index = pandas.Index(index[valid].astype(numpy.int64).values,
+                               name=index_col)
+    for column in frame.columns:
+        frame[column] = _convert_categorical(column, frame[column])
+    return frame
+
+def _convert_categorical(column, series):
+    """Convert a categorical column to datetime or numbers if it fits."""
+    categories = series.cat.categories
+    if column.startswith(STRING_COLUMNS):
+        return series
+    if column.endswith('Date'):
+        converted = pandas.to_datetime(pandas.Series(categories),
+                                       errors='coerce')
+    else:
+        converted = pandas.to_numeric(pandas.Series(categories),
+                                      errors='coerce')
+        if converted.isnull().any():
+            return series # not numeric, keep as categorical
+    codes = series.cat.codes.values
+    values = converted.values.take(numpy.maximum(codes, 0))
+    return pandas.Series(values, index=series.index).where(codes >= 0)
+
+def read_tsv_header(filename):
+    """Return the column names of a tsv file."""
+    return pandas.read_csv(filename,
+                           delimiter='\t',
+                           encoding='ISO-8859-1',
+                           nrows=0).columns.tolist()
+
+@instrument.traced('dataio.annotate_graph')
+def annotate_graph(graph, metadata, mode='attributes'):
+    """Annotate graph with metadata fields.
+
+    The metadata is collapsed to one row per applnID and aligned to the
+    graph's nodes once, and each column is then attached as a whole: as an
+    array aligned with the node ids on a `CSRGraph`, or as one batched
+    attribute update on a `networkx.DiGraph`. Missing values are not
+    stored, and when an applnID appears on several rows the last non-null
+    value of each column wins.
+
+    With `mode='table'` the graph is left untouched, for analyses that only
+    read the `metadata` side table.
+
+    """
+    if mode == 'table':
+        return
+    if mode != 'attributes':
+        raise ValueError('Unknown annotation mode: {}'.format(mode))
+    if not metadata.index.is_unique:
+        metadata = metadata.groupby(level=0).last()
+    if isinstance(graph, CSRGraph):
+        aligned = metadata.reindex(graph.labels)
+        for column, series in aligned.items():
+            graph.node_attrs[column] = series.values
+        return
+    nodes = metadata.index.intersection(pandas.Index(list(graph.nodes())))
+    aligned = metadata.loc[nodes]
+    records = aligned.to_dict('index')
+    graph.add_nodes_from(
+        (node, {column: value for column, value in record.items()
+                if not pandas.isna(value)}) # ignore missing data
+        for node, record in records.items())
 
+@instrument.traced('dataio.read_tsv', items=len)
 def read_tsv(filename, index_col=None):
     """Return a pandas.DataFrame of a tsv file."""
     return pandas.read_csv(filename,
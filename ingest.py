@@ -0,0 +1,287 @@
+"""Incremental ingestion of citation and metadata deltas.
+
+A delta is a set of tsv files in the same formats as the full sources:
+citation pairs to add, and metadata rows (such as applicant or acquirer
+updates) to upsert by applnID. `apply_delta` turns a snapshot and a delta
+into a new snapshot with a higher revision and an extended watermark, so
+the same delta file is never applied twice. Only the delta files are
+parsed; new edges are merged into the existing sorted CSR arrays.
+
+`DerivedCache` holds values computed from a snapshot (degrees, PageRank,
+neighborhoods) and, given the edges a delta added, drops or updates only
+the entries the delta can have changed. The query server keeps one across
+the deltas it applies while running (see `server.QueryService.refresh`).
+
+"""
+import os
+import os.path
+import json
+import glob
+import hashlib
+import collections
+
+import numpy
+import pandas
+
+import nhood
+import dataio
+import snapshot
+import pagerank
+
+EDGE_DELTA_PATTERN = '*.citations.txt'
+METADATA_DELTA_PATTERN = '*.metadata.txt'
+
+class Delta(object):
+    """The result of applying a delta to a snapshot.
+
+    Attributes: `snapshot` (the new `snapshot.Snapshot`), `added` (a
+    `(src, dst)` pair of label arrays with the edges that were new) and
+    `upserted` (the applnIDs whose metadata rows were inserted or updated,
+    or `None` if unknown).
+
+    """
+
+    def __init__(self, snap, added, upserted):
+        self.snapshot = snap
+        self.added = added
+        self.upserted = upserted
+
+def pending_files(snap, delta_dir):
+    """Return `(edge_files, metadata_files)` in `delta_dir` not yet applied.
+
+    Edge deltas match `EDGE_DELTA_PATTERN` and metadata deltas match
+    `METADATA_DELTA_PATTERN`; both are applied in filename order.
+
+    """
+    applied = set(tuple(identity) for identity in snap.watermark)
+    def pending(pattern):
+        return [filename
+                for filename in sorted(glob.glob(os.path.join(delta_dir,
+                                                              pattern)))
+                if tuple(snapshot.file_identity(filename)) not in applied]
+    return (pending(EDGE_DELTA_PATTERN), pending(METADATA_DELTA_PATTERN))
+
+def delta_files(delta_dir):
+    """Return all edge and metadata delta files in `delta_dir`."""
+    return [filename
+            for pattern in (EDGE_DELTA_PATTERN, METADATA_DELTA_PATTERN)
+            for filename in sorted(glob.glob(os.path.join(delta_dir,
+                                                          pattern)))]
+
+def latest_snapshot(snap, snapshot_dir, delta_dir):
+    """Return the newest snapshot derived from `snap` by applying deltas.
+
+    Candidates are the snapshots in `snapshot_dir` descending from `snap`
+    through their `parent` keys whose watermark only holds delta files
+    still present, unchanged, in `delta_dir`. Among those, the one with
+    the highest revision (then the longest watermark) wins; `snap` itself
+    is returned if there is none. Applying the files `pending_files`
+    reports for the result then only parses deltas received since.
+
+    """
+    current = set(tuple(snapshot.file_identity(filename))
+                  for filename in delta_files(delta_dir))
+    children = collections.defaultdict(list)
+    for name in os.listdir(snapshot_dir):
+        if not snapshot.exists(snapshot_dir, name):
+            continue # temporary or partially written
+        child = snapshot.open_snapshot(snapshot_dir, name)
+        if child.manifest.get('parent'):
+            children[child.manifest['parent']].append(child)
+    best = snap
+    frontier = [snap]
+    while frontier:
+        parent = frontier.pop()
+        for child in children[parent.key]:
+            if not set(map(tuple, child.watermark)) <= current:
+                continue
+            frontier.append(child)
+            if ((child.revision, len(child.watermark))
+                    > (best.revision, len(best.watermark))):
+                best = child
+    return best
+
+def apply_delta(snap, snapshot_dir, edge_files=(), metadata_files=()):
+    """Apply delta files to a snapshot, return a `Delta`.
+
+    The new snapshot is written to `snapshot_dir` under a key derived from
+    the parent key and the delta files. If that snapshot already exists
+    (another process applied the same delta) it is reused without parsing
+    the delta: the added edges are then found by comparing its graph with
+    the parent's, and `upserted` is `None` as the rows are not known.
+
+    """
+    edge_files, metadata_files = list(edge_files), list(metadata_files)
+    identities = [snapshot.file_identity(filename)
+                  for filename in edge_files + metadata_files]
+    key = hashlib.sha1(json.dumps([snap.key, identities]).encode()) \
+                 .hexdigest()
+    nothing = (numpy.empty(0, dtype=numpy.int64),) * 2
+    if snapshot.exists(snapshot_dir, key):
+        child = snapshot.open_snapshot(snapshot_dir, key)
+        return Delta(child, new_edges(snap.graph, child.graph), None)
+
+    graph = snap.graph
+    added = nothing
+    if edge_files:
+        edges = [dataio.read_edges(filename) for filename in edge_files]
+        graph, added = graph.add_edges(
+            numpy.concatenate([src for src, _ in edges]),
+            numpy.concatenate([dst for _, dst in edges]))
+
+    metadata = snap.metadata
+    upserted = pandas.Index([], dtype=numpy.int64)
+    if metadata_files:
+        updates = dataio.read_metadata(metadata_files,
+                                       columns=list(metadata.columns))
+        metadata = upsert(metadata, updates)
+        upserted = updates.index.unique()
+
+    path = snapshot.write(snapshot_dir, key, graph, metadata,
+                          revision=snap.revision + 1, parent=snap.key,
+                          watermark=snap.watermark + identities)
+    return Delta(snapshot.Snapshot(path), added, upserted)
+
+def new_edges(parent, child):
+    """Return `(src, dst)` label arrays of the edges of `child` that are
+    not in `parent`, a `CSRGraph` whose nodes and edges it contains."""
+    n = len(child.labels)
+    remap = numpy.searchsorted(child.labels, parent.labels)
+    rows, cols = parent.edge_ids()
+    old = remap[rows].astype(numpy.int64) * n + remap[cols]
+    rows, cols = child.edge_ids()
+    keys = rows.astype(numpy.int64) * n + cols
+    added = keys[~numpy.isin(keys, old, assume_unique=True)]
+    return child.labels[added // n], child.labels[added % n]
+
+def upsert(metadata, updates):
+    """Return `metadata` with the rows of `updates` inserted or updated.
+
+    Non-null values in `updates` replace existing ones; null values leave
+    the existing value in place. Column types are preserved. An applnID
+    with several rows (see `dataio.read_metadata`) is matched row by row,
+    in order.
+
+    """
+    name = metadata.index.name
+    metadata = metadata.set_axis(dataio.occurrence_index(metadata.index))
+    updates = updates.set_axis(dataio.occurrence_index(updates.index))
+    index = metadata.index.union(updates.index)
+    columns = {}
+    for column in metadata.columns:
+        old = metadata[column]
+        if column not in updates or updates[column].isnull().all():
+            columns[column] = old.reindex(index)
+            continue
+        new = updates[column]
+        categorical = (isinstance(old.dtype, pandas.CategoricalDtype)
+                       or isinstance(new.dtype, pandas.CategoricalDtype))
+        if categorical:
+            old, new = old.astype(object), new.astype(object)
+        merged = new.combine_first(old).reindex(index)
+        columns[column] = merged.astype('category') if categorical else merged
+    merged = pandas.DataFrame(columns, index=index, columns=metadata.columns)
+    return merged.droplevel(1).rename_axis(name)
+
+def affected_roots(graph, dst, depth):
+    """Return the labels whose closed `depth`-neighborhood gained members
+    when edges into the nodes `dst` were added.
+
+    A new citation of `v` changes the neighborhood of every node that `v`
+    reaches by following at most `depth - 1` citations.
+
+    """
+    seen = set(numpy.asarray(dst).tolist())
+    frontier = seen
+    for _ in range(depth - 1):
+        frontier = set(node for root in frontier
+                       for node in graph.successors(root)) - seen
+        if not frontier:
+            break
+        seen |= frontier
+    return seen
+
+def stale_neighborhoods(graph, dst, keys):
+    """Return the `(root, depth, closed)` neighborhood keys among `keys`
+    whose neighborhoods changed when edges into the nodes `dst` were added
+    to `graph`."""
+    keys = list(keys)
+    stale = {depth: affected_roots(graph, dst, depth)
+             for depth in set(depth for _, depth, _ in keys)}
+    return [key for key in keys if key[0] in stale[key[1]]]
+
+class DerivedCache(object):
+    """Values derived from one snapshot revision, kept current by deltas.
+
+    -   `degrees()` returns in- and out-degrees, updated in place from the
+        added edges.
+
+    -   `pagerank()` returns PageRank scores; after a delta they are
+        recomputed lazily, warm-started from the previous scores.
+
+    -   `neighborhood(root, depth, closed)` caches neighborhoods, and a
+        delta only evicts the roots it can have changed.
+
+    Constructor arguments:
+
+    -   **`snap`** is the `snapshot.Snapshot` the values derive from.
+
+    -   **`neighborhoods`** optionally is the mapping that holds cached
+        neighborhoods, such as a bounded LRU; it needs `get`, `pop`, item
+        assignment, `len` and iteration over its keys.
+
+    """
+
+    def __init__(self, snap, neighborhoods=None):
+        self.snapshot = snap
+        self._degrees = None
+        self._pagerank = None
+        self._neighborhoods = {} if neighborhoods is None else neighborhoods
+
+    @property
+    def revision(self):
+        return self.snapshot.revision
+
+    def degrees(self):
+        if self._degrees is None:
+            graph = self.snapshot.graph
+            self._degrees = pandas.DataFrame({
+                'indegree': graph.in_degree_array(),
+                'outdegree': graph.out_degree_array(),
+            }, index=graph.labels)
+        return self._degrees
+
+    def pagerank(self):
+        if self._pagerank is None:
+            self._pagerank = pagerank.PageRank.from_graph(self.snapshot.graph)
+        return self._pagerank.scores()
+
+    def neighborhood(self, root, depth=1, closed=False):
+        key = (root, depth, closed)
+        members = self._neighborhoods.get(key)
+        if members is None:
+            members = frozenset(nhood.neighborhood(self.snapshot.graph, root,
+                                                   depth, closed))
+            self._neighborhoods[key] = members
+        return members
+
+    def apply(self, delta):
+        """Move the cache to `delta.snapshot`, invalidating what changed."""
+        src, dst = delta.added
+        graph = delta.snapshot.graph
+        self.snapshot = delta.snapshot
+        if self._degrees is not None:
+            degrees = self._degrees
+            if len(degrees) != len(graph.labels):
+                degrees = degrees.reindex(graph.labels, fill_value=0)
+            for column, ends in (('indegree', dst), ('outdegree', src)):
+                counts = pandas.Series(ends).value_counts()
+                degrees.loc[counts.index, column] += counts.values
+            self._degrees = degrees
+        if self._pagerank is not None and len(src):
+            self._pagerank.add_edges(src, dst)
+        if len(self._neighborhoods) and len(src):
+            for key in stale_neighborhoods(graph, dst,
+                                           list(self._neighborhoods)):
+                # Entries may have been evicted concurrently.
+                self._neighborhoods.pop(key, None)
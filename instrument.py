@@ -0,0 +1,261 @@
+"""Named spans, trace export and a sampling profiler.
+
+A span times a named piece of work: wall and CPU time, the number of items
+it processed and, optionally, the peak memory it allocated. Spans nest, and
+are recorded only while tracing is enabled; otherwise `span` returns a
+shared no-op object and `traced` functions call straight through, so the
+instrumentation can stay in hot paths.
+
+Settings, read at import like the other `PATENT_*` variables:
+
+-   `PATENT_TRACE` is a file name; spans are recorded and written there at
+    exit in the Chrome trace event format, which chrome://tracing,
+    Perfetto and speedscope display as a timeline or flame graph.
+
+-   `PATENT_TRACE_MEMORY=1` also records each span's peak traced memory
+    (through `tracemalloc`, which slows allocation-heavy code down).
+
+-   `PATENT_PROFILE` is a file name; a background thread samples the main
+    thread's Python stack every `PATENT_PROFILE_INTERVAL` seconds (default
+    0.005) and writes the counts at exit as folded stacks, the input format
+    of flamegraph.pl and speedscope.
+
+"""
+import os
+import sys
+import json
+import time
+import atexit
+import resource
+import functools
+import threading
+import collections
+
+_enabled = False
+_memory = False
+_events = []
+_local = threading.local()
+_origin = time.perf_counter()
+
+class _NullSpan(object):
+    """Stands in for a span while tracing is disabled."""
+    items = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def __setattr__(self, name, value):
+        pass # ignore `span.items = ...` while disabled
+
+_null = _NullSpan()
+
+class Span(object):
+    """A recorded span; set `items` or add to `args` while it is open."""
+
+    def __init__(self, name, items=0, args=None):
+        self.name = name
+        self.items = items
+        self.args = dict(args or {})
+        self.children_peak = 0
+
+    def __enter__(self):
+        stack = _stack()
+        if _memory:
+            import tracemalloc
+            current, peak = tracemalloc.get_traced_memory()
+            if stack:
+                stack[-1].children_peak = max(stack[-1].children_peak, peak)
+            tracemalloc.reset_peak()
+            self.memory_start = current
+        stack.append(self)
+        self.start = time.perf_counter()
+        self.cpu_start = time.thread_time()
+        return self
+
+    def __exit__(self, *exc):
+        end = time.perf_counter()
+        cpu = time.thread_time() - self.cpu_start
+        stack = _stack()
+        # Remove this span, not whatever is on top: a span left open in a
+        # suspended generator may be closed out of order.
+        for position in range(len(stack) - 1, -1, -1):
+            if stack[position] is self:
+                del stack[position]
+                break
+        args = dict(self.args)
+        args['cpu_seconds'] = cpu
+        args['items'] = self.items
+        args['peak_rss'] = _peak_rss()
+        if _memory:
+            import tracemalloc
+            peak = max(self.children_peak, tracemalloc.get_traced_memory()[1])
+            args['peak_memory'] = peak - self.memory_start
+            if stack:
+                stack[-1].children_peak = max(stack[-1].children_peak, peak)
+            tracemalloc.reset_peak()
+        if exc[0] is not None:
+            args['error'] = exc[0].__name__
+        _events.append({
+            'name': self.name,
+            'ph': 'X',
+            'ts': (self.start - _origin) * 1e6,
+            'dur': (end - self.start) * 1e6,
+            'pid': os.getpid(),
+            'tid': threading.get_ident(),
+            'args': args,
+        })
+        return False
+
+def _stack():
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    return _local.stack
+
+def _peak_rss():
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS reports bytes.
+    return usage if os.uname().sysname == 'Darwin' else usage * 1024
+
+def enabled():
+    return _enabled
+
+def span(name, items=0, **args):
+    """Return a context manager timing the code within as span `name`."""
+    if not _enabled:
+        return _null
+    return Span(name, items, args)
+
+def traced(name=None, items=None):
+    """Decorate a function to run each call in a span.
+
+    -   **`name`** defaults to the function's qualified name.
+
+    -   **`items`** optionally is a function of the call's result returning
+        the number of items processed.
+
+    """
+    def decorate(func):
+        label = name or func.__qualname__
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return func(*args, **kwargs)
+            with Span(label) as current:
+                result = func(*args, **kwargs)
+                if items is not None:
+                    current.items = items(result)
+                return result
+        return wrapper
+    return decorate
+
+def enable(memory=False):
+    """Start recording spans (and their peak memory, with `memory`)."""
+    global _enabled, _memory
+    if memory:
+        import tracemalloc
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+    _enabled, _memory = True, memory
+
+def disable():
+    global _enabled, _memory
+    _enabled = _memory = False
+
+def events():
+    """Return the recorded span events."""
+    return list(_events)
+
+def clear():
+    del _events[:]
+
+def write_trace(filename):
+    """Write the recorded spans as a Chrome trace event file."""
+    with open(filename, 'w') as f:
+        json.dump({'traceEvents': _events, 'displayTimeUnit': 'ms'}, f)
+
+def summary():
+    """Return a `pandas.DataFrame` of totals per span name."""
+    import pandas
+    frame = pandas.DataFrame([
+        dict(event['args'], name=event['name'], seconds=event['dur'] / 1e6)
+        for event in _events])
+    if frame.empty:
+        return frame
+    aggregations = {'calls': ('seconds', 'size'),
+                    'seconds': ('seconds', 'sum'),
+                    'cpu_seconds': ('cpu_seconds', 'sum'),
+                    'items': ('items', 'sum')}
+    if 'peak_memory' in frame:
+        aggregations['peak_memory'] = ('peak_memory', 'max')
+    return frame.groupby('name').agg(**aggregations) \
+                .sort_values('seconds', ascending=False)
+
+# # Sampling profiler
+
+class Sampler(object):
+    """Sample a thread's Python stack on a timer, count folded stacks.
+
+    Constructor arguments:
+
+    -   **`interval`** is the time between samples in seconds.
+
+    -   **`thread_id`** is the thread to sample; defaults to the calling
+        thread.
+
+    """
+
+    def __init__(self, interval=0.005, thread_id=None):
+        self.interval = interval
+        self.thread_id = thread_id or threading.get_ident()
+        self.counts = collections.Counter()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append('{} ({}:{})'.format(
+                    code.co_name, os.path.basename(code.co_filename),
+                    code.co_firstlineno))
+                frame = frame.f_back
+            self.counts[';'.join(reversed(stack))] += 1
+
+    def write(self, filename):
+        """Write the samples as folded stacks, one `stack count` per line."""
+        with open(filename, 'w') as f:
+            for stack, count in self.counts.most_common():
+                f.write('{} {}\n'.format(stack, count))
+
+def _configure():
+    trace_file = os.environ.get('PATENT_TRACE')
+    if trace_file:
+        enable(memory=os.environ.get('PATENT_TRACE_MEMORY') == '1')
+        atexit.register(write_trace, trace_file)
+    profile_file = os.environ.get('PATENT_PROFILE')
+    if profile_file:
+        interval = float(os.environ.get('PATENT_PROFILE_INTERVAL', 0.005))
+        sampler = Sampler(interval, threading.main_thread().ident).start()
+        def finish():
+            sampler.stop()
+            sampler.write(profile_file)
+        atexit.register(finish)
+
+_configure()
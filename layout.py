@@ -0,0 +1,321 @@
+"""Force-directed layout and headless rendering of neighborhood clusters.
+
+The layout is Fruchterman-Reingold with repulsion approximated on a
+hierarchy of grids, in the spirit of Barnes-Hut: nodes are binned into
+equal-count cells of a few nodes each, repulsion between nodes in adjacent
+cells is exact, and otherwise cells act as single bodies at their
+centroids, at the coarsest level (blocks of blocks of cells, and so on)
+where they are still not adjacent. Each cell interacts with a bounded
+number of cells per level and the levels shrink geometrically, so with
+every force a NumPy array operation an iteration costs O(n + m) for n
+nodes and m edges instead of O(n^2).
+
+Layouts are cached by cluster membership and layout parameters, in memory
+and in `PATENT_LAYOUT_DIR`, so re-rendering a cluster with another coloring
+does not lay it out again. Rendering uses the Agg canvas directly and needs
+no display.
+
+"""
+import os
+import os.path
+import hashlib
+
+import numpy
+import pandas
+
+import nhood
+from csrgraph import as_csr, expand_ranges
+
+ITERATIONS = 300
+FORMATS = ('png', 'pdf')
+CELL_OCCUPANCY = 4 # average nodes per grid cell
+COARSE_GROUP = 4 # cells per cell of the next level, along each axis
+
+def force_layout(n, src, dst, iterations=ITERATIONS, seed=0):
+    """Return an `(n, 2)` array of node positions in the unit square.
+
+    -   **`src`**, **`dst`** are edge endpoints as int arrays of node indices;
+        direction is ignored.
+
+    -   **`iterations`** is the number of cooling steps.
+
+    """
+    rng = numpy.random.RandomState(seed)
+    if n < 2:
+        return rng.rand(n, 2)
+    src, dst = numpy.asarray(src), numpy.asarray(dst)
+    # Ideal edge length 1, in a square of area n.
+    width = numpy.sqrt(n)
+    pos = rng.rand(n, 2) * width
+    side = max(int(numpy.sqrt(n / CELL_OCCUPANCY)), 1)
+    pairs = _cell_pairs(side, COARSE_GROUP)
+    temperature = width / 10
+    cooling = temperature / (iterations + 1)
+    for _ in range(iterations):
+        delta = _repulsion(pos, side, pairs)
+
+        # Attraction, d^2, along edges.
+        diff = pos[src] - pos[dst]
+        dist = numpy.sqrt(numpy.maximum((diff ** 2).sum(axis=1), 1e-12))
+        force = dist[:, None] * diff
+        for axis in (0, 1):
+            delta[:, axis] += (
+                numpy.bincount(dst, weights=force[:, axis], minlength=n)
+                - numpy.bincount(src, weights=force[:, axis], minlength=n))
+
+        # Gravity keeps disconnected parts of the cluster in view.
+        delta += (pos.mean(axis=0) - pos) / width
+
+        length = numpy.sqrt(numpy.maximum((delta ** 2).sum(axis=1), 1e-12))
+        pos += delta * (numpy.minimum(length, temperature) / length)[:, None]
+        temperature -= cooling
+    low, high = pos.min(axis=0), pos.max(axis=0)
+    return (pos - low) / numpy.maximum(high - low, 1e-12).max()
+
+def _grid(pos, side):
+    """Bin positions into a `side` x `side` grid of equal-count cells.
+
+    Nodes are split into `side` strips by x rank, and each strip into
+    `side` cells by y rank, so every cell holds about `n / side**2` nodes
+    however unevenly the nodes are spread.
+
+    """
+    n = len(pos)
+    strip = numpy.empty(n, dtype=numpy.int64)
+    strip[numpy.argsort(pos[:, 0], kind='mergesort')] = \
+        numpy.arange(n) * side // n
+    order = numpy.lexsort((pos[:, 1], strip))
+    starts = numpy.searchsorted(strip[order], strip[order])
+    sizes = numpy.bincount(strip, minlength=side)[strip[order]]
+    cells = numpy.empty((n, 2), dtype=numpy.int64)
+    cells[order, 0] = strip[order]
+    cells[order, 1] = (numpy.arange(n) - starts) * side // sizes
+    return cells
+
+def _cell_pairs(side, group):
+    """Return the cell pairs interacting through centroids, per level.
+
+    Level `k` has cells of `group**k` x `group**k` fine cells. The result
+    is a list of `(factor, a, b)` with `factor = group**k`, pairing level-`k`
+    cells that are not adjacent but whose level-`k + 1` cells are. Together
+    with exact node pairs in adjacent fine cells, every pair of nodes is
+    counted once.
+
+    """
+    levels = []
+    reach = 2 * group - 1
+    factor = 1
+    while -(-side // factor) > 2:
+        level_side = -(-side // factor)
+        cell = numpy.arange(level_side * level_side)
+        x, y = cell // level_side, cell % level_side
+        a, b = [], []
+        for dx in range(-reach, reach + 1):
+            for dy in range(-reach, reach + 1):
+                if abs(dx) <= 1 and abs(dy) <= 1:
+                    continue
+                ox, oy = x + dx, y + dy
+                keep = ((ox >= 0) & (ox < level_side)
+                        & (oy >= 0) & (oy < level_side)
+                        & (numpy.abs(ox // group - x // group) <= 1)
+                        & (numpy.abs(oy // group - y // group) <= 1))
+                a.append(cell[keep])
+                b.append(ox[keep] * level_side + oy[keep])
+        levels.append((factor, numpy.concatenate(a), numpy.concatenate(b)))
+        factor *= group
+    return levels
+
+def _repulsion(pos, side, pairs):
+    """Return the repulsive displacement, 1 / d per pair, of every node."""
+    cells = _grid(pos, side)
+    delta = _near_repulsion(pos, cells, cells[:, 0] * side + cells[:, 1],
+                            side)
+    for factor, a, b in pairs:
+        level_side = -(-side // factor)
+        level = cells // factor
+        ids = level[:, 0] * level_side + level[:, 1]
+        delta += _body_repulsion(pos, ids, level_side ** 2, a, b)[ids]
+    return delta
+
+def _near_repulsion(pos, cells, cell_id, side):
+    """Exact repulsion between nodes in the same or adjacent cells."""
+    n = len(pos)
+    order = numpy.argsort(cell_id, kind='mergesort')
+    indptr = numpy.searchsorted(cell_id[order], numpy.arange(side * side + 1))
+    delta = numpy.zeros_like(pos)
+    for dx in (-1, 0, 1):
+        for dy in (-1, 0, 1):
+            other = cells + (dx, dy)
+            nodes = numpy.flatnonzero(((other >= 0) & (other < side))
+                                      .all(axis=1))
+            owner, positions = expand_ranges(
+                indptr, other[nodes, 0] * side + other[nodes, 1])
+            i, j = nodes[owner], order[positions]
+            i, j = i[i != j], j[i != j]
+            diff = pos[i] - pos[j]
+            dist2 = numpy.maximum((diff ** 2).sum(axis=1), 1e-12)
+            force = diff / dist2[:, None]
+            for axis in (0, 1):
+                delta[:, axis] += numpy.bincount(i, weights=force[:, axis],
+                                                 minlength=n)
+    return delta
+
+def _body_repulsion(pos, ids, size, a, b):
+    """Return the repulsion on each of `size` cells from the cells it is
+    paired with, each acting as its node count placed at its centroid."""
+    counts = numpy.bincount(ids, minlength=size)
+    centroid = numpy.stack([
+        numpy.bincount(ids, weights=pos[:, axis], minlength=size)
+        for axis in (0, 1)], axis=1) / numpy.maximum(counts, 1)[:, None]
+    occupied = (counts[a] > 0) & (counts[b] > 0)
+    a, b = a[occupied], b[occupied]
+    diff = centroid[a] - centroid[b]
+    dist2 = numpy.maximum((diff ** 2).sum(axis=1), 1e-12)
+    force = diff * (counts[b] / dist2)[:, None]
+    return numpy.stack([
+        numpy.bincount(a, weights=force[:, axis], minlength=size)
+        for axis in (0, 1)], axis=1)
+
+def layout_key(labels, src, dst, iterations=ITERATIONS, seed=0):
+    """Return a hex key for a cluster's membership, edges and parameters."""
+    digest = hashlib.sha1()
+    for array in (labels, src, dst):
+        digest.update(numpy.ascontiguousarray(array, dtype=numpy.int64)
+                           .tobytes())
+        digest.update(b'|')
+    digest.update('{}:{}'.format(iterations, seed).encode())
+    return digest.hexdigest()
+
+class LayoutCache(object):
+    """Layouts keyed by `layout_key`, in memory and optionally on disk.
+
+    Constructor arguments:
+
+    -   **`directory`** stores layouts as `.npy` files; defaults to
+        `PATENT_LAYOUT_DIR` (`~/.cache/patentdata/layouts`). Pass `''` to
+        keep layouts in memory only.
+
+    """
+
+    def __init__(self, directory=None):
+        if directory is None:
+            directory = os.environ.get('PATENT_LAYOUT_DIR',
+                os.path.expanduser('~/.cache/patentdata/layouts'))
+        self.directory = directory
+        self._layouts = {}
+
+    def get(self, labels, src, dst, iterations=ITERATIONS, seed=0):
+        """Return positions for a cluster, computing them on a miss.
+
+        `labels` must be sorted; `src` and `dst` index into it.
+
+        """
+        key = layout_key(labels, src, dst, iterations, seed)
+        if key in self._layouts:
+            return self._layouts[key]
+        path = (os.path.join(self.directory, key + '.npy')
+                if self.directory else None)
+        if path and os.path.exists(path):
+            pos = numpy.load(path)
+        else:
+            pos = force_layout(len(labels), src, dst, iterations, seed)
+            if path:
+                os.makedirs(self.directory, exist_ok=True)
+                tmp = path + '.tmp.npy'
+                numpy.save(tmp, pos)
+                os.replace(tmp, path)
+        self._layouts[key] = pos
+        return pos
+
+class ClusterSet(object):
+    """The neighborhood clusters of the highest-indegree nodes.
+
+    Indegrees and all neighborhoods are computed once, in the constructor,
+    and shared by every cluster index.
+
+    Constructor arguments:
+
+    -   **`graph`** is a `networkx.DiGraph` or `csrgraph.CSRGraph`.
+
+    -   **`top`** is the number of highest-indegree seeds.
+
+    -   **`depth`** and **`closed`** are passed to
+        `nhood.neighborhood_sets`.
+
+    """
+
+    def __init__(self, graph, top=10, depth=1, closed=False):
+        self.graph = csr = as_csr(graph)
+        self.indegrees = pandas.Series(csr.in_degree_array(),
+                                       index=csr.labels, name='indegree')
+        # Ascending, so that index 1 is the highest indegree as in
+        # `code.visualize_cluster`.
+        self.roots = self.indegrees.sort_values(kind='mergesort') \
+                                   .tail(top).index
+        self.nhoods = nhood.neighborhood_sets(csr, self.roots, depth, closed)
+
+    def __len__(self):
+        return len(self.roots)
+
+    def root(self, index):
+        return self.roots[-index]
+
+    def cluster(self, index):
+        """Return `(labels, src, dst)` of a cluster's induced subgraph.
+
+        `labels` is sorted, and `src` and `dst` index into it.
+
+        """
+        nodes = list(self.nhoods[self.root(index)])
+        members = numpy.sort(self.graph.ids(nodes))
+        keep = numpy.zeros(len(self.graph.labels), dtype=bool)
+        keep[members] = True
+        owner, positions = expand_ranges(self.graph.indptr, members)
+        dst = self.graph.indices[positions]
+        inside = keep[dst]
+        return (self.graph.labels[members], owner[inside],
+                numpy.searchsorted(members, dst[inside]))
+
+def draw(ax, pos, src, dst, colors):
+    """Draw a laid-out cluster onto matplotlib axes."""
+    from matplotlib.collections import LineCollection
+    ax.add_collection(LineCollection(
+        numpy.stack([pos[src], pos[dst]], axis=1), linewidths=.7, alpha=.7,
+        colors='k'))
+    ax.scatter(pos[:, 0], pos[:, 1], s=50, c=colors, zorder=2)
+    ax.set_xlim(-.02, 1.02)
+    ax.set_ylim(-.02, 1.02)
+    ax.set_axis_off()
+
+def render(filename, pos, src, dst, colors, size=8):
+    """Render a laid-out cluster to `filename` without a display."""
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    figure = Figure(figsize=(size, size))
+    FigureCanvasAgg(figure)
+    draw(figure.add_subplot(1, 1, 1), pos, src, dst, colors)
+    figure.savefig(filename)
+
+def render_all(graph, directory, top=10, formats=FORMATS, cache=None,
+               iterations=ITERATIONS, seed=0):
+    """Render every cluster of a `ClusterSet`, colored by indegree within
+    the cluster, to `cluster<index>.<format>` files in `directory`.
+
+    Return the list of files written.
+
+    """
+    clusters = graph if isinstance(graph, ClusterSet) else ClusterSet(graph,
+                                                                      top)
+    cache = cache if cache is not None else LayoutCache()
+    os.makedirs(directory, exist_ok=True)
+    written = []
+    for index in range(1, len(clusters) + 1):
+        labels, src, dst = clusters.cluster(index)
+        pos = cache.get(labels, src, dst, iterations, seed)
+        colors = numpy.bincount(dst, minlength=len(labels))
+        for extension in formats:
+            filename = os.path.join(directory, 'cluster{}.{}'.format(
+                index, extension))
+            render(filename, pos, src, dst, colors)
+            written.append(filename)
+    return written
@@ -1,35 +1,22 @@
 import os
-import time
-import contextlib
 
 import pandas
-import networkx
 
 import analysis
-
-@contextlib.contextmanager
-def timed(description):
-    """Print timing information on code within the context."""
-    print('{}...'.format(description), end='', flush=True)
-    start = time.clock()
-    yield
-    end = time.clock()
-    print('done after {} seconds.'.format(end - start))
+import dataio
+import instrument
+from dataio import timed
 
 def read_graph(filename):
     """Read edgelist from tsv file, return a networkx.DiGraph."""
-    frame = read_tsv(filename)
-    clean_frame = frame.dropna() # ignore missing data
-    edgelist = [
-        (int(src), int(dst)) # convert edges to integers
-        for src, dst in clean_frame.values.tolist()
-    ]
-    return networkx.DiGraph(edgelist)
+    return dataio.read_graph(filename)
 
+@instrument.traced('main.read_metadata', items=len)
 def read_metadata(filename, index_col='applnID'):
     """Read metadata from tsv file and return a pandas.DataFrame."""
     return read_tsv(filename, index_col=index_col)
 
+@instrument.traced('main.read_tsv', items=len)
 def read_tsv(filename, index_col=None):
     """Return a pandas.DataFrame of a tsv file."""
     return pandas.read_csv(filename,
@@ -87,7 +74,7 @@ def main():
     #  'j'], dtype='object')}
 
     with timed('Analyzing...\n'):
-        analysis.AnnotatedNetwork(graph, metadata).report()
+        print(analysis.AnnotatedNetwork(graph, metadata).report())
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,256 @@
+"""Search path counts and main path analysis.
+
+Knowledge flows along citations from the cited patent to the citing one.
+For each flow edge `u -> v`, the search path count weights of Hummon &
+Doreian and Batagelj are `n_minus(u) * n_plus(v)`, where `n_minus(u)`
+counts paths reaching `u` and `n_plus(v)` counts paths leaving `v`:
+
+-   **SPC**: paths from sources (patents citing nothing) to sinks (patents
+    never cited).
+
+-   **SPLC**: paths from any patent to a sink.
+
+-   **SPNP**: paths from any patent to any patent.
+
+Both counters are computed in two sweeps over a topological order, one
+forward and one backward. The sweeps visit the nodes level by level with
+array operations, so the whole computation is linear in the size of the
+graph. Counts are kept as float64, which holds the huge path counts of real
+citation graphs; an `OverflowError` is raised rather than returning
+infinite weights.
+
+The citation graph should be a DAG, but data errors create a few cycles.
+They are broken first: inside each strongly connected component, flow edges
+that go from a later patent to an earlier one (by filing date, then label)
+are dropped.
+
+"""
+import numpy
+import pandas
+import scipy.sparse
+import scipy.sparse.csgraph
+
+from csrgraph import as_csr, expand_ranges
+
+WEIGHTS = ('spc', 'splc', 'spnp')
+
+class SearchPaths(object):
+    """Search path count weights of a citation graph.
+
+    Constructor arguments:
+
+    -   **`graph`** is a `networkx.DiGraph` or `csrgraph.CSRGraph`.
+
+    -   **`dates`** optionally is a `pandas.Series` of filing dates indexed
+        by node, used to orient edges when breaking cycles.
+
+    Attributes: `edges`, a `pandas.DataFrame` with one row per kept flow
+    edge (`cited`, `citing` and the `WEIGHTS` columns), and `removed`, a
+    `pandas.DataFrame` of the citations dropped to break cycles.
+
+    """
+
+    def __init__(self, graph, dates=None):
+        self.graph = csr = as_csr(graph)
+        n = csr.number_of_nodes()
+        citing, cited = csr.edge_ids()
+        keep = _acyclic_mask(csr, citing, cited, dates)
+        self.removed = pandas.DataFrame({
+            'cited': csr.labels[cited[~keep]],
+            'citing': csr.labels[citing[~keep]],
+        }, columns=['cited', 'citing'])
+
+        # Flow edges u -> v (v cites u). In forward CSR order, the flow
+        # predecessors of v are its citations; reverse CSR holds the flow
+        # successors. Carry the keep mask over to the reverse order.
+        self._forward_keep = keep
+        reverse_keep = numpy.ones(len(csr.rindices), dtype=bool)
+        if not keep.all():
+            forward_keys = citing.astype(numpy.int64) * n + cited
+            rrows = numpy.repeat(numpy.arange(n), numpy.diff(csr.rindptr))
+            reverse_keys = csr.rindices.astype(numpy.int64) * n + rrows
+            dropped = numpy.sort(forward_keys[~keep])
+            reverse_keep = ~numpy.isin(reverse_keys, dropped)
+        self._reverse_keep = reverse_keep
+        self.levels = self._topological_levels()
+
+        # bincount and products saturate to inf without raising a floating
+        # point error, so check the results explicitly.
+        counts = {}
+        for name, forward, every_node in (('source', True, False),
+                                          ('origin', True, True),
+                                          ('sink', False, False),
+                                          ('target', False, True)):
+            counts[name] = _finite(self._sweep(forward, every_node),
+                                   'Search path counts')
+        u, v = cited[keep], citing[keep]
+        with numpy.errstate(over='ignore'):
+            weights = {
+                'spc': counts['source'][u] * counts['sink'][v],
+                'splc': counts['origin'][u] * counts['sink'][v],
+                'spnp': counts['origin'][u] * counts['target'][v],
+            }
+        for name in WEIGHTS:
+            _finite(weights[name], 'Search path weights')
+        self.edges = pandas.DataFrame(dict(weights, cited=csr.labels[u],
+                                           citing=csr.labels[v]),
+                                      columns=['cited', 'citing']
+                                              + list(WEIGHTS))
+        self._u, self._v = u, v
+        self._edge_index = pandas.Series(
+            numpy.arange(len(u)), index=u.astype(numpy.int64) * n + v)
+
+    def _flow_predecessors(self, nodes):
+        """Return `(owner, predecessor)` flow edges into `nodes`."""
+        owner, positions = expand_ranges(self.graph.indptr, nodes)
+        keep = self._forward_keep[positions]
+        return owner[keep], self.graph.indices[positions[keep]]
+
+    def _flow_successors(self, nodes):
+        """Return `(owner, successor)` flow edges out of `nodes`."""
+        owner, positions = expand_ranges(self.graph.rindptr, nodes)
+        keep = self._reverse_keep[positions]
+        return owner[keep], self.graph.rindices[positions[keep]]
+
+    def _topological_levels(self):
+        """Return a list of node id arrays in topological (flow) order."""
+        n = self.graph.number_of_nodes()
+        remaining = numpy.bincount(
+            numpy.repeat(numpy.arange(n), numpy.diff(self.graph.indptr))
+            [self._forward_keep], minlength=n)
+        frontier = numpy.flatnonzero(remaining == 0)
+        levels = []
+        while len(frontier):
+            levels.append(frontier)
+            _, successors = self._flow_successors(frontier)
+            remaining -= numpy.bincount(successors, minlength=n)
+            released = numpy.unique(successors)
+            frontier = released[remaining[released] == 0]
+        if sum(len(level) for level in levels) != n:
+            raise ValueError('Graph still has cycles after cycle breaking')
+        return levels
+
+    def _sweep(self, forward, every_node):
+        """Count paths into (`forward`) or out of each node.
+
+        With `every_node`, every node starts a path; otherwise only sources
+        (forward) or sinks (backward) do.
+
+        """
+        n = self.graph.number_of_nodes()
+        counts = numpy.zeros(n, dtype=numpy.float64)
+        levels = self.levels if forward else self.levels[::-1]
+        neighbors = (self._flow_predecessors if forward
+                     else self._flow_successors)
+        for level in levels:
+            owner, other = neighbors(level)
+            total = numpy.bincount(owner, weights=counts[other],
+                                   minlength=len(level))
+            has_neighbors = numpy.bincount(owner, minlength=len(level)) > 0
+            start = 1.0 if every_node else (~has_neighbors).astype(float)
+            counts[level] = total + start
+        return counts
+
+    # # Main paths
+
+    def _best_paths(self, weights, forward):
+        """Return `(score, pointer)` of the heaviest path into (`forward`)
+        or out of each node; `pointer` is the next node back toward the
+        path's start, or -1."""
+        n = self.graph.number_of_nodes()
+        score = numpy.zeros(n)
+        pointer = numpy.full(n, -1, dtype=numpy.int64)
+        levels = self.levels if forward else self.levels[::-1]
+        neighbors = (self._flow_predecessors if forward
+                     else self._flow_successors)
+        for level in levels:
+            owner, other = neighbors(level)
+            if not len(owner):
+                continue
+            nodes = level[owner]
+            keys = (other.astype(numpy.int64) * n + nodes if forward
+                    else nodes.astype(numpy.int64) * n + other)
+            value = score[other] + weights[self._edge_index.loc[keys].values]
+            order = numpy.lexsort((other, -value, owner))
+            first = numpy.ones(len(order), dtype=bool)
+            first[1:] = owner[order][1:] != owner[order][:-1]
+            chosen = order[first]
+            score[nodes[chosen]] = value[chosen]
+            pointer[nodes[chosen]] = other[chosen]
+        return score, pointer
+
+    def _trace(self, pointer, node):
+        path = [node]
+        while pointer[path[-1]] >= 0:
+            path.append(pointer[path[-1]])
+        return path
+
+    def global_main_path(self, weight='spc'):
+        """Return the heaviest source-to-sink path as a list of labels."""
+        weights = self.edges[weight].values
+        score, pointer = self._best_paths(weights, forward=True)
+        end = int(numpy.argmax(score))
+        return self.graph.labels[self._trace(pointer, end)[::-1]].tolist()
+
+    def key_route_main_paths(self, weight='spc', routes=10):
+        """Return the key-route main path network.
+
+        The `routes` heaviest edges are key routes; each is extended
+        backward along the heaviest path reaching it and forward along the
+        heaviest path leaving it. Return a `pandas.DataFrame` of the distinct
+        edges on those paths with their weight.
+
+        """
+        weights = self.edges[weight].values
+        _, into = self._best_paths(weights, forward=True)
+        _, out_of = self._best_paths(weights, forward=False)
+        top = numpy.argsort(-weights, kind='mergesort')[:routes]
+        edges = set()
+        for e in top:
+            path = (self._trace(into, self._u[e])[::-1]
+                    + self._trace(out_of, self._v[e]))
+            edges.update(zip(path[:-1], path[1:]))
+        u = numpy.array([a for a, _ in sorted(edges)], dtype=numpy.int64)
+        v = numpy.array([b for _, b in sorted(edges)], dtype=numpy.int64)
+        n = self.graph.number_of_nodes()
+        return pandas.DataFrame({
+            'cited': self.graph.labels[u],
+            'citing': self.graph.labels[v],
+            weight: weights[self._edge_index.loc[u * n + v].values],
+        }, columns=['cited', 'citing', weight]).sort_values(
+            weight, ascending=False).reset_index(drop=True)
+
+def _finite(values, what):
+    """Return `values`, raising `OverflowError` if any is infinite."""
+    if not numpy.isfinite(values).all():
+        raise OverflowError('{} exceed float64'.format(what))
+    return values
+
+def _acyclic_mask(csr, citing, cited, dates):
+    """Return a mask over forward edges that leaves the flow graph acyclic.
+
+    Only edges inside nontrivial strongly connected components are
+    candidates for removal; of those, a flow edge is kept only if the cited
+    patent precedes the citing one by (filing date, label).
+
+    """
+    n = csr.number_of_nodes()
+    adjacency = scipy.sparse.csr_matrix(
+        (numpy.ones(len(csr.indices), dtype=numpy.int8), csr.indices,
+         csr.indptr), shape=(n, n))
+    _, component = scipy.sparse.csgraph.connected_components(
+        adjacency, directed=True, connection='strong')
+    keep = component[citing] != component[cited]
+    inside = ~keep
+    if not inside.any():
+        return keep
+    rank = numpy.arange(n)
+    if dates is not None:
+        dates = pandas.to_datetime(dates).dropna()
+        dates = dates[~dates.index.duplicated(keep='first')]
+        node_dates = dates.reindex(csr.labels).values.astype('datetime64[ns]')
+        # NaT sorts last; ties fall back to the label order.
+        rank = numpy.empty(n, dtype=numpy.int64)
+        rank[numpy.lexsort((numpy.arange(n), node_dates))] = numpy.arange(n)
+    keep[inside] = rank[cited[inside]] < rank[citing[inside]]
+    return keep
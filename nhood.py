@@ -0,0 +1,123 @@
+"""Frontier-based neighborhood computations.
+
+The neighborhood of a node grows by following citations backwards: the
+1-neighborhood of a patent is the set of patents citing it, the
+2-neighborhood adds the patents citing those, and so on. Each expansion only
+visits the newly discovered nodes (the frontier), so every node is expanded
+at most once per root.
+
+"""
+import numpy
+import pandas
+import scipy.sparse
+
+from csrgraph import as_csr
+
+ROOT_BATCH_SIZE = 256 # roots propagated together by the batched functions
+
+def neighborhood_layers(graph, root, depth=1):
+    """Return the layers of a node's neighborhood as a list of sets.
+
+    Layer 0 is `{root}` and layer `k` holds the nodes first reached after
+    `k` expansions, so the union of layers `0..k` is the closed
+    `k`-neighborhood. Works with either graph backend.
+
+    """
+    layers = [set([root])]
+    seen = set(layers[0])
+    for _ in range(depth):
+        frontier = set()
+        for node in layers[-1]:
+            frontier.update(graph.predecessors(node))
+        frontier -= seen
+        if not frontier:
+            break
+        seen |= frontier
+        layers.append(frontier)
+    return layers
+
+def neighborhood(graph, root, depth=1, closed=False):
+    """Return the `depth`-neighborhood of a node as a set."""
+    nhood = set().union(*neighborhood_layers(graph, root, depth))
+    if not closed:
+        nhood.discard(root)
+    return nhood
+
+def predecessor_matrix(graph):
+    """Return a sparse matrix `P` with `P[i, j] = 1` if `j` cites `i`.
+
+    Rows and columns follow the dense ids of `csrgraph.as_csr(graph)`.
+
+    """
+    csr = as_csr(graph)
+    n = csr.number_of_nodes()
+    data = numpy.ones(len(csr.rindices), dtype=numpy.int32)
+    return scipy.sparse.csr_matrix((data, csr.rindices, csr.rindptr),
+                                   shape=(n, n))
+
+def _propagate(graph, roots, depth, batch_size):
+    """Yield `(labels, visited_by_depth)` for batches of roots.
+
+    `visited_by_depth[k]` is a sparse boolean matrix whose row `r` marks the
+    closed `k`-neighborhood of `labels[r]`.
+
+    """
+    csr = as_csr(graph)
+    pred = predecessor_matrix(csr)
+    n = csr.number_of_nodes()
+    roots = numpy.asarray(list(csr.nbunch_iter(roots)), dtype=numpy.int64)
+    for start in range(0, len(roots), batch_size):
+        labels = roots[start:start+batch_size]
+        ids = csr.ids(labels)
+        k = len(ids)
+        frontier = scipy.sparse.csr_matrix(
+            (numpy.ones(k, dtype=numpy.int32), (numpy.arange(k), ids)),
+            shape=(k, n))
+        visited = frontier.copy()
+        history = [visited]
+        for _ in range(depth):
+            reached = frontier @ pred
+            reached.data[:] = 1
+            frontier = reached - reached.multiply(visited)
+            frontier.eliminate_zeros()
+            visited = visited + frontier
+            history.append(visited)
+        yield labels, history
+
+def neighborhood_sizes(graph, roots, depth=1, closed=False,
+                       batch_size=ROOT_BATCH_SIZE):
+    """Return the sizes of the 1..`depth` neighborhoods of many roots.
+
+    One traversal gives every depth: the result is a `pandas.DataFrame`
+    indexed by root with columns `'1-nhood'` to `'{depth}-nhood'`. Roots are
+    propagated together in batches of `batch_size` as sparse frontier
+    matrices over the predecessor adjacency.
+
+    """
+    frames = []
+    for labels, history in _propagate(graph, roots, depth, batch_size):
+        offset = 0 if closed else 1
+        frames.append(pandas.DataFrame({
+            '{}-nhood'.format(d): history[d].getnnz(axis=1) - offset
+            for d in range(1, depth + 1)
+        }, index=labels))
+    if not frames:
+        return pandas.DataFrame(columns=['{}-nhood'.format(d)
+                                         for d in range(1, depth + 1)])
+    return pandas.concat(frames)
+
+def neighborhood_sets(graph, roots, depth=1, closed=False,
+                      batch_size=ROOT_BATCH_SIZE):
+    """Return a dict mapping each root to its `depth`-neighborhood set."""
+    csr = as_csr(graph)
+    result = {}
+    for labels, history in _propagate(csr, roots, depth, batch_size):
+        visited = history[-1].tocsr()
+        for row, root in enumerate(labels.tolist()):
+            members = visited.indices[visited.indptr[row]:
+                                      visited.indptr[row+1]]
+            nhood = set(csr.labels[members].tolist())
+            if not closed:
+                nhood.discard(root)
+            result[root] = nhood
+    return result
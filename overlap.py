@@ -0,0 +1,172 @@
+"""Overlap statistics for collections of node clusters.
+
+All statistics derive from a single pass that counts, for every node, how
+many clusters contain it. A node is unique to its cluster when that count is
+one; pairwise intersections come from the sparse cluster-by-node incidence
+matrix. For very many clusters, pairwise Jaccard similarities can instead be
+estimated from MinHash signatures, comparing only the candidate pairs that
+locality-sensitive hashing (LSH) puts in a common bucket.
+
+"""
+import numpy
+import pandas
+import scipy.sparse
+
+from anf import hash64
+
+MINHASH_PERMUTATIONS = 128
+MINHASH_BANDS = 64 # LSH bands of `MINHASH_PERMUTATIONS // MINHASH_BANDS` rows
+MINHASH_BLOCK = 1 << 16 # candidate pairs compared per block
+
+def incidence(clusters):
+    """Return `(keys, labels, matrix)` for a dict of iterables.
+
+    `matrix` is a sparse boolean cluster-by-node matrix with rows following
+    `keys` and columns following the sorted node `labels`. Repeated members
+    of a cluster are counted once.
+
+    """
+    keys = list(clusters)
+    members = [numpy.unique(numpy.fromiter(clusters[key], dtype=numpy.int64))
+               for key in keys]
+    sizes = numpy.array([len(m) for m in members], dtype=numpy.int64)
+    flat = (numpy.concatenate(members) if members
+            else numpy.empty(0, dtype=numpy.int64))
+    labels, columns = numpy.unique(flat, return_inverse=True)
+    rows = numpy.repeat(numpy.arange(len(keys)), sizes)
+    matrix = scipy.sparse.csr_matrix(
+        (numpy.ones(len(flat), dtype=numpy.int32), (rows, columns)),
+        shape=(len(keys), len(labels)))
+    return keys, labels, matrix
+
+def overlap_table(clusters):
+    """Return per-cluster overlap statistics as a `pandas.DataFrame`.
+
+    Columns are `size`, `unique` (members in no other cluster),
+    `percentunique` (`unique / size`) and `bignodes` (how many of the
+    cluster keys are members, as in `code.analyze_nhood_overlap`).
+
+    """
+    keys, labels, matrix = incidence(clusters)
+    counts = numpy.asarray(matrix.sum(axis=0)).ravel()
+    sizes = numpy.diff(matrix.indptr)
+    unique = matrix @ (counts == 1).astype(numpy.int64)
+    is_key = numpy.isin(labels, numpy.asarray(keys, dtype=numpy.int64))
+    bignodes = matrix @ is_key.astype(numpy.int64)
+    return pandas.DataFrame({
+        'size': sizes,
+        'unique': unique,
+        'percentunique': unique / numpy.maximum(sizes, 1),
+        'bignodes': bignodes,
+    }, index=keys, columns=['size', 'unique', 'percentunique', 'bignodes'])
+
+def pairwise_overlap(clusters, approximate=False,
+                     num_perm=MINHASH_PERMUTATIONS, seed=0,
+                     bands=MINHASH_BANDS):
+    """Return intersection sizes and Jaccard similarity of cluster pairs.
+
+    The result is a `pandas.DataFrame` with one row per unordered pair that
+    shares at least one member (exact mode) or has a nonzero estimated
+    similarity (approximate mode), with columns `a`, `b`, `intersection`
+    and `jaccard`. With `approximate=True`, Jaccard similarity is estimated
+    from `num_perm` MinHash values and intersections are derived from it
+    and the exact cluster sizes. Only pairs that LSH with `bands` bands
+    selects as candidates are estimated (see `minhash_jaccard`), so pairs
+    of low similarity are likely to be missing.
+
+    """
+    keys, labels, matrix = incidence(clusters)
+    sizes = numpy.diff(matrix.indptr).astype(numpy.float64)
+    if approximate:
+        signatures = minhash_signatures(matrix, labels, num_perm, seed)
+        a, b, jaccard = minhash_jaccard(signatures, bands)
+        intersection = jaccard / (1 + jaccard) * (sizes[a] + sizes[b])
+    else:
+        products = scipy.sparse.triu(matrix @ matrix.T, k=1).tocoo()
+        a, b = products.row, products.col
+        intersection = products.data.astype(numpy.float64)
+        jaccard = intersection / (sizes[a] + sizes[b] - intersection)
+    keys = numpy.asarray(keys)
+    return pandas.DataFrame({
+        'a': keys[a],
+        'b': keys[b],
+        'intersection': intersection,
+        'jaccard': jaccard,
+    }, columns=['a', 'b', 'intersection', 'jaccard'])
+
+def minhash_signatures(matrix, labels, num_perm=MINHASH_PERMUTATIONS,
+                       seed=0):
+    """Return a `(clusters, num_perm)` array of MinHash values.
+
+    Each permutation hashes the node labels XORed with its own random salt.
+
+    """
+    rng = numpy.random.RandomState(seed)
+    salts = rng.randint(0, 2**63 - 1, size=num_perm, dtype=numpy.int64)
+    sizes = numpy.diff(matrix.indptr)
+    nonempty = numpy.flatnonzero(sizes)
+    starts = matrix.indptr[:-1][nonempty]
+    members = labels[matrix.indices]
+    signatures = numpy.full((matrix.shape[0], num_perm),
+                            numpy.iinfo(numpy.uint64).max, dtype=numpy.uint64)
+    if len(nonempty):
+        for p, salt in enumerate(salts):
+            hashed = hash64(members ^ salt)
+            signatures[nonempty, p] = numpy.minimum.reduceat(hashed, starts)
+    return signatures
+
+def minhash_jaccard(signatures, bands=MINHASH_BANDS, block=MINHASH_BLOCK):
+    """Return `(a, b, jaccard)` arrays of estimated pairwise similarities.
+
+    The signatures are split into `bands` bands of equal width, and two
+    clusters become a candidate pair when all values of some band agree,
+    which for similarity `s` happens with probability
+    `1 - (1 - s**width)**bands`. Only candidates are compared, `block`
+    pairs at a time, and only pairs `a < b` with a nonzero estimate are
+    returned. Empty clusters are never candidates.
+
+    """
+    k, num_perm = signatures.shape
+    if num_perm % bands:
+        raise ValueError('{} permutations do not split into {} bands'
+                         .format(num_perm, bands))
+    a, b = lsh_candidates(signatures, bands)
+    result_j = [(signatures[a[start:start+block]]
+                 == signatures[b[start:start+block]]).sum(axis=1) / num_perm
+                for start in range(0, len(a), block)]
+    jaccard = (numpy.concatenate(result_j) if result_j
+               else numpy.empty(0))
+    keep = jaccard > 0
+    return a[keep], b[keep], jaccard[keep]
+
+def lsh_candidates(signatures, bands=MINHASH_BANDS):
+    """Return sorted `(a, b)` arrays of the pairs `a < b` that agree on all
+    values of at least one band of their MinHash signatures."""
+    k, num_perm = signatures.shape
+    width = num_perm // bands
+    empty = numpy.iinfo(numpy.uint64).max
+    rows = numpy.flatnonzero((signatures != empty).any(axis=1))
+    codes = []
+    for band in range(bands):
+        # Hash each band to one value; unequal bands that collide only add
+        # candidates, which the comparison then rejects.
+        key = numpy.zeros(len(rows), dtype=numpy.uint64)
+        for column in range(band * width, (band + 1) * width):
+            key = hash64(key ^ signatures[rows, column])
+        order = numpy.argsort(key, kind='mergesort')
+        key = key[order]
+        # Pair every row with the rows after it in the same bucket.
+        bounds = numpy.flatnonzero(numpy.diff(key)) + 1
+        ends = numpy.repeat(numpy.append(bounds, len(key)),
+                            numpy.diff(numpy.concatenate(([0], bounds,
+                                                          [len(key)]))))
+        after = ends - numpy.arange(len(key)) - 1
+        first = numpy.repeat(numpy.arange(len(key)), after)
+        offsets = numpy.arange(len(first)) - numpy.repeat(
+            numpy.cumsum(after) - after, after)
+        second = first + 1 + offsets
+        a, b = rows[order[first]], rows[order[second]]
+        codes.append(numpy.minimum(a, b) * k + numpy.maximum(a, b))
+    codes = (numpy.unique(numpy.concatenate(codes)) if codes
+             else numpy.empty(0, dtype=numpy.int64))
+    return codes // k, codes % k
@@ -0,0 +1,656 @@
+"""Local query server for neighborhoods, classification, degrees and ranks.
+
+The server loads the current snapshot once (see
+`dataio.load_current_snapshot`) and answers JSON queries over HTTP, on a TCP
+port or a Unix socket. Connections are served concurrently by asyncio and
+queries run on a small thread pool, so a slow query does not hold up the
+others.
+
+Queries are `GET /<query>?<parameters>`, where `node` is one node or a
+comma-separated list of nodes:
+
+-   `/neighborhood?node=...&depth=1&closed=0&limit=` returns members of the
+    neighborhoods (see `nhood.neighborhood`).
+
+-   `/classify?node=...&field=appMyName&max_cited=20` predicts a metadata
+    field (see `analysis.AnnotatedNetwork.classify_many`).
+
+-   `/degree?node=...` returns in- and outdegrees.
+
+-   `/pagerank?node=...` returns PageRank scores and ranks.
+
+-   `/top?by=indegree&k=10` returns the top nodes by indegree or pagerank.
+
+-   `/stats` returns request counts and cache statistics.
+
+`POST /batch` takes a JSON list of queries such as `{"query": "degree",
+"node": [1, 2]}` and returns a list with a `result` or an `error` for each.
+
+Neighborhoods are cached in a bounded LRU keyed by `(root, depth,
+closed)`. Behind it is a shared store: Redis through the pooled
+`dataio.redis_client`, so that several servers share results, or a local
+stand-in when Redis is not available.
+
+With `PATENT_DELTA_DIR` set, the server checks for new delta files every
+`--refresh` seconds and applies them (see `ingest`); an
+`ingest.DerivedCache` then evicts only the cached neighborhoods the new
+citations changed, and PageRank is warm-started from the previous scores.
+
+Usage: `python server.py serve --port 8750`, then
+`python server.py loadtest --port 8750` reports p50 and p99 latencies.
+
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import threading
+import collections
+import urllib.parse
+import concurrent.futures
+
+import numpy
+
+import dataio
+
+HOST = '127.0.0.1'
+PORT = 8750
+CACHE_SIZE = 10000 # neighborhoods kept in the in-process LRU
+STORE_SIZE = 100000 # neighborhoods kept by the local stand-in store
+STORE_TTL = 24 * 3600 # seconds a neighborhood lives in Redis
+WORKERS = 4
+REFRESH_INTERVAL = 60 # seconds between checks for new delta files
+QUERIES = ('neighborhood', 'classify', 'degree', 'pagerank', 'top', 'stats')
+REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found',
+           405: 'Method Not Allowed', 500: 'Internal Server Error'}
+
+class LRUCache(object):
+    """A bounded mapping that evicts the least recently used entry.
+
+    Constructor arguments:
+
+    -   **`maxsize`** is the number of entries kept.
+
+    """
+
+    def __init__(self, maxsize=CACHE_SIZE):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._entries[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def __setitem__(self, key, value):
+        self.put(key, value)
+
+    def __delitem__(self, key):
+        with self._lock:
+            del self._entries[key]
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._entries.pop(key, default)
+
+    def __iter__(self):
+        with self._lock:
+            return iter(list(self._entries))
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        return {'size': len(self), 'maxsize': self.maxsize,
+                'hits': self.hits, 'misses': self.misses}
+
+class LocalStore(object):
+    """Stand-in for the Redis client when no Redis server is available.
+
+    Implements the `get` and `set` calls the server makes, on a bounded
+    in-process `LRUCache`; expiry times are ignored.
+
+    """
+
+    def __init__(self, maxsize=STORE_SIZE):
+        self._cache = LRUCache(maxsize)
+
+    def get(self, key):
+        return self._cache.get(key)
+
+    def set(self, key, value, ex=None):
+        self._cache.put(key, value)
+
+class QueryService(object):
+    """Answers queries on a snapshot, caching neighborhoods.
+
+    Constructor arguments:
+
+    -   **`snap`** is a `snapshot.Snapshot`.
+
+    -   **`cache_size`** is the number of neighborhoods in the LRU.
+
+    -   **`store`** is the shared store: a `redis.StrictRedis`-like client
+        with `get` and `set`, by default `dataio.redis_client()` or else a
+        `LocalStore`.
+
+    """
+
+    def __init__(self, snap, cache_size=CACHE_SIZE, store=None):
+        import ingest
+        self.cache = LRUCache(cache_size)
+        self.derived = ingest.DerivedCache(snap, neighborhoods=self.cache)
+        if store is None:
+            store = _redis_store() or LocalStore()
+        self.store = store
+        self.store_hits = 0
+        self.started = time.time()
+        self.counts = collections.Counter()
+        self._ranks = None
+        self._lock = threading.Lock()
+        self._use(snap)
+
+    def _use(self, snap):
+        from analysis import AnnotatedNetwork
+        self.snapshot = snap
+        self.graph = snap.graph
+        self.network = AnnotatedNetwork(self.graph, snap.metadata)
+        self.prefix = '{}nhood:{}:'.format(
+            os.environ.get('PATENT_REDIS_PREFIX', 'patentdata:'), snap.key)
+
+    def refresh(self, delta_dir=None):
+        """Apply the delta files not yet in the served snapshot.
+
+        `delta_dir` defaults to `PATENT_DELTA_DIR`. The derived cache drops
+        the neighborhoods the new edges changed and PageRank is recomputed
+        on the next query, warm-started. Return the number of files
+        applied.
+
+        """
+        import ingest
+        delta_dir = delta_dir or os.environ.get('PATENT_DELTA_DIR')
+        if not delta_dir:
+            return 0
+        edge_files, metadata_files = ingest.pending_files(self.snapshot,
+                                                          delta_dir)
+        if not (edge_files or metadata_files):
+            return 0
+        delta = ingest.apply_delta(self.snapshot,
+                                   os.path.dirname(self.snapshot.path),
+                                   edge_files, metadata_files)
+        with self._lock:
+            self.derived.apply(delta)
+            self._use(delta.snapshot)
+            self._ranks = None
+        return len(edge_files) + len(metadata_files)
+
+    def query(self, name, params):
+        """Run query `name` with a dict of parameters, return its result.
+
+        Raises `KeyError` for unknown nodes and `ValueError` for bad
+        parameters.
+
+        """
+        if name not in QUERIES:
+            raise ValueError('Unknown query: {}'.format(name))
+        self.counts[name] += 1
+        params = dict(params)
+        return getattr(self, 'query_' + name)(**params)
+
+    def batch(self, queries):
+        """Run a list of `{"query": name, ...}` dicts, one result each."""
+        results = []
+        for query in queries:
+            query = dict(query)
+            try:
+                result = self.query(query.pop('query', None), query)
+            except (KeyError, ValueError, TypeError) as exc:
+                results.append({'error': _message(exc)})
+            else:
+                results.append({'result': result})
+        return results
+
+    # # Queries
+
+    def query_neighborhood(self, node, depth=1, closed=False, limit=None):
+        depth, closed = int(depth), _flag(closed)
+        limit = None if limit in (None, '') else int(limit)
+        results = []
+        for root in _nodes(node):
+            members = self.neighborhood(root, depth, closed)
+            shown = members if limit is None else members[:limit]
+            results.append({'node': root, 'size': len(members),
+                            'members': shown.tolist()})
+        return results
+
+    def query_classify(self, node, field='appMyName', max_cited=20):
+        nodes = _nodes(node)
+        if field not in self.network.metadata.columns:
+            raise ValueError('Unknown field: {}'.format(field))
+        predictions = self.network.classify_many(nodes, field,
+                                                 int(max_cited))
+        return [{'node': root, field: _scalar(value)}
+                for root, value in zip(nodes, predictions.values)]
+
+    def query_degree(self, node):
+        graph = self.graph
+        ids = graph.ids(_nodes(node))
+        indegree = graph.rindptr[ids + 1] - graph.rindptr[ids]
+        outdegree = graph.indptr[ids + 1] - graph.indptr[ids]
+        return [{'node': int(label), 'indegree': int(i), 'outdegree': int(o)}
+                for label, i, o in zip(graph.labels[ids], indegree,
+                                       outdegree)]
+
+    def query_pagerank(self, node):
+        graph, scores, ranks = self.ranks()
+        ids = graph.ids(_nodes(node))
+        return [{'node': int(graph.labels[i]),
+                 'pagerank': float(scores[i]), 'rank': int(ranks[i])}
+                for i in ids]
+
+    def query_top(self, by='indegree', k=10):
+        k = int(k)
+        if by == 'indegree':
+            graph = self.graph
+            values = graph.in_degree_array()
+        elif by == 'pagerank':
+            graph, values, _ = self.ranks()
+        else:
+            raise ValueError('Unknown ordering: {}'.format(by))
+        top = numpy.argsort(-values, kind='mergesort')[:k]
+        return [{'node': int(graph.labels[i]), by: _scalar(values[i])}
+                for i in top]
+
+    def query_stats(self):
+        return {'snapshot': self.snapshot.key,
+                'revision': self.snapshot.revision,
+                'nodes': self.graph.number_of_nodes(),
+                'edges': self.graph.number_of_edges(),
+                'uptime': time.time() - self.started,
+                'queries': dict(self.counts),
+                'cache': self.cache.stats(),
+                'store': type(self.store).__name__,
+                'store_hits': self.store_hits}
+
+    # # Cached computations
+
+    def neighborhood(self, root, depth=1, closed=False):
+        """Return a sorted label array of a node's neighborhood.
+
+        Looked up in the LRU, then in the shared store, and otherwise
+        computed and stored in both.
+
+        """
+        import nhood
+        graph, prefix = self.graph, self.prefix
+        key = (root, depth, closed)
+        members = self.cache.get(key)
+        if members is not None:
+            return members
+        store_key = '{}{}:{}:{}'.format(prefix, root, depth, int(closed))
+        data = self.store.get(store_key)
+        if data is not None:
+            self.store_hits += 1
+            members = numpy.frombuffer(data, dtype=numpy.int64)
+        else:
+            if root not in graph:
+                raise KeyError(root)
+            members = numpy.array(sorted(nhood.neighborhood(
+                graph, root, depth, closed)), dtype=numpy.int64)
+            self.store.set(store_key, members.tobytes(), ex=STORE_TTL)
+        if graph is self.graph: # not computed on a snapshot since replaced
+            self.cache.put(key, members)
+        return members
+
+    def ranks(self):
+        """Return `(graph, scores, ranks)`, the arrays aligned with the
+        labels of `graph`."""
+        with self._lock:
+            if self._ranks is None:
+                if os.environ.get('PATENT_MEMORY_BUDGET'):
+                    import streaming
+                    scores = streaming.pagerank(self.graph)
+                else:
+                    scores = self.derived.pagerank()
+                ranks = scores.rank(ascending=False, method='min')
+                self._ranks = (self.graph, scores.values,
+                               ranks.values.astype(int))
+        return self._ranks
+
+def _redis_store():
+    try:
+        return dataio.redis_client()
+    except ImportError:
+        return None
+
+def _nodes(value):
+    """Return a list of int nodes from an int, a list or a `'1,2'` string."""
+    if isinstance(value, str):
+        value = [part for part in value.split(',') if part.strip()]
+    elif not isinstance(value, (list, tuple)):
+        value = [value]
+    if not value:
+        raise ValueError('No nodes given')
+    return [int(node) for node in value]
+
+def _flag(value):
+    if isinstance(value, str):
+        return value.lower() in ('1', 'true', 'yes')
+    return bool(value)
+
+def _scalar(value):
+    """Return `value` as a JSON-serializable Python scalar."""
+    if value is None or isinstance(value, float) and numpy.isnan(value):
+        return None
+    return value.item() if isinstance(value, numpy.generic) else value
+
+def _message(exc):
+    if isinstance(exc, KeyError):
+        return 'Unknown node: {}'.format(exc.args[0])
+    return str(exc)
+
+# # HTTP
+
+class Server(object):
+    """HTTP/1.1 front end of a `QueryService`, with keep-alive.
+
+    Classify queries cost about the same for one node as for hundreds (see
+    `analysis.AnnotatedNetwork.classify_many`), so the classify queries
+    that arrive while one is running are answered together by the next
+    call.
+
+    """
+
+    def __init__(self, service, workers=WORKERS):
+        self.service = service
+        self.executor = concurrent.futures.ThreadPoolExecutor(workers)
+        self._pending = collections.defaultdict(list)
+        self._draining = set()
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    method, target, version = line.decode('latin-1').split()
+                except ValueError:
+                    await self.respond(writer, 400, {'error': 'Bad request'},
+                                       False)
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                length = int(headers.get('content-length', 0) or 0)
+                body = await reader.readexactly(length) if length else b''
+                status, payload = await self.dispatch(method, target, body)
+                keep_alive = (version == 'HTTP/1.1' and headers.get(
+                    'connection', '').lower() != 'close')
+                await self.respond(writer, status, payload, keep_alive)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def dispatch(self, method, target, body):
+        """Return `(status, payload)` for a request."""
+        url = urllib.parse.urlsplit(target)
+        name = url.path.strip('/')
+        loop = asyncio.get_running_loop()
+        try:
+            if name == 'batch':
+                if method != 'POST':
+                    return 405, {'error': 'Use POST for batches'}
+                queries = json.loads(body.decode() or '[]')
+                if not isinstance(queries, list):
+                    raise ValueError('A batch is a list of queries')
+                result = await loop.run_in_executor(
+                    self.executor, self.service.batch, queries)
+            elif name in QUERIES:
+                if method != 'GET':
+                    return 405, {'error': 'Use GET for queries'}
+                params = dict(urllib.parse.parse_qsl(url.query))
+                if name == 'classify':
+                    result = await self.classify(**params)
+                else:
+                    result = await loop.run_in_executor(
+                        self.executor, self.service.query, name, params)
+            else:
+                return 404, {'error': 'Unknown query: {}'.format(name)}
+        except KeyError as exc:
+            return 404, {'error': _message(exc)}
+        except (ValueError, TypeError) as exc:
+            return 400, {'error': _message(exc)}
+        except Exception as exc:
+            return 500, {'error': repr(exc)}
+        return 200, {'result': result}
+
+    async def classify(self, node, field='appMyName', max_cited=20):
+        """Queue a classify query and wait for the batch it joins."""
+        nodes = _nodes(node)
+        self.service.graph.ids(nodes) # fail here, not in the whole batch
+        self.service.counts['classify'] += 1
+        key = (field, int(max_cited))
+        future = asyncio.get_running_loop().create_future()
+        self._pending[key].append((nodes, future))
+        if key not in self._draining:
+            self._draining.add(key)
+            asyncio.ensure_future(self._drain(key))
+        return await future
+
+    async def _drain(self, key):
+        loop = asyncio.get_running_loop()
+        try:
+            while self._pending[key]:
+                batch, self._pending[key] = self._pending[key], []
+                nodes = [node for queued, _ in batch for node in queued]
+                try:
+                    results = await loop.run_in_executor(
+                        self.executor, self.service.query_classify, nodes,
+                        *key)
+                except Exception as exc:
+                    for _, future in batch:
+                        future.set_exception(exc)
+                    continue
+                start = 0
+                for queued, future in batch:
+                    future.set_result(results[start:start + len(queued)])
+                    start += len(queued)
+        finally:
+            self._draining.discard(key)
+
+    async def respond(self, writer, status, payload, keep_alive):
+        body = json.dumps(payload).encode()
+        writer.write('HTTP/1.1 {} {}\r\n'
+                     'Content-Type: application/json\r\n'
+                     'Content-Length: {}\r\n'
+                     'Connection: {}\r\n\r\n'
+                     .format(status, REASONS[status], len(body),
+                             'keep-alive' if keep_alive else 'close')
+                     .encode() + body)
+        await writer.drain()
+
+async def refresh_periodically(server, interval):
+    """Apply new delta files to `server`'s service every `interval` s."""
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            applied = await loop.run_in_executor(server.executor,
+                                                 server.service.refresh)
+        except Exception as exc:
+            print('Applying deltas failed: {!r}'.format(exc),
+                  file=sys.stderr)
+            continue
+        if applied:
+            print('Applied {} delta files, serving snapshot {}'.format(
+                applied, server.service.snapshot.key), file=sys.stderr)
+
+async def serve(service, host=HOST, port=PORT, unix=None, workers=WORKERS,
+                refresh=REFRESH_INTERVAL):
+    """Serve `service` until cancelled.
+
+    With `PATENT_DELTA_DIR` set, new delta files are applied every
+    `refresh` seconds (never, if `refresh` is 0).
+
+    """
+    server = Server(service, workers)
+    if refresh and os.environ.get('PATENT_DELTA_DIR'):
+        asyncio.ensure_future(refresh_periodically(server, refresh))
+    if unix:
+        listener = await asyncio.start_unix_server(server.handle, unix)
+    else:
+        listener = await asyncio.start_server(server.handle, host, port)
+    print('Serving snapshot {} on {}'.format(
+        service.snapshot.key, unix or '{}:{}'.format(host, port)),
+        file=sys.stderr)
+    async with listener:
+        await listener.serve_forever()
+
+# # Load test
+
+# Share of each query in the load test; nodes are drawn with probability
+# proportional to indegree + 1, so popular patents are asked about more.
+LOAD_MIX = (('neighborhood', 0.5), ('degree', 0.2), ('pagerank', 0.15),
+            ('classify', 0.15))
+
+def load_targets(graph, requests, seed=0, mix=LOAD_MIX):
+    """Return a list of `(query, target)` pairs for `load_test`."""
+    rng = numpy.random.RandomState(seed)
+    weights = graph.in_degree_array() + 1.0
+    nodes = graph.labels[rng.choice(len(graph.labels), requests,
+                                    p=weights / weights.sum())]
+    names = [name for name, _ in mix]
+    shares = numpy.array([share for _, share in mix])
+    queries = rng.choice(len(names), requests, p=shares / shares.sum())
+    return [(names[q], '/{}?node={}'.format(names[q], node))
+            for q, node in zip(queries, nodes)]
+
+async def _client(host, port, unix, targets, latencies):
+    if unix:
+        reader, writer = await asyncio.open_unix_connection(unix)
+    else:
+        reader, writer = await asyncio.open_connection(host, port)
+    try:
+        for name, target in targets:
+            start = time.perf_counter()
+            writer.write('GET {} HTTP/1.1\r\nHost: {}\r\n\r\n'
+                         .format(target, host).encode())
+            await writer.drain()
+            status = int((await reader.readline()).split()[1])
+            length = 0
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b''):
+                    break
+                if line.lower().startswith(b'content-length:'):
+                    length = int(line.split(b':')[1])
+            await reader.readexactly(length)
+            latencies.append((name, status, time.perf_counter() - start))
+    finally:
+        writer.close()
+
+async def _load(host, port, unix, targets, concurrency):
+    latencies = []
+    await asyncio.gather(*[
+        _client(host, port, unix, targets[i::concurrency], latencies)
+        for i in range(concurrency)])
+    return latencies
+
+def load_test(host=HOST, port=PORT, unix=None, requests=10000,
+              concurrency=16, seed=0, graph=None):
+    """Send a mix of queries to a running server, return latency stats.
+
+    The result is a `pandas.DataFrame` with the count, errors, p50, p99 and
+    mean latency in milliseconds per query, plus an `all` row; the elapsed
+    time and throughput are printed to stderr. `graph` supplies the nodes
+    to ask about and defaults to the current snapshot's graph.
+
+    """
+    import pandas
+    if graph is None:
+        graph = dataio.load_current_snapshot().graph
+    targets = load_targets(graph, requests, seed)
+    start = time.perf_counter()
+    latencies = asyncio.run(_load(host, port, unix, targets, concurrency))
+    elapsed = time.perf_counter() - start
+    print('{} requests in {:.3f} seconds ({:.0f} requests/sec) '
+          'with {} connections'.format(len(latencies), elapsed,
+                                       len(latencies) / elapsed,
+                                       concurrency), file=sys.stderr)
+    frame = pandas.DataFrame(latencies, columns=['query', 'status',
+                                                 'seconds'])
+    frame = pandas.concat([frame, frame.assign(query='all')])
+    milliseconds = frame.groupby('query')['seconds'].describe(
+        percentiles=[0.5, 0.99]) * 1000
+    table = pandas.DataFrame({
+        'count': frame.groupby('query').size(),
+        'errors': frame[frame['status'] != 200].groupby('query').size(),
+        'p50_ms': milliseconds['50%'],
+        'p99_ms': milliseconds['99%'],
+        'mean_ms': milliseconds['mean'],
+    }).fillna({'errors': 0}).astype({'errors': int})
+    return table
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+    for name in ('serve', 'loadtest'):
+        command = commands.add_parser(name)
+        command.add_argument('--host', default=HOST)
+        command.add_argument('--port', type=int, default=PORT)
+        command.add_argument('--unix', help='Unix socket path instead of TCP')
+        if name == 'serve':
+            command.add_argument('--cache-size', type=int, default=CACHE_SIZE)
+            command.add_argument('--workers', type=int, default=WORKERS)
+            command.add_argument('--refresh', type=float,
+                                 default=REFRESH_INTERVAL,
+                                 help='seconds between checks for deltas')
+        else:
+            command.add_argument('--requests', type=int, default=10000)
+            command.add_argument('--concurrency', type=int, default=16)
+            command.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    if args.command == 'serve':
+        with dataio.timed('Loading snapshot'):
+            service = QueryService(dataio.load_current_snapshot(),
+                                   args.cache_size)
+        with dataio.timed('Computing PageRank'):
+            service.ranks()
+        try:
+            asyncio.run(serve(service, args.host, args.port, args.unix,
+                              args.workers, args.refresh))
+        except KeyboardInterrupt:
+            pass
+    else:
+        print(load_test(args.host, args.port, args.unix, args.requests,
+                        args.concurrency, args.seed).to_string())
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,163 @@
+"""Co-citation and bibliographic-coupling similarity over the whole graph.
+
+With `A` the citation adjacency (`A[i, j] = 1` if `i` cites `j`),
+co-citation is `A.T @ A` (how many patents cite both `i` and `j`) and
+bibliographic coupling is `A @ A.T` (how many patents both `i` and `j`
+cite). Both are computed one block of rows at a time and reduced to the
+`k` strongest entries per row above a threshold before the next block, so
+memory stays bounded by the block size. Blocks are independent, so the
+computation can be split across machines by row range.
+
+The sparse similarity graph feeds a label-propagation community detection
+step whose communities can be scored against IPC labels.
+
+"""
+import numpy
+import pandas
+import scipy.sparse
+
+from csrgraph import as_csr
+
+ROW_BLOCK = 4096 # rows per sparse product block
+TOP_K = 20 # strongest similarities kept per row
+THRESHOLD = 2 # minimum shared citations for a similarity to count
+
+def citation_matrices(graph):
+    """Return `(A, A.T)` as sparse CSR matrices over dense node ids."""
+    csr = as_csr(graph)
+    n = csr.number_of_nodes()
+    forward = scipy.sparse.csr_matrix(
+        (numpy.ones(len(csr.indices), dtype=numpy.int32), csr.indices,
+         csr.indptr), shape=(n, n))
+    reverse = scipy.sparse.csr_matrix(
+        (numpy.ones(len(csr.rindices), dtype=numpy.int32), csr.rindices,
+         csr.rindptr), shape=(n, n))
+    return forward, reverse
+
+def similarity_blocks(graph, kind='cocitation', k=TOP_K, threshold=THRESHOLD,
+                      block=ROW_BLOCK, rows=None):
+    """Yield `(lo, hi, matrix)` blocks of a thresholded top-k similarity.
+
+    `kind` is `'cocitation'` or `'coupling'`. Each `matrix` holds rows
+    `lo:hi` of the full similarity with the diagonal removed, entries
+    below `threshold` dropped and only the `k` largest entries per row
+    kept. `rows` optionally restricts the computation to a `(lo, hi)` row
+    range, for splitting the work across processes or machines.
+
+    """
+    forward, reverse = citation_matrices(graph)
+    if kind == 'cocitation':
+        left, right = reverse, forward
+    elif kind == 'coupling':
+        left, right = forward, reverse
+    else:
+        raise ValueError('Unknown similarity: {}'.format(kind))
+    start, stop = rows if rows is not None else (0, forward.shape[0])
+    for lo in range(start, stop, block):
+        hi = min(lo + block, stop)
+        product = (left[lo:hi] @ right).tocoo()
+        keep = (product.row + lo != product.col) & (product.data >= threshold)
+        yield lo, hi, _top_k(product.row[keep], product.col[keep],
+                             product.data[keep], hi - lo, forward.shape[1], k)
+
+def _top_k(rows, cols, data, nrows, ncols, k):
+    """Return a CSR matrix keeping the `k` largest entries of each row."""
+    order = numpy.lexsort((cols, -data, rows))
+    rows, cols, data = rows[order], cols[order], data[order]
+    starts = numpy.searchsorted(rows, rows, side='left')
+    keep = numpy.arange(len(rows)) - starts < k
+    return scipy.sparse.csr_matrix((data[keep], (rows[keep], cols[keep])),
+                                   shape=(nrows, ncols))
+
+def similarity(graph, kind='cocitation', k=TOP_K, threshold=THRESHOLD,
+               block=ROW_BLOCK):
+    """Return the full thresholded top-k similarity as one CSR matrix."""
+    blocks = [matrix for _, _, matrix in
+              similarity_blocks(graph, kind, k, threshold, block)]
+    return scipy.sparse.vstack(blocks).tocsr() if blocks else None
+
+def label_propagation(matrix, max_iter=50, seed=0):
+    """Detect communities in a weighted similarity graph.
+
+    The matrix is symmetrized (keeping the larger weight of each pair).
+    Each round, a random half of the nodes adopt the label with the largest
+    total weight among their neighbors (smallest label on ties); updating
+    only half the nodes avoids the oscillations of fully synchronous
+    propagation. Stops when a round changes nothing or after `max_iter`
+    rounds. Return an array of community labels per node.
+
+    """
+    matrix = matrix.maximum(matrix.T).tocoo()
+    n = matrix.shape[0]
+    labels = numpy.arange(n)
+    rng = numpy.random.RandomState(seed)
+    rows, cols, weights = matrix.row, matrix.col, matrix.data
+    for _ in range(max_iter):
+        keys = rows.astype(numpy.int64) * n + labels[cols]
+        unique, inverse = numpy.unique(keys, return_inverse=True)
+        totals = numpy.bincount(inverse, weights=weights)
+        node, label = unique // n, unique % n
+        order = numpy.lexsort((label, -totals, node))
+        node, label = node[order], label[order]
+        first = numpy.ones(len(node), dtype=bool)
+        first[1:] = node[1:] != node[:-1]
+        best = labels.copy()
+        best[node[first]] = label[first]
+        if (best == labels).all():
+            break
+        update = rng.rand(n) < 0.5
+        labels = numpy.where(update, best, labels)
+    return labels
+
+def communities(graph, kind='cocitation', k=TOP_K, threshold=THRESHOLD,
+                block=ROW_BLOCK, max_iter=50, seed=0):
+    """Return a `pandas.Series` of community ids indexed by node."""
+    csr = as_csr(graph)
+    labels = label_propagation(similarity(csr, kind, k, threshold, block),
+                               max_iter, seed)
+    return pandas.Series(labels, index=csr.labels, name='community')
+
+def compare_with_labels(found, truth):
+    """Score communities against reference labels such as IPC codes.
+
+    Both arguments are `pandas.Series` indexed by node; only nodes present
+    in both are compared. Return a dict with the number of `nodes`,
+    `purity`, normalized mutual information (`nmi`) and adjusted Rand
+    index (`ari`).
+
+    """
+    found, truth = found.dropna(), truth.dropna()
+    found = found[~found.index.duplicated(keep='first')]
+    truth = truth[~truth.index.duplicated(keep='first')]
+    frame = pandas.concat([found.rename('found'), truth.rename('truth')],
+                          axis=1, join='inner').dropna()
+    n = len(frame)
+    if n < 2:
+        return {'nodes': n, 'purity': float('nan'), 'nmi': float('nan'),
+                'ari': float('nan')}
+    f, f_names = pandas.factorize(frame['found'])
+    t, t_names = pandas.factorize(frame['truth'])
+    keys, joint = numpy.unique(f.astype(numpy.int64) * len(t_names) + t,
+                               return_counts=True)
+    rows, cols = keys // len(t_names), keys % len(t_names)
+    joint = joint.astype(numpy.float64)
+    a = numpy.bincount(rows, weights=joint, minlength=len(f_names))
+    b = numpy.bincount(cols, weights=joint, minlength=len(t_names))
+    best = numpy.zeros(len(f_names))
+    numpy.maximum.at(best, rows, joint)
+    purity = best.sum() / n
+
+    mutual = (joint / n * numpy.log(joint * n / (a[rows] * b[cols]))).sum()
+    def entropy(counts):
+        p = counts[counts > 0] / n
+        return -(p * numpy.log(p)).sum()
+    mean_entropy = (entropy(a) + entropy(b)) / 2
+    nmi = mutual / mean_entropy if mean_entropy > 0 else 1.0
+
+    def pairs(counts):
+        return (counts * (counts - 1) / 2).sum()
+    expected = pairs(a) * pairs(b) / (n * (n - 1) / 2)
+    maximum = (pairs(a) + pairs(b)) / 2
+    ari = ((pairs(joint) - expected) / (maximum - expected)
+           if maximum != expected else 1.0)
+    return {'nodes': n, 'purity': purity, 'nmi': nmi, 'ari': ari}
@@ -0,0 +1,251 @@
+"""Memory-mapped on-disk snapshots of the citation graph and its metadata.
+
+A snapshot is a directory of `.npy` files: the CSR arrays of a
+`csrgraph.CSRGraph` plus one array per metadata column, described by a
+`manifest.json`. Arrays are opened with `mmap_mode='r'`, so every process
+that opens the same snapshot shares one page-cached copy of the data.
+
+Snapshots are keyed by a hash of the source file paths, sizes and
+modification times, so editing a source file produces a new key instead of
+serving stale data.
+
+"""
+import os
+import os.path
+import json
+import shutil
+import hashlib
+import tempfile
+
+import numpy
+import pandas
+
+from csrgraph import CSRGraph
+
+FORMAT_VERSION = 1
+GRAPH_ARRAYS = ('labels', 'indptr', 'indices', 'rindptr', 'rindices')
+REDIS_CHUNK_SIZE = 64 * 2**20 # bytes per Redis value, well below 512 MB
+
+def file_identity(filename):
+    """Return `[path, size, mtime]` identifying a file's current state."""
+    stat = os.stat(filename)
+    return [os.path.abspath(filename), stat.st_size, stat.st_mtime_ns]
+
+def source_key(filenames, options=()):
+    """Return a hash identifying the current state of the source files.
+
+    `options` are JSON-serializable loader settings (such as the metadata
+    columns) that also change the snapshot contents.
+
+    """
+    digest = hashlib.sha1(json.dumps([FORMAT_VERSION, list(options)])
+                          .encode())
+    for filename in filenames:
+        digest.update(json.dumps(file_identity(filename)).encode())
+    return digest.hexdigest()
+
+def snapshot_path(snapshot_dir, key):
+    return os.path.join(snapshot_dir, key)
+
+def exists(snapshot_dir, key):
+    return os.path.exists(os.path.join(snapshot_path(snapshot_dir, key),
+                                       'manifest.json'))
+
+def write(snapshot_dir, key, graph, metadata, revision=0, parent=None,
+          watermark=()):
+    """Write `graph` and `metadata` as snapshot `key`, return its path.
+
+    `graph` may be either backend; it is stored in CSR form. The snapshot
+    is assembled in a temporary directory and renamed into place, so a
+    reader never sees a partially written snapshot.
+
+    Snapshots produced by applying deltas (see `ingest`) record their
+    `revision`, the `parent` snapshot key and the `watermark` of delta
+    files applied so far.
+
+    """
+    if not isinstance(graph, CSRGraph):
+        graph = CSRGraph.from_networkx(graph)
+    os.makedirs(snapshot_dir, exist_ok=True)
+    tmp = tempfile.mkdtemp(dir=snapshot_dir, prefix='.tmp-')
+    try:
+        for name in GRAPH_ARRAYS:
+            numpy.save(os.path.join(tmp, name + '.npy'), getattr(graph, name))
+        manifest = {
+            'version': FORMAT_VERSION,
+            'key': key,
+            'revision': revision,
+            'parent': parent,
+            'watermark': list(watermark),
+            'nodes': graph.number_of_nodes(),
+            'edges': graph.number_of_edges(),
+            'index': _save_column(tmp, 'index', metadata.index),
+            'index_name': metadata.index.name,
+            'columns': [
+                [column, _save_column(tmp, 'col{}'.format(i),
+                                      metadata[column])]
+                for i, column in enumerate(metadata.columns)
+            ],
+        }
+        with open(os.path.join(tmp, 'manifest.json'), 'w') as f:
+            json.dump(manifest, f)
+        path = snapshot_path(snapshot_dir, key)
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.rename(tmp, path)
+    except BaseException:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+    return path
+
+def _save_column(directory, stem, values):
+    """Save a column as `.npy` arrays, return a description of its encoding.
+
+    Numeric and datetime columns are saved as-is. Anything else is saved as
+    categorical codes plus a fixed-width string array of categories, which
+    (unlike object arrays) can be memory-mapped.
+
+    """
+    values = pandas.Series(values)
+    if (values.dtype.kind in 'biufmM'
+            and not isinstance(values.dtype, pandas.CategoricalDtype)):
+        numpy.save(os.path.join(directory, stem + '.npy'), values.values)
+        return {'stem': stem, 'encoding': 'plain'}
+    categorical = pandas.Categorical(values)
+    categories = numpy.asarray(categorical.categories)
+    if categories.dtype.kind == 'O':
+        categories = categories.astype(str)
+    numpy.save(os.path.join(directory, stem + '.npy'), categorical.codes)
+    numpy.save(os.path.join(directory, stem + '.categories.npy'), categories)
+    return {'stem': stem, 'encoding': 'categorical'}
+
+class Snapshot(object):
+    """An opened snapshot.
+
+    The graph and metadata are built lazily on first access, from arrays
+    that stay memory-mapped.
+
+    Constructor arguments:
+
+    -   **`path`** is the snapshot directory.
+
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'manifest.json')) as f:
+            self.manifest = json.load(f)
+        self._graph = None
+        self._metadata = None
+
+    @property
+    def key(self):
+        return self.manifest['key']
+
+    @property
+    def revision(self):
+        return self.manifest.get('revision', 0)
+
+    @property
+    def watermark(self):
+        return self.manifest.get('watermark', [])
+
+    def array(self, stem):
+        """Return the memory-mapped array stored under `stem`."""
+        return numpy.load(os.path.join(self.path, stem + '.npy'),
+                          mmap_mode='r')
+
+    @property
+    def graph(self):
+        if self._graph is None:
+            self._graph = CSRGraph(*[self.array(name)
+                                     for name in GRAPH_ARRAYS])
+        return self._graph
+
+    @property
+    def metadata(self):
+        if self._metadata is None:
+            # copy=False keeps each column (or its categorical codes) on
+            # the memory map instead of consolidating them into new blocks.
+            index = pandas.Index(self._load_column(self.manifest['index']),
+                                 name=self.manifest['index_name'],
+                                 copy=False)
+            self._metadata = pandas.DataFrame(
+                {column: self._load_column(spec)
+                 for column, spec in self.manifest['columns']},
+                index=index,
+                columns=[column for column, _ in self.manifest['columns']],
+                copy=False)
+        return self._metadata
+
+    def _load_column(self, spec):
+        values = self.array(spec['stem'])
+        if spec['encoding'] == 'categorical':
+            categories = numpy.load(os.path.join(
+                self.path, spec['stem'] + '.categories.npy'))
+            # The codes were written by _save_column, so skip validating
+            # them, which would read the whole column.
+            return pandas.Categorical.from_codes(
+                values, dtype=pandas.CategoricalDtype(categories),
+                validate=False)
+        return values
+
+def open_snapshot(snapshot_dir, key):
+    return Snapshot(snapshot_path(snapshot_dir, key))
+
+# # Optional Redis tier
+
+def push_to_redis(rc, path, prefix, chunk_size=REDIS_CHUNK_SIZE):
+    """Store the snapshot at `path` in Redis as fixed-size chunks.
+
+    Each file is split into values of at most `chunk_size` bytes under
+    `prefix + key + ':' + filename + ':' + n`. A hash at `prefix + key`
+    records the number of chunks per file and is written last, so readers
+    only see complete snapshots.
+
+    """
+    key = os.path.basename(path)
+    counts = {}
+    for filename in sorted(os.listdir(path)):
+        count = 0
+        with open(os.path.join(path, filename), 'rb') as f:
+            pipe = rc.pipeline(transaction=False)
+            for count, chunk in enumerate(iter(lambda: f.read(chunk_size),
+                                               b''), 1):
+                pipe.set('{}{}:{}:{}'.format(prefix, key, filename, count - 1),
+                         chunk)
+            pipe.execute()
+        counts[filename] = count
+    rc.hset(prefix + key, mapping=counts)
+
+def pull_from_redis(rc, snapshot_dir, key, prefix):
+    """Download snapshot `key` from Redis into `snapshot_dir`.
+
+    Return the local path, or `None` if Redis has no such snapshot.
+
+    """
+    counts = rc.hgetall(prefix + key)
+    if not counts:
+        return None
+    os.makedirs(snapshot_dir, exist_ok=True)
+    tmp = tempfile.mkdtemp(dir=snapshot_dir, prefix='.tmp-')
+    try:
+        for filename, count in counts.items():
+            filename = filename.decode()
+            with open(os.path.join(tmp, filename), 'wb') as f:
+                for i in range(int(count)):
+                    chunk = rc.get('{}{}:{}:{}'.format(prefix, key,
+                                                       filename, i))
+                    if chunk is None:
+                        raise KeyError('Missing chunk {} of {}'
+                                       .format(i, filename))
+                    f.write(chunk)
+        path = snapshot_path(snapshot_dir, key)
+        if not os.path.exists(path):
+            os.rename(tmp, path)
+        else:
+            shutil.rmtree(tmp)
+    except BaseException:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+    return path
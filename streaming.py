@@ -0,0 +1,435 @@
+"""Out-of-core snapshots and analyses for edgelists larger than memory.
+
+`build_snapshot` turns a citation edgelist into a snapshot (see `snapshot`)
+without ever holding all edges in memory:
+
+1.  The edgelist is parsed chunk by chunk (`dataio.iter_edge_chunks`).
+    Each chunk's edges are spilled to a binary file and its sorted unique
+    labels are saved as a run.
+
+2.  The runs are merged into the sorted label array.
+
+3.  Spilled edges are mapped to dense ids by looking them up in sorted
+    order in the memory-mapped labels, a merge join, while node degrees are
+    counted.
+
+4.  Every edge is written to its CSR position in both directions by a
+    counting sort, with the degree prefix sums as write cursors.
+
+5.  Each node's slice is sorted and duplicate edges are dropped, which
+    compacts the arrays in place.
+
+Per-edge work happens in blocks sized by a memory budget, set by
+`PATENT_MEMORY_BUDGET` in bytes with an optional `K`, `M` or `G` suffix
+(default 256M). Per-node arrays (labels, degrees, cursors) are
+memory-mapped files in a spill directory next to the snapshots, or in
+`PATENT_SPILL_DIR`; the operating system pages them in and out as needed.
+
+The analyses `in_degree_counts`, `top_in_degree`, `pagerank` and
+`neighborhoods` read a graph's memory-mapped CSR arrays block by block
+within the same budget, keeping only per-node vectors in memory.
+
+"""
+import os
+import os.path
+import shutil
+import tempfile
+
+import numpy
+import pandas
+from numpy.lib.format import open_memmap
+
+import dataio
+import snapshot
+import instrument
+from csrgraph import CSRGraph
+
+DEFAULT_MEMORY_BUDGET = 256 * 2**20
+SIZE_SUFFIXES = {'K': 2**10, 'M': 2**20, 'G': 2**30}
+MIN_BLOCK = 1024
+MERGE_FAN_IN = 64 # label runs merged at once
+
+# Approximate peak bytes per row or edge of each blockwise step, used to turn
+# the memory budget into block sizes.
+PARSE_BYTES_PER_ROW = 160
+MERGE_BYTES_PER_LABEL = 24
+REMAP_BYTES_PER_EDGE = 96
+PLACE_BYTES_PER_EDGE = 64
+SORT_BYTES_PER_EDGE = 56
+SCAN_BYTES_PER_EDGE = 32
+NODE_BYTES = 24
+
+def parse_size(text):
+    """Return the byte count of a size such as `'1048576'`, `'512M'`."""
+    text = text.strip().upper()
+    scale = 1
+    if text and text[-1] in SIZE_SUFFIXES:
+        scale, text = SIZE_SUFFIXES[text[-1]], text[:-1]
+    return int(float(text) * scale)
+
+def memory_budget(budget=None):
+    """Return `budget`, or the `PATENT_MEMORY_BUDGET` setting in bytes."""
+    if budget is not None:
+        return budget
+    setting = os.environ.get('PATENT_MEMORY_BUDGET')
+    return parse_size(setting) if setting else DEFAULT_MEMORY_BUDGET
+
+def _block(budget, bytes_per_item):
+    return max(MIN_BLOCK, memory_budget(budget) // bytes_per_item)
+
+# # Building snapshots
+
+def build_snapshot(graph_file, snapshot_dir, key, metadata=None,
+                   budget=None, spill_dir=None):
+    """Build snapshot `key` from an edgelist in bounded memory.
+
+    Return the snapshot path. The result is the same as
+    `snapshot.write(snapshot_dir, key, dataio.read_graph(graph_file,
+    backend='csr'), metadata)`.
+
+    -   **`metadata`** is a `pandas.DataFrame` indexed by node, or `None`
+        for a snapshot without metadata.
+
+    -   **`budget`** is the memory budget in bytes; see `memory_budget`.
+
+    -   **`spill_dir`** holds the temporary files, which take about 40
+        bytes per edge; defaults to `PATENT_SPILL_DIR` or `snapshot_dir`.
+
+    """
+    if metadata is None:
+        metadata = pandas.DataFrame(index=pandas.Index(
+            [], dtype=numpy.int64, name='applnID'))
+    spill_dir = spill_dir or os.environ.get('PATENT_SPILL_DIR', snapshot_dir)
+    os.makedirs(spill_dir, exist_ok=True)
+    work = tempfile.mkdtemp(dir=spill_dir, prefix='.spill-')
+    try:
+        graph = build_graph(graph_file, work, budget)
+        with instrument.span('streaming.write_snapshot',
+                             items=graph.number_of_edges()):
+            return snapshot.write(snapshot_dir, key, graph, metadata)
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+
+def build_graph(graph_file, work, budget=None):
+    """Build a `CSRGraph` of memory-mapped arrays in directory `work`."""
+    path = lambda name: os.path.join(work, name)
+    with instrument.span('streaming.spill') as span:
+        edges, runs = _spill(graph_file, path('edges.bin'), work, budget)
+        span.items = edges
+    with instrument.span('streaming.merge_labels', runs=len(runs)) as span:
+        labels = _merge_runs(runs, path('labels.npy'), budget)
+        span.items = len(labels)
+    n = len(labels)
+    with instrument.span('streaming.remap', items=edges):
+        out_degree = open_memmap(path('out_degree.npy'), 'w+',
+                                 numpy.int64, (n,))
+        in_degree = open_memmap(path('in_degree.npy'), 'w+',
+                                numpy.int64, (n,))
+        _remap(path('edges.bin'), path('ids.bin'), edges, labels,
+               out_degree, in_degree, budget)
+        os.remove(path('edges.bin'))
+    with instrument.span('streaming.place', items=edges):
+        indptr = _prefix_sums(out_degree, path('indptr.npy'))
+        rindptr = _prefix_sums(in_degree, path('rindptr.npy'))
+        indices = open_memmap(path('indices.npy'), 'w+', numpy.int32,
+                              (edges,))
+        rindices = open_memmap(path('rindices.npy'), 'w+', numpy.int32,
+                               (edges,))
+        # The degree arrays are done with; reuse them as write cursors.
+        out_degree[:] = indptr[:-1]
+        in_degree[:] = rindptr[:-1]
+        _place(path('ids.bin'), edges, indices, out_degree, rindices,
+               in_degree, budget)
+        os.remove(path('ids.bin'))
+    with instrument.span('streaming.deduplicate') as span:
+        kept = _deduplicate(indptr, indices, budget)
+        if _deduplicate(rindptr, rindices, budget) != kept:
+            raise AssertionError('Forward and reverse edge counts differ')
+        span.items = kept
+    return CSRGraph(labels, indptr, indices[:kept], rindptr,
+                    rindices[:kept])
+
+def _spill(graph_file, edges_file, work, budget):
+    """Write parsed edges as int64 pairs and one label run per chunk.
+
+    Return `(edge count, run file names)`.
+
+    """
+    edges, runs = 0, []
+    with open(edges_file, 'wb') as f:
+        for src, dst in dataio.iter_edge_chunks(
+                graph_file, _block(budget, PARSE_BYTES_PER_ROW)):
+            numpy.stack([src, dst], axis=1).tofile(f)
+            run = os.path.join(work, 'run{}.npy'.format(len(runs)))
+            numpy.save(run, _unique(numpy.concatenate([src, dst])))
+            runs.append(run)
+            edges += len(src)
+    return edges, runs
+
+def _merge_runs(runs, filename, budget):
+    """Merge sorted unique runs into one memory-mapped sorted unique array.
+
+    Runs are merged in passes of at most `MERGE_FAN_IN` at a time, so the
+    number of open files and the block read per run stay bounded however
+    many chunks the edgelist had.
+
+    """
+    stem = os.path.splitext(filename)[0]
+    level = 0
+    while len(runs) > MERGE_FAN_IN:
+        runs = [_merge_group(runs[start:start + MERGE_FAN_IN],
+                             '{}.pass{}.{}.npy'.format(stem, level, start),
+                             budget)
+                for start in range(0, len(runs), MERGE_FAN_IN)]
+        level += 1
+    _merge_group(runs, filename, budget)
+    return numpy.load(filename, mmap_mode='r')
+
+def _merge_group(runs, filename, budget):
+    """Merge sorted unique runs into a sorted unique `.npy` file, delete
+    the runs and return `filename`.
+
+    Each round loads a block from every run. Every value up to the
+    smallest last value of the blocks is then known to be loaded, so those
+    values are merged and written; the run that ended there is always
+    consumed, so every round makes progress.
+
+    """
+    arrays = [numpy.load(run, mmap_mode='r') for run in runs]
+    block = max(MIN_BLOCK, _block(budget, MERGE_BYTES_PER_LABEL)
+                           // max(len(arrays), 1))
+    positions = [0] * len(arrays)
+    raw = filename + '.raw'
+    count = 0
+    with open(raw, 'wb') as f:
+        while True:
+            heads = [array[position:position + block]
+                     for array, position in zip(arrays, positions)]
+            bounds = [head[-1] for head in heads if len(head)]
+            if not bounds:
+                break
+            bound = min(bounds)
+            taken = []
+            for i, head in enumerate(heads):
+                k = int(numpy.searchsorted(head, bound, side='right'))
+                taken.append(head[:k])
+                positions[i] += k
+            merged = _unique(numpy.concatenate(taken))
+            merged.tofile(f)
+            count += len(merged)
+    del arrays, heads # close the runs' memory maps
+    for run in runs:
+        os.remove(run)
+    labels = open_memmap(filename, 'w+', numpy.int64, (count,))
+    if count:
+        labels[:] = numpy.memmap(raw, numpy.int64, 'r', shape=(count,))
+    os.remove(raw)
+    labels.flush()
+    del labels
+    return filename
+
+def _unique(values):
+    """Return the unique values of `values`, which is sorted in place."""
+    values.sort()
+    if not len(values):
+        return values
+    return values[numpy.r_[True, values[1:] != values[:-1]]]
+
+def _lookup(labels, values):
+    """Return the positions of `values` in the sorted array `labels`.
+
+    Values are searched in sorted order, so the binary searches sweep the
+    memory-mapped labels front to back.
+
+    """
+    order = numpy.argsort(values, kind='stable')
+    ids = numpy.empty(len(values), dtype=numpy.int64)
+    ids[order] = numpy.searchsorted(labels, values[order])
+    return ids
+
+def _count(degrees, ids):
+    nodes, counts = numpy.unique(ids, return_counts=True)
+    degrees[nodes] += counts
+
+def _remap(edges_file, ids_file, edges, labels, out_degree, in_degree,
+           budget):
+    """Write edges as int32 dense id pairs and count node degrees."""
+    if not edges:
+        open(ids_file, 'wb').close()
+        return
+    pairs = numpy.memmap(edges_file, numpy.int64, 'r', shape=(edges, 2))
+    block = _block(budget, REMAP_BYTES_PER_EDGE)
+    with open(ids_file, 'wb') as f:
+        for start in range(0, edges, block):
+            chunk = numpy.array(pairs[start:start + block])
+            ids = _lookup(labels, chunk.ravel()).reshape(-1, 2)
+            ids.astype(numpy.int32).tofile(f)
+            _count(out_degree, ids[:, 0])
+            _count(in_degree, ids[:, 1])
+
+def _prefix_sums(degrees, filename):
+    """Return a memory-mapped CSR `indptr` array for `degrees`."""
+    indptr = open_memmap(filename, 'w+', numpy.int64, (len(degrees) + 1,))
+    indptr[0] = 0
+    numpy.cumsum(degrees, out=indptr[1:])
+    return indptr
+
+def _place(ids_file, edges, indices, cursor, rindices, rcursor, budget):
+    """Write every edge at its CSR position in both directions."""
+    if not edges:
+        return
+    pairs = numpy.memmap(ids_file, numpy.int32, 'r', shape=(edges, 2))
+    block = _block(budget, PLACE_BYTES_PER_EDGE)
+    for start in range(0, edges, block):
+        chunk = numpy.array(pairs[start:start + block])
+        _scatter(indices, cursor, chunk[:, 0], chunk[:, 1])
+        _scatter(rindices, rcursor, chunk[:, 1], chunk[:, 0])
+
+def _scatter(indices, cursor, rows, cols):
+    """Write `cols` at the next free positions of their `rows`."""
+    order = numpy.argsort(rows, kind='stable')
+    rows, cols = rows[order], cols[order]
+    starts = numpy.flatnonzero(numpy.r_[True, rows[1:] != rows[:-1]])
+    counts = numpy.diff(numpy.r_[starts, len(rows)])
+    nodes = rows[starts]
+    offsets = numpy.arange(len(rows)) - numpy.repeat(starts, counts)
+    indices[numpy.repeat(cursor[nodes], counts) + offsets] = cols
+    cursor[nodes] += counts
+
+def _deduplicate(indptr, indices, budget):
+    """Sort each node's slice of `indices` and drop repeated entries.
+
+    The arrays are compacted in place, rewriting `indptr` as blocks of
+    nodes are done; return the number of entries kept.
+
+    """
+    n = len(indptr) - 1
+    block = _block(budget, SORT_BYTES_PER_EDGE)
+    row, start, kept = 0, 0, 0
+    while row < n:
+        stop = int(numpy.searchsorted(indptr, start + block,
+                                      side='right')) - 1
+        stop = min(max(stop, row + 1), row + block, n)
+        ends = numpy.array(indptr[row + 1:stop + 1])
+        lengths = numpy.diff(numpy.r_[start, ends])
+        owner = numpy.repeat(numpy.arange(stop - row), lengths)
+        keys = _unique(owner * n + numpy.array(indices[start:ends[-1]]))
+        indices[kept:kept + len(keys)] = keys % n
+        counts = numpy.bincount(keys // n, minlength=stop - row)
+        indptr[row + 1:stop + 1] = kept + numpy.cumsum(counts)
+        kept += len(keys)
+        row, start = stop, int(ends[-1])
+    return kept
+
+# # Blockwise analyses
+
+def _row_blocks(indptr, block):
+    """Yield `(start, stop)` node ranges holding about `block` edges."""
+    n = len(indptr) - 1
+    row = 0
+    while row < n:
+        stop = int(numpy.searchsorted(indptr, indptr[row] + block,
+                                      side='right')) - 1
+        stop = min(max(stop, row + 1), row + block, n)
+        yield row, stop
+        row = stop
+
+def _node_blocks(n, block):
+    for start in range(0, n, block):
+        yield start, min(start + block, n)
+
+def in_degree_counts(graph, budget=None):
+    """Return a `pandas.Series` of the number of nodes per indegree."""
+    counts = numpy.zeros(1, dtype=numpy.int64)
+    for start, stop in _node_blocks(len(graph.labels),
+                                    _block(budget, NODE_BYTES)):
+        found = numpy.bincount(numpy.diff(graph.rindptr[start:stop + 1]))
+        if len(found) > len(counts):
+            counts = numpy.r_[counts, numpy.zeros(len(found) - len(counts),
+                                                  dtype=numpy.int64)]
+        counts[:len(found)] += found
+    series = pandas.Series(counts, name='nodes')
+    series.index.name = 'indegree'
+    return series[series > 0]
+
+def top_in_degree(graph, k=10, budget=None):
+    """Return the `k` highest indegrees as a `pandas.Series` by node.
+
+    Ties are broken by label, as a stable sort of the indegrees would.
+
+    """
+    best_ids = numpy.empty(0, dtype=numpy.int64)
+    best = numpy.empty(0, dtype=numpy.int64)
+    for start, stop in _node_blocks(len(graph.labels),
+                                    _block(budget, NODE_BYTES)):
+        ids = numpy.r_[best_ids, numpy.arange(start, stop)]
+        degrees = numpy.r_[best, numpy.diff(graph.rindptr[start:stop + 1])]
+        order = numpy.lexsort((ids, -degrees))[:k]
+        best_ids, best = ids[order], degrees[order]
+    return pandas.Series(best, index=graph.labels[best_ids], name='indegree')
+
+def pagerank(graph, alpha=0.85, tol=1e-6, max_iter=200, budget=None):
+    """Return PageRank scores as a `pandas.Series` indexed by node.
+
+    Iterates like `pagerank.PageRank.scores`, but each step reads the
+    memory-mapped reverse arrays in blocks of nodes, so the transition
+    matrix is never built.
+
+    """
+    n = len(graph.labels)
+    out_degree = numpy.diff(graph.indptr)
+    dangling = out_degree == 0
+    inverse = 1.0 / numpy.maximum(out_degree, 1)
+    blocks = list(_row_blocks(graph.rindptr, _block(budget,
+                                                    SCAN_BYTES_PER_EDGE)))
+    x = numpy.full(n, 1.0 / n)
+    with instrument.span('streaming.pagerank', blocks=len(blocks)) as span:
+        for iterations in range(1, max_iter + 1):
+            last = x
+            share = last * inverse
+            teleport = (alpha * last[dangling].sum() + 1 - alpha) / n
+            x = numpy.empty(n)
+            for start, stop in blocks:
+                bounds = numpy.array(graph.rindptr[start:stop + 1])
+                owner = numpy.repeat(numpy.arange(stop - start),
+                                     numpy.diff(bounds))
+                cited = share[graph.rindices[bounds[0]:bounds[-1]]]
+                x[start:stop] = alpha * numpy.bincount(
+                    owner, weights=cited, minlength=stop - start) + teleport
+            if numpy.abs(x - last).sum() < n * tol:
+                break
+        else:
+            raise RuntimeError('PageRank did not converge in {} '
+                               'iterations'.format(max_iter))
+        span.items = iterations
+    return pandas.Series(x, index=numpy.asarray(graph.labels),
+                         name='pagerank')
+
+def neighborhoods(graph, roots=None, closed=False, budget=None):
+    """Yield `(root, members)` for the 1-neighborhoods of nodes.
+
+    `members` is a sorted label array of the patents citing `root`, plus
+    `root` itself if `closed`. With `roots=None`, every node is visited in
+    label order and the reverse arrays are read sequentially in blocks;
+    otherwise the roots are visited in the given order, raising `KeyError`
+    for a root that is not in the graph.
+
+    """
+    if roots is None:
+        blocks = _row_blocks(graph.rindptr, _block(budget,
+                                                   SCAN_BYTES_PER_EDGE))
+    else:
+        roots = numpy.asarray(list(roots), dtype=numpy.int64)
+        ids = graph.ids(roots)
+        blocks = ((i, i + 1) for i in ids)
+    for start, stop in blocks:
+        bounds = numpy.array(graph.rindptr[start:stop + 1])
+        members = graph.labels[graph.rindices[bounds[0]:bounds[-1]]]
+        bounds -= bounds[0]
+        for i in range(stop - start):
+            root = graph.labels[start + i]
+            nhood = members[bounds[i]:bounds[i + 1]]
+            if closed:
+                nhood = numpy.insert(nhood, numpy.searchsorted(nhood, root),
+                                     root)
+            yield int(root), nhood
@@ -0,0 +1,200 @@
+"""Time-sliced citation index for date-windowed analyses.
+
+Every citation is dated by the filing date of the citing patent, and edges
+are kept sorted by that date. A date window is then a contiguous slice of
+the edge arrays, so indegree, PageRank, neighborhoods and classification
+can be evaluated on the graph as of a date, or within a window, without
+building a new `networkx.DiGraph`. Sweeps over a series of dates add each
+slice to running totals, which costs one pass over the edges overall.
+
+Windows are half-open: `start <= date < end`, with `None` meaning
+unbounded. Citations whose citing patent has no filing date are left out of
+every window.
+
+"""
+import numpy
+import pandas
+
+import pagerank
+from analysis import AnnotatedNetwork
+from csrgraph import CSRGraph, as_csr
+
+class TemporalIndex(object):
+    """Citation edges ordered by citing date.
+
+    Constructor arguments:
+
+    -   **`graph`** is a `networkx.DiGraph` or `csrgraph.CSRGraph`.
+
+    -   **`dates`** is a `pandas.Series` of filing dates indexed by node
+        (e.g. the `applnFilingDate` metadata column).
+
+    """
+
+    def __init__(self, graph, dates):
+        self.graph = as_csr(graph)
+        dates = pandas.to_datetime(dates).dropna()
+        dates = dates[~dates.index.duplicated(keep='first')]
+        self.node_dates = dates.reindex(self.graph.labels).values \
+                               .astype('datetime64[ns]')
+        src, dst = self.graph.edge_ids()
+        edge_dates = self.node_dates[src]
+        dated = ~numpy.isnat(edge_dates)
+        order = numpy.argsort(edge_dates[dated], kind='mergesort')
+        self.src = src[dated][order]
+        self.dst = dst[dated][order]
+        self.edge_dates = edge_dates[dated][order]
+        # Citing date of every edge in reverse CSR order, for windowed
+        # predecessor queries on the full graph.
+        self.rdates = self.node_dates[self.graph.rindices]
+
+    @classmethod
+    def from_metadata(cls, graph, metadata, field='applnFilingDate'):
+        return cls(graph, metadata[field].dropna())
+
+    @property
+    def labels(self):
+        return self.graph.labels
+
+    def _bounds(self, start=None, end=None):
+        """Return the edge slice `lo:hi` for a date window."""
+        lo = 0 if start is None else numpy.searchsorted(
+            self.edge_dates, numpy.datetime64(pandas.Timestamp(start)),
+            side='left')
+        hi = len(self.edge_dates) if end is None else numpy.searchsorted(
+            self.edge_dates, numpy.datetime64(pandas.Timestamp(end)),
+            side='left')
+        return int(lo), int(hi)
+
+    def edges(self, start=None, end=None):
+        """Return `(src, dst)` label arrays of citations in a window."""
+        lo, hi = self._bounds(start, end)
+        return self.labels[self.src[lo:hi]], self.labels[self.dst[lo:hi]]
+
+    def window_graph(self, start=None, end=None):
+        """Return a `CSRGraph` of the citations in a window.
+
+        The graph keeps every node, so results align across windows.
+
+        """
+        src, dst = self.edges(start, end)
+        return CSRGraph.from_edges(src, dst, labels=self.labels)
+
+    def in_degree(self, start=None, end=None):
+        """Return indegrees counting only citations in a window."""
+        lo, hi = self._bounds(start, end)
+        counts = numpy.bincount(self.dst[lo:hi], minlength=len(self.labels))
+        return pandas.Series(counts, index=self.labels, name='indegree')
+
+    def sweep_in_degree(self, dates, window=None):
+        """Return indegrees as of each date in `dates`.
+
+        The result is a `pandas.DataFrame` indexed by node with one column
+        per date. With `window` (a number of entries of `dates`), only
+        citations since the date `window` steps earlier are counted, giving
+        a sliding window. Each edge is counted once over the whole sweep.
+        Raises `ValueError` unless `dates` is ascending.
+
+        """
+        dates = _ascending(dates)
+        totals = numpy.zeros(len(self.labels), dtype=numpy.int64)
+        columns = []
+        lo = 0
+        for date in dates:
+            _, hi = self._bounds(end=date)
+            totals = totals + numpy.bincount(self.dst[lo:hi],
+                                             minlength=len(self.labels))
+            columns.append(totals)
+            lo = hi
+        if window is not None:
+            columns = [columns[i] - (columns[i - window] if i >= window
+                                     else 0)
+                       for i in range(len(columns))]
+        return pandas.DataFrame(numpy.column_stack(columns) if columns
+                                else numpy.empty((len(self.labels), 0)),
+                                index=self.labels, columns=dates)
+
+    def pagerank(self, start=None, end=None, **kwargs):
+        """Return PageRank scores of the citations in a window."""
+        src, dst = self.edges(start, end)
+        return pagerank.PageRank(src, dst, labels=self.labels,
+                                 **kwargs).scores()
+
+    def sweep_pagerank(self, dates, **kwargs):
+        """Return PageRank as of each date in `dates`, as columns.
+
+        One `pagerank.PageRank` engine is grown date by date, so every run
+        warm-starts from the previous date's scores and only each date's
+        new citations are merged into its transition matrix. Raises
+        `ValueError` unless `dates` is ascending.
+
+        """
+        dates = _ascending(dates)
+        engine = None
+        columns = {}
+        lo = 0
+        for date in dates:
+            _, hi = self._bounds(end=date)
+            src = self.labels[self.src[lo:hi]]
+            dst = self.labels[self.dst[lo:hi]]
+            if engine is None:
+                engine = pagerank.PageRank(src, dst, labels=self.labels,
+                                           **kwargs)
+            elif hi > lo:
+                engine.add_edges(src, dst)
+            columns[date] = engine.scores()
+            lo = hi
+        return pandas.DataFrame(columns, columns=list(columns))
+
+    def predecessors(self, node, start=None, end=None):
+        """Return the nodes citing `node` within a window."""
+        i = self.graph.id(node)
+        if i < 0:
+            raise KeyError(node)
+        lo, hi = self.graph.rindptr[i], self.graph.rindptr[i+1]
+        keep = self._in_window(self.rdates[lo:hi], start, end)
+        return self.labels[self.graph.rindices[lo:hi][keep]].tolist()
+
+    def _in_window(self, dates, start, end):
+        keep = ~numpy.isnat(dates)
+        if start is not None:
+            keep &= dates >= numpy.datetime64(pandas.Timestamp(start))
+        if end is not None:
+            keep &= dates < numpy.datetime64(pandas.Timestamp(end))
+        return keep
+
+    def neighborhood(self, root, depth=1, closed=False, start=None,
+                     end=None):
+        """Return the `depth`-neighborhood of `root` within a window.
+
+        Only citations made in the window are followed; the full reverse
+        adjacency is filtered on the fly instead of building a window graph.
+
+        """
+        nhood = set([root])
+        frontier = [root]
+        for _ in range(depth):
+            found = set()
+            for node in frontier:
+                found.update(self.predecessors(node, start, end))
+            frontier = found - nhood
+            if not frontier:
+                break
+            nhood |= frontier
+        if not closed:
+            nhood.discard(root)
+        return nhood
+
+    def classify_many(self, metadata, nodes, field, max_cited=20,
+                      start=None, end=None):
+        """Run `AnnotatedNetwork.classify_many` on a window's citations."""
+        network = AnnotatedNetwork(self.window_graph(start, end), metadata)
+        return network.classify_many(nodes, field, max_cited)
+
+def _ascending(dates):
+    """Return `dates` as a list, raising `ValueError` if not ascending."""
+    dates = list(dates)
+    stamps = [pandas.Timestamp(date) for date in dates]
+    if any(later < earlier for earlier, later in zip(stamps, stamps[1:])):
+        raise ValueError('Sweep dates must be in ascending order')
+    return dates
@@ -5,8 +5,9 @@ import statistics
 import dataio
 
 def main():
-    graph = dataio.graph()
-    metadata = dataio.metadata()
+    _, meta_files = dataio.source_files()
+    metadata = dataio.read_metadata(meta_files[2:], columns=['ipcaA'],
+                                    longform='keep')
 
     key = 'ipcaA'
     series_dirty = metadata[key]